@@ -0,0 +1,321 @@
+# Headless batch runner for galfit wrapper
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import galfit_run
+from psf import PSF, AUTO_CANDIDATES
+from psf_library import library_key
+from galfit_config import GalfitConfig
+from sersic import Sersic
+from region_file import read_regions, json_to_regions
+from utils import get_paths, init_target, saved_files, read_zero_point, \
+                  write_zero_point
+
+def read_manifest(manifest_file: str) -> list[dict]:
+    '''
+    Reads in batch manifest. The manifest is a JSON list of targets, each an
+    object with keys:
+        target: path to target fits file (required)
+        zero_point: zero point of target image (required unless saved)
+        psf_regions: ds9 region file with circle for star and box for frame,
+                     a .json region file, or a list of JSON regions (see
+                     region_file.json_to_regions)
+        psf_model: psf fits file to upload instead of fitting a psf
+        psf_auto: true (or a number of candidate stars) to find and fit psf
+                  stars automatically instead of from psf_regions
+        regions: ds9 region file with ellipses, points and box for frame,
+                 a .json region file, or a list of JSON regions
+        auto_regions: true to seed components from sources found in the
+                      image instead of regions, or a fitting box
+                      [xmin, xmax, ymin, ymax] to seed within
+        config: existing galfit config file to optimize instead of regions
+        constraint: galfit constraint file
+        conv_box: convolution box policy, 'auto' (default), 'full' or pixels
+        stamp_radius: half-width in pixels of psf model stamp
+        psf_library: true to link a compatible psf from the library (matched
+                     by exposure and CCD in target header) instead of
+                     fitting, and to add psfs fitted here to the library
+        psf_group: psf library group id, implies psf_library
+
+    Args:
+        manifest_file: path to manifest JSON file
+
+    Returns: list of target entries
+    '''
+    with open(manifest_file) as manifest:
+        entries = json.load(manifest)
+    # Resolve paths relative to manifest location
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    for entry in entries:
+        for key in ['target', 'psf_regions', 'psf_model', 'regions', 'config',
+                    'constraint']:
+            if isinstance(entry.get(key), str):
+                entry[key] = os.path.join(manifest_dir, os.path.expanduser(entry[key]))
+    return entries
+
+def entry_regions(regions: str|list|dict) -> str:
+    '''
+    Gets ds9 region string of a manifest entry's regions
+
+    Args:
+        regions: region file path, or JSON regions given in the manifest
+
+    Returns: ds9 region string
+    '''
+    if isinstance(regions, str):
+        return read_regions(regions)
+    return json_to_regions(regions)
+
+def relink_config(config_file: str, output_file: str, files: dict[str, str],
+                  copies: dict[str, str]) -> dict[str, str]:
+    '''
+    Copies a galfit config and points its file parameters to this target.
+    Files the config uses that belong to its source (mask, constraint) are
+    copied into the target output directory
+
+    Args:
+        config_file: galfit config to copy
+        output_file: path to write the relinked config to
+        files: galfit parameter letter -> new file path
+        copies: galfit parameter letter -> path to copy its file to
+
+    Returns: galfit parameter letter -> file path, or 'none', of each copy
+    '''
+    config = GalfitConfig.read(config_file)
+    for key, value in files.items():
+        config.set_header(key, value)
+    copied = {}
+    for key, copy in copies.items():
+        source = ' '.join(config.header[key].values) if key in config.header else 'none'
+        # Relative paths are tried from where batch runs, then from the config
+        if source != 'none' and not os.path.exists(source):
+            source = os.path.join(os.path.dirname(os.path.abspath(config_file)), source)
+        if source == 'none' or not os.path.exists(source):
+            copied[key] = 'none'
+        else:
+            if not os.path.exists(copy) or not os.path.samefile(source, copy):
+                shutil.copyfile(source, copy)
+            copied[key] = copy
+        if key in config.header:
+            config.set_header(key, copied[key])
+    config.write(output_file)
+    return copied
+
+def run_target(entry: dict, path_to_galfit: str, path_to_output: str) -> dict:
+    '''
+    Runs the psf and sersic stages for a single manifest entry, without ds9
+    or prompts
+
+    Args:
+        entry: manifest entry for target
+        path_to_galfit: path to galfit executable
+        path_to_output: root output directory (~/gf_out/)
+
+    Returns: summary of run
+    '''
+    summary = {'target': entry['target'], 'psf': False, 'sersic': False,
+               'error': None}
+    start = time.time()
+    try:
+        target_path, target_filename, output_dir = init_target(entry['target'], path_to_output)
+        summary['output_dir'] = output_dir
+        if 'zero_point' in entry:
+            zero_point = write_zero_point(output_dir, entry['zero_point'])
+        else:
+            zero_point = read_zero_point(output_dir)
+        if zero_point is None:
+            raise ValueError('no zero point given or saved for target')
+        saved = saved_files(output_dir, target_filename)
+
+        psf = PSF('?', target_path, output_dir, path_to_galfit,
+                  target_filename, zero_point, saved['psf_config_file'],
+                  saved['psf_config_output_file'], saved['psf_model_file'],
+                  saved['psf_mask'])
+        sersic = Sersic('?', target_path, output_dir, path_to_galfit,
+                        target_filename, zero_point, saved['sersic_config_file'],
+                        saved['sersic_config_output_file'], saved['sersic_mask'],
+                        saved['sersic_constraint'], psf)
+        psf.conv_box = entry.get('conv_box', psf.conv_box)
+        psf.stamp_radius = entry.get('stamp_radius', psf.stamp_radius)
+        # PSF stage
+        use_library = entry.get('psf_library', False) or 'psf_group' in entry
+        library_entry = psf.library.find(psf, entry.get('psf_group')) if use_library else None
+        if 'psf_model' in entry:
+            psf.upload_psf(entry['psf_model'])
+            summary['psf'] = True
+        elif library_entry is not None and library_entry['source'] != output_dir:
+            psf.library.link(psf, library_entry)
+            summary['psf'] = True
+            summary['psf_library'] = library_entry['key']
+        elif 'psf_regions' in entry or entry.get('psf_auto'):
+            if 'psf_regions' in entry:
+                summary['psf'] = psf.fit(entry_regions(entry['psf_regions']))
+            else:
+                n = entry['psf_auto'] if type(entry['psf_auto']) is int else AUTO_CANDIDATES
+                summary['psf'] = psf.auto_fit(n)
+            if summary['psf'] and use_library:
+                psf.library.add(psf, entry.get('psf_group'))
+        else:
+            # Reuse psf already saved for target
+            summary['psf'] = psf.model_file is not None
+        if not summary['psf']:
+            raise RuntimeError('no psf model for target')
+        # Sersic stage
+        if 'config' in entry:
+            sersic.config_file = output_dir + target_filename + '_config.txt'
+            copied = relink_config(entry['config'], sersic.config_file,
+                                   {'A': target_path,
+                                    'B': output_dir + target_filename + '_model_temp.fits',
+                                    'D': psf.model_file},
+                                   {'F': output_dir + target_filename + '_mask.fits',
+                                    'G': output_dir + target_filename + '_constraint.txt'})
+            sersic.mask = copied.get('F') if copied.get('F') != 'none' else None
+            sersic.constraint_file = copied.get('G') if copied.get('G') != 'none' else None
+            sersic.manifest.record('sersic_config_file', 'sersic_mask', 'sersic_constraint')
+            regions = None
+        elif 'regions' in entry:
+            regions = entry_regions(entry['regions'])
+        elif entry.get('auto_regions'):
+            box = entry['auto_regions'] if isinstance(entry['auto_regions'], list) else None
+            if not sersic.auto_config(box):
+                raise RuntimeError('no sources found to seed config')
+            regions = None
+        else:
+            regions = None
+        if regions is not None:
+            sersic.make_config(regions)
+        if 'constraint' in entry and sersic.config_file is not None:
+            sersic.upload_constraint(entry['constraint'])
+        summary['sersic'] = sersic.fit()
+    except Exception as error:
+        summary['error'] = f'{type(error).__name__}: {error}'
+        traceback.print_exc()
+    summary['seconds'] = round(time.time() - start, 2)
+
+    return summary
+
+def library_group(entry: dict) -> str|None:
+    '''
+    Gets psf library key a manifest entry would add its fitted psf to, so
+    entries sharing a key are not all fitted at once
+
+    Args:
+        entry: manifest entry for target
+
+    Returns: library key, or None if entry does not fit a psf for the library
+    '''
+    if not (entry.get('psf_library') or 'psf_group' in entry) or 'psf_model' in entry:
+        return None
+    if 'psf_regions' not in entry and not entry.get('psf_auto'):
+        return None
+    try:
+        return library_key(entry['target'], entry.get('psf_group'))
+    except OSError:
+        # Missing target is reported when the entry runs
+        return None
+
+def set_limits(timeout: float|None, max_iterations: int|None, cutout: bool =False) -> None:
+    '''
+    Sets default galfit run limits in a worker process
+
+    Args:
+        timeout: wall-clock seconds after which galfit is killed, or None
+        max_iterations: iteration after which galfit is killed, or None
+        cutout: whether galfit runs on cutouts of the fitting box
+
+    Returns: Nothing
+    '''
+    galfit_run.TIMEOUT = timeout
+    galfit_run.MAX_ITERATIONS = max_iterations
+    galfit_run.CUTOUT = cutout
+
+def run_batch(entries: list[dict], path_to_galfit: str, path_to_output: str,
+              workers: int, timeout: float|None =None,
+              max_iterations: int|None =None, cutout: bool =False) -> list[dict]:
+    '''
+    Runs all manifest entries through a process pool
+
+    Args:
+        entries: manifest entries
+        path_to_galfit: path to galfit executable
+        path_to_output: root output directory (~/gf_out/)
+        workers: number of worker processes
+        timeout: wall-clock seconds after which each galfit run is killed
+        max_iterations: iteration after which each galfit run is killed
+        cutout: whether galfit runs on cutouts of the fitting box
+
+    Returns: list of run summaries, in completion order
+    '''
+    # Entries sharing a psf library key wait for the first of them, so the
+    # psf is fitted once and linked by the rest. If the first has no psf,
+    # the next one fits
+    waiting = {}
+    first = []
+    for entry in entries:
+        key = library_group(entry)
+        if key is not None and key in waiting:
+            waiting[key].append(entry)
+            continue
+        if key is not None:
+            waiting[key] = []
+        first.append((entry, key))
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_limits,
+                             initargs=(timeout, max_iterations, cutout)) as pool:
+        futures = {pool.submit(run_target, entry, path_to_galfit, path_to_output): key
+                   for entry, key in first}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                summary = future.result()
+                summaries.append(summary)
+                status = 'done' if summary['sersic'] else 'FAILED'
+                print(f"[{len(summaries)}/{len(entries)}] {status} "
+                      f"{os.path.basename(summary['target'])} ({summary['seconds']}s)")
+                if key is None or not waiting[key]:
+                    continue
+                if summary['psf']:
+                    followers, key = waiting.pop(key), None
+                else:
+                    followers = [waiting[key].pop(0)]
+                for entry in followers:
+                    futures[pool.submit(run_target, entry, path_to_galfit, path_to_output)] = key
+    return summaries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run galfit wrapper psf and '
+                                     'sersic stages for many targets without ds9')
+    parser.add_argument('manifest', help='JSON manifest of targets')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('-o', '--summary', default=None,
+                        help='write JSON summary of runs to this file')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='kill galfit runs after this many seconds')
+    parser.add_argument('-i', '--max-iterations', type=int, default=None,
+                        help='kill galfit runs past this many iterations')
+    parser.add_argument('-c', '--cutout', action='store_true',
+                        help='run galfit on cutouts of the fitting box instead of the full image')
+    args = parser.parse_args()
+
+    path_to_galfit, path_to_output, galfit_output = get_paths()
+    entries = read_manifest(args.manifest)
+    summaries = run_batch(entries, path_to_galfit, path_to_output, args.workers,
+                          args.timeout, args.max_iterations, args.cutout)
+
+    failed = [summary for summary in summaries if not summary['sersic']]
+    print(f'\n{len(summaries) - len(failed)}/{len(summaries)} targets fitted\n')
+    for summary in failed:
+        print('-', summary['target'], summary['error'] or 'galfit failed')
+    if args.summary is not None:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(summaries, summary_file, indent=4)
+    sys.exit(1 if failed else 0)
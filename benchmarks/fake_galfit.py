@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Stand-in galfit executable for benchmarking and testing the wrapper
+# Author: Paxson Swierc & Daniel Babnigg
+#
+# Usage is the same as galfit: fake_galfit.py [-o1|-o2|-o3] feedme
+# Reads the feedme, prints iteration lines, and writes a 4 extension output
+# (empty, input, model, residual) whose model header carries FLAGS, COMP_N
+# and N_PARAM keywords, plus a galfit.NN config in the working directory.
+# No fitting is done: the initial parameters are echoed back.
+#
+# Behaviour is set through environment variables:
+#   FAKE_GALFIT_DELAY       total seconds to spend "fitting" (default 0)
+#   FAKE_GALFIT_ITERATIONS  number of iteration lines printed (default 5)
+#   FAKE_GALFIT_FLAGS       FLAGS header value (default '2' plus the flags
+#                           galfit raises for missing inputs and headers)
+#   FAKE_GALFIT_FAIL        failure mode: crash (exit 1, no output),
+#                           nofit (output fits but no galfit.NN), corrupt
+#                           (truncated output fits), hang (never finishes)
+#   FAKE_GALFIT_FAIL_RATE   probability (0-1) of applying the failure mode,
+#                           default 1 when a mode is set
+#   FAKE_GALFIT_SEED        seed for FAIL_RATE draws
+
+import os
+import sys
+import time
+import glob
+import random
+import numpy as np
+from astropy.io import fits
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from galfit_config import GalfitConfig
+from synthetic import add_sersic, add_moffat, PSF_FWHM
+
+# Header keywords written for each component parameter
+HEADER_PARAMS = {'sersic': {'3': 'MAG', '4': 'RE', '5': 'N', '9': 'AR', '10': 'PA'},
+                 'moffat': {'3': 'MAG', '4': 'FWHM', '5': 'C', '9': 'AR', '10': 'PA'},
+                 'psf': {'3': 'MAG'},
+                 'sky': {'1': 'SKY', '2': 'DSDX', '3': 'DSDY'}}
+
+def header_value(param, i: int =0) -> str:
+    '''
+    Formats parameter as galfit does in output headers: fixed values in [],
+    free values with an error
+    '''
+    value = param.value(i)
+    free = param.free()
+    if free and not free[min(i, len(free) - 1)]:
+        return f'[{value:.4f}]'
+    return f'{value:.4f} +/- {abs(value) * 0.001 + 0.0001:.4f}'
+
+def next_config_name(directory: str) -> str:
+    '''
+    Returns: next unused galfit.NN path, as galfit numbers its output configs
+    '''
+    numbers = [int(os.path.basename(path)[7:]) for path in glob.glob(os.path.join(directory, 'galfit.[0-9][0-9]*'))
+               if os.path.basename(path)[7:].isdigit()]
+    return os.path.join(directory, f'galfit.{max(numbers, default=0) + 1:02d}')
+
+def render_model(config: GalfitConfig, box: tuple[int, int, int, int], zero_point: float) -> np.ndarray:
+    '''
+    Renders config components over the fitting box
+
+    Args:
+        config: parsed feedme
+        box: fitting box (xmin, xmax, ymin, ymax), 1-indexed inclusive
+        zero_point: magnitude zero point
+
+    Returns: model image of fitting box
+    '''
+    xmin, xmax, ymin, ymax = box
+    model = np.zeros((ymax - ymin + 1, xmax - xmin + 1), dtype=np.float32)
+    for component in config.components:
+        if component.type == 'sky' and '1' in component:
+            model += component['1'].value()
+        if '1' not in component or '3' not in component:
+            continue
+        x = component['1'].value(0) - xmin + 1
+        y = component['1'].value(1) - ymin + 1
+        total = 10**(-0.4 * (component['3'].value() - zero_point))
+        if component.type == 'sersic':
+            add_sersic(model, x, y, max(component['4'].value(), 0.5), max(component['5'].value(), 0.3),
+                       min(max(component['9'].value(), 0.05), 1), component['10'].value(), total)
+        elif component.type == 'moffat':
+            add_moffat(model, x, y, total, max(component['4'].value(), 0.5))
+        elif component.type == 'psf':
+            add_moffat(model, x, y, total, PSF_FWHM)
+    return model
+
+def main(argv: list[str]) -> int:
+    options = [arg for arg in argv if arg.startswith('-')]
+    files = [arg for arg in argv if not arg.startswith('-')]
+    if not files:
+        print('Usage: fake_galfit.py [-o1|-o2|-o3] feedme')
+        return 1
+    feedme = files[0]
+
+    fail = os.environ.get('FAKE_GALFIT_FAIL')
+    if fail:
+        rng = random.Random(os.environ.get('FAKE_GALFIT_SEED'))
+        if rng.random() >= float(os.environ.get('FAKE_GALFIT_FAIL_RATE', 1)):
+            fail = None
+    delay = float(os.environ.get('FAKE_GALFIT_DELAY', 0))
+    iterations = int(os.environ.get('FAKE_GALFIT_ITERATIONS', 5))
+
+    config = GalfitConfig.read(feedme)
+    print(f'\n-- fake galfit -- reading {feedme}\n', flush=True)
+    if fail == 'crash':
+        print('Segmentation fault', flush=True)
+        return 1
+
+    # Print progress as galfit does
+    chi2nu = 10.0
+    for iteration in range(1, iterations + 1):
+        if fail == 'hang':
+            iteration = 1
+        time.sleep(delay / max(iterations, 1))
+        previous, chi2nu = chi2nu, 1 + (chi2nu - 1) * 0.5
+        print(f'Iteration : {iteration:<5} Chi2nu: {chi2nu:.3e}     '
+              f'dChi2/Chi2: {(chi2nu - previous) / previous:.2e}    alamda: 1e-03', flush=True)
+    while fail == 'hang':
+        time.sleep(1)
+
+    # Fitting box and input data
+    xmin, xmax, ymin, ymax = [int(value) for value in config.header['H'].values[:4]]
+    zero_point = config.header['J'].value() if 'J' in config.header else 0.0
+    flags = []
+    input_file = ' '.join(config.header['A'].values)
+    if os.path.exists(input_file):
+        with fits.open(input_file) as hdulist:
+            data = np.asarray(hdulist[0].section[ymin - 1:ymax, xmin - 1:xmax], dtype=np.float32)
+            input_header = hdulist[0].header
+            if 'EXPTIME' not in input_header:
+                flags.append('H-1')
+            if 'GAIN' not in input_header:
+                flags.append('H-3')
+            if 'NCOMBINE' not in input_header:
+                flags.append('H-4')
+    else:
+        flags.append('A-1')
+        data = np.zeros((ymax - ymin + 1, xmax - xmin + 1), dtype=np.float32)
+    for key, flag in [('D', 'A-2'), ('F', 'A-4'), ('G', 'A-6')]:
+        if key not in config.header or not os.path.exists(' '.join(config.header[key].values)):
+            flags.append(flag)
+    model = render_model(config, (xmin, xmax, ymin, ymax), zero_point)
+
+    header = fits.Header()
+    header['OBJECT'] = os.path.basename(input_file)
+    header['INITFILE'] = os.path.basename(feedme)
+    header['DATAIN'] = input_file
+    header['PSF'] = ' '.join(config.header['D'].values) if 'D' in config.header else 'none'
+    header['CONSTRNT'] = ' '.join(config.header['G'].values) if 'G' in config.header else 'none'
+    header['MASK'] = ' '.join(config.header['F'].values) if 'F' in config.header else 'none'
+    header['FITSECT'] = f'[{xmin}:{xmax},{ymin}:{ymax}]'
+    header['CONVBOX'] = ','.join(config.header['I'].values[:2]) if 'I' in config.header else ''
+    header['MAGZPT'] = zero_point
+    for number, component in enumerate(config.components, 1):
+        header[f'COMP_{number}'] = component.type
+        if '1' in component and component.type != 'sky':
+            header[f'{number}_XC'] = header_value(component['1'], 0)
+            header[f'{number}_YC'] = header_value(component['1'], 1)
+        for key, name in HEADER_PARAMS.get(component.type, {}).items():
+            if key in component:
+                header[f'{number}_{name}'] = header_value(component[key])
+    header['CHI2NU'] = chi2nu
+    header['NITER'] = iterations
+    header['FLAGS'] = os.environ.get('FAKE_GALFIT_FLAGS', ' '.join(['2'] + flags))
+
+    # -o1 writes only the model image. Runs with -o options write no galfit.NN
+    output_file = ' '.join(config.header['B'].values)
+    if '-o1' in options:
+        hdulist = fits.HDUList([fits.PrimaryHDU(model, header=header)])
+    else:
+        hdulist = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data, name='INPUT_'),
+                                fits.ImageHDU(model, header=header, name='MODEL_'),
+                                fits.ImageHDU(data - model, name='RESIDUAL')])
+    hdulist.writeto(output_file, overwrite=True)
+    if fail == 'corrupt':
+        with open(output_file, 'r+b') as output:
+            output.truncate(os.path.getsize(output_file) // 2)
+    if fail in ['nofit', 'corrupt'] or options:
+        return 0
+
+    # Output config, written in the working directory
+    lines = ['\n', '#  Input menu file: ' + os.path.basename(feedme) + '\n',
+             f'#  Chi^2/nu = {chi2nu:.3f},  Chi^2 = {chi2nu * data.size:.3f},  Ndof = {data.size}\n',
+             '\n'] + config.lines
+    with open(next_config_name(os.getcwd()), 'w') as output_config:
+        output_config.writelines(lines)
+    print(f'\nFit summary is now being saved into `fit.log\'.\n', flush=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
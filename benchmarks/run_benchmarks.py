@@ -0,0 +1,266 @@
+# Benchmarks of galfit wrapper config generation, parsing and masking
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+import subprocess
+import tracemalloc
+import numpy as np
+from astropy.io import fits
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from psf import PSF
+from sersic import Sersic
+from display import Display
+from galfit_run import GalfitRun
+from region_to_config import input_to_galfit
+from detection import find_stars, find_sources
+from synthetic import make_target, make_psf_model, make_galfit_output, ZERO_POINT
+
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, 'baselines')
+# Stand-in galfit, so wrapper overhead can be timed without the real binary
+FAKE_GALFIT = os.path.join(BENCHMARK_DIR, 'fake_galfit.py')
+# Image sizes in pixels and region counts benchmarked
+SIZES = [256, 1024, 4096]
+REGION_COUNTS = [4, 32, 128]
+# Slowdown ratio reported as a regression by compare
+THRESHOLD = 1.25
+
+class NullDS9():
+    '''
+    Stands in for pyds9.DS9, so ds9 round trips are not timed
+    '''
+    def set(self, command: str, data=None) -> int:
+        return 1
+
+    def get(self, command: str) -> str:
+        return ''
+
+class Case():
+    '''
+    Class for a single benchmark case.
+
+    Attributes:
+        name: unique name of case, e.g. 'input_to_galfit/1024px/32reg'
+        run: function timed, called with no arguments
+        setup: function called before each repeat, outside of timing
+    '''
+    def __init__(self, name: str, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+def make_cases(work_dir: str, sizes: list[int], region_counts: list[int]) -> list[Case]:
+    '''
+    Generates synthetic targets in work_dir and builds benchmark cases for
+    every image size and region count
+
+    Args:
+        work_dir: scratch directory for targets and outputs
+        sizes: image sizes in pixels
+        region_counts: numbers of sources placed
+
+    Returns: list of cases
+    '''
+    cases = []
+    psf_model = os.path.join(work_dir, 'psf_model.fits')
+    make_psf_model(psf_model)
+    for size in sizes:
+        for count in region_counts:
+            label = f'{size}px/{count}reg'
+            target_dir = os.path.join(work_dir, f'{size}_{count}') + os.sep
+            os.makedirs(target_dir)
+            target = target_dir + 'target.fits'
+            regions = make_target(target, size, count, seed=size + count)
+            config = target_dir + 'target_config.txt'
+            output = target_dir + 'target_model.fits'
+            mask = target_dir + 'target_mask.fits'
+
+            def galfit_config(target=target, regions=regions, config=config,
+                              output=output, mask=mask):
+                input_to_galfit(target, False, regions['regions'], ZERO_POINT,
+                                config, output, mask, psf_model, False, False,
+                                False, [0]*4, 'none', [], None)
+            cases.append(Case(f'input_to_galfit/{label}', galfit_config))
+            galfit_config()
+
+            psf = PSF('?', target, target_dir, 'galfit', 'target', ZERO_POINT,
+                      model_file=psf_model)
+            sersic = Sersic('?', target, target_dir, 'galfit', 'target', ZERO_POINT,
+                            config, output, mask, None, psf)
+            # Fake galfit output for header readers
+            types = ['sky'] + ['psf'] * max(count // 4, 1) + ['sersic'] * (count - max(count // 4, 1))
+            make_galfit_output(output, (size, size), types)
+            cases.append(Case(f'config_to_region/{label}',
+                              lambda sersic=sersic: sersic.config_to_region(Display(NullDS9()))))
+            # add_constraint rewrites the config, so restore it each repeat
+            with open(config) as config_file:
+                config_text = config_file.read()
+            def restore(config=config, config_text=config_text):
+                with open(config, 'w') as config_file:
+                    config_file.write(config_text)
+            cases.append(Case(f'add_constraint/{label}', sersic.add_constraint, restore))
+
+            def flags(sersic=sersic):
+                with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                    sersic.flags()
+            cases.append(Case(f'sersic_flags/{label}', flags))
+            if count == region_counts[0]:
+                psf_output = target_dir + 'target_psf.fits'
+                make_galfit_output(psf_output, (size, size), ['sky', 'moffat'])
+                psf.config_output_file = psf_output
+                cases.append(Case(f'psf_fwhm/{size}px', psf.fwhm))
+                # Full galfit run through the wrapper, cache disabled
+                def galfit_run(config=config, target_dir=target_dir):
+                    run = GalfitRun(FAKE_GALFIT, config, target_dir, use_cache=False, quiet=True)
+                    run.run()
+                    run.cleanup()
+                cases.append(Case(f'galfit_run/{size}px', galfit_run))
+                data = fits.getdata(target)
+                cases.append(Case(f'find_stars/{size}px', lambda data=data: find_stars(data, 5)))
+                cases.append(Case(f'find_sources/{size}px', lambda data=data: find_sources(data)))
+                # Blank fitting boxes must give no sources, not fail
+                noise = np.random.default_rng(size).normal(100, 5, (size, size))
+                cases.append(Case(f'find_sources_noise/{size}px', lambda noise=noise: find_sources(noise)))
+    return cases
+
+def measure(case: Case, repeats: int) -> dict:
+    '''
+    Times case over repeats, then runs it once more under tracemalloc for
+    peak python/numpy memory. Memory is measured separately since tracing
+    slows the run down
+
+    Args:
+        case: benchmark case
+        repeats: number of timed repeats
+
+    Returns: dict of timings in seconds and peak memory in bytes
+    '''
+    times = []
+    for _ in range(repeats):
+        if case.setup is not None:
+            case.setup()
+        start = time.perf_counter()
+        case.run()
+        times.append(time.perf_counter() - start)
+    if case.setup is not None:
+        case.setup()
+    tracemalloc.start()
+    case.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'median_s': statistics.median(times), 'min_s': min(times),
+            'max_s': max(times), 'repeats': repeats, 'peak_bytes': peak}
+
+def environment() -> dict:
+    '''
+    Returns: details of machine and code version for baseline
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=BENCHMARK_DIR, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    import astropy
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit or None,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'astropy': astropy.__version__, 'machine': platform.platform(),
+            'cpus': os.cpu_count()}
+
+def run(sizes: list[int], region_counts: list[int], repeats: int,
+        filter: str|None =None) -> dict:
+    '''
+    Runs all benchmark cases on freshly generated targets
+
+    Args:
+        sizes: image sizes in pixels
+        region_counts: numbers of sources placed
+        repeats: number of timed repeats per case
+        filter: only run cases whose name contains this
+
+    Returns: baseline dict with environment and results by case name
+    '''
+    work_dir = tempfile.mkdtemp(prefix='gf_bench_')
+    try:
+        cases = make_cases(work_dir, sizes, region_counts)
+        results = {}
+        for case in cases:
+            if filter is not None and filter not in case.name:
+                continue
+            results[case.name] = measure(case, repeats)
+            print(f"{case.name:<40} {results[case.name]['median_s']*1000:>10.2f} ms "
+                  f"{results[case.name]['peak_bytes']/1024**2:>9.2f} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'environment': environment(), 'results': results}
+
+def compare(baseline: dict, current: dict, threshold: float =THRESHOLD) -> list[str]:
+    '''
+    Prints time and memory ratios of current results against a baseline
+
+    Args:
+        baseline: baseline dict loaded from JSON
+        current: baseline dict of current run
+        threshold: ratio above which a case counts as a regression
+
+    Returns: names of regressed cases
+    '''
+    regressions = []
+    print(f"\n{'case':<40} {'time':>8} {'memory':>8}   (current / baseline "
+          f"{baseline['environment'].get('commit')})")
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print(f'{name:<40} {"new":>8}')
+            continue
+        old = baseline['results'][name]
+        time_ratio = result['median_s'] / old['median_s'] if old['median_s'] else float('inf')
+        memory_ratio = result['peak_bytes'] / old['peak_bytes'] if old['peak_bytes'] else 1.0
+        regressed = time_ratio > threshold or memory_ratio > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<40} {time_ratio:>7.2f}x {memory_ratio:>7.2f}x{'   REGRESSION' if regressed else ''}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark galfit wrapper on synthetic targets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='image sizes in pixels')
+    parser.add_argument('--regions', type=int, nargs='+', default=REGION_COUNTS,
+                        help='numbers of sources placed')
+    parser.add_argument('--repeats', type=int, default=5, help='timed repeats per case')
+    parser.add_argument('--filter', default=None, help='only run cases containing this')
+    parser.add_argument('--save', default=None,
+                        help='save results as baseline with this name in benchmarks/baselines/')
+    parser.add_argument('--compare', default=None,
+                        help='baseline name or JSON path to compare results against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown ratio reported as regression')
+    args = parser.parse_args()
+
+    current = run(args.sizes, args.regions, args.repeats, args.filter)
+    if args.save is not None:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        baseline_file = os.path.join(BASELINE_DIR, args.save + '.json')
+        with open(baseline_file, 'w') as baseline:
+            json.dump(current, baseline, indent=4)
+        print(f'\nSaved baseline to {baseline_file}')
+    if args.compare is not None:
+        baseline_file = args.compare
+        if not os.path.exists(baseline_file):
+            baseline_file = os.path.join(BASELINE_DIR, args.compare + '.json')
+        with open(baseline_file) as baseline:
+            regressions = compare(json.load(baseline), current, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) past {args.threshold}x')
+            sys.exit(1)
@@ -0,0 +1,139 @@
+# Startup time budget check for galfit wrapper
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Seconds from interpreter launch to the TUI being ready for a command
+STARTUP_BUDGET = 0.5
+# Modules that must not be loaded at startup, or by headless commands
+GUI_MODULES = ['pyds9', 'tkinter']
+HEAVY_MODULES = GUI_MODULES + ['astropy', 'pyregion', 'numpy']
+
+# Runs what galfit_wrapper.py does before its first prompt, then optionally
+# a headless command, and reports time and which modules got loaded
+STARTUP_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {repo!r})
+from galfit_wrapper import PSF, Sersic, JobQueue
+from utils import init_target, saved_files, read_zero_point
+target_path, target_filename, output_dir = init_target({target!r}, {output!r})
+saved = saved_files(output_dir, target_filename)
+psf = PSF('?', target_path, output_dir, 'galfit', target_filename, read_zero_point(output_dir),
+          saved['psf_config_file'], saved['psf_config_output_file'], saved['psf_model_file'],
+          saved['psf_mask'])
+sersic = Sersic('?', target_path, output_dir, 'galfit', target_filename, read_zero_point(output_dir),
+                saved['sersic_config_file'], saved['sersic_config_output_file'], saved['sersic_mask'],
+                saved['sersic_constraint'], psf)
+ready = time.perf_counter() - start
+startup_modules = sorted(set(name.split('.')[0] for name in sys.modules))
+{command}
+print(json.dumps({{'ready': ready, 'startup_modules': startup_modules,
+                  'modules': sorted(set(name.split('.')[0] for name in sys.modules))}}))
+'''
+
+# Headless commands checked for GUI imports, as run from the TUI
+HEADLESS_COMMANDS = {'psf flags': 'psf.flags()',
+                     'sersic flags': 'sersic.flags()',
+                     'convolution box': 'psf.convolution_box()'}
+
+def make_target(work_dir: str) -> tuple[str, str]:
+    '''
+    Writes a small target with saved psf and sersic outputs, so headless
+    commands have something to read
+
+    Args:
+        work_dir: scratch directory
+
+    Returns: path to target fits, root output directory
+    '''
+    from synthetic import make_target, make_galfit_output
+    target = os.path.join(work_dir, 'startup.fits')
+    make_target(target, 64, 2)
+    output = os.path.join(work_dir, 'gf_out', '')
+    target_dir = os.path.join(output, 'startup', '')
+    os.makedirs(target_dir)
+    with open(target_dir + 'zero_point.txt', 'w') as zero_point:
+        zero_point.write('30.0')
+    make_galfit_output(target_dir + 'startup_psf.fits', (64, 64), ['sky', 'moffat'])
+    make_galfit_output(target_dir + 'startup_model.fits', (64, 64), ['sky', 'sersic'])
+    return target, output
+
+def run_startup(target: str, output: str, command: str ='') -> dict:
+    '''
+    Runs wrapper startup (and a command) in a fresh interpreter
+
+    Returns: dict with wall time of whole process and loaded modules
+    '''
+    script = STARTUP_SCRIPT.format(repo=REPO_DIR, target=target, output=output,
+                                   command=command)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True,
+                            text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit('FAIL wrapper could not start')
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['wall'] = wall
+    return report
+
+def check_startup(target: str, output: str, budget: float =STARTUP_BUDGET,
+                  repeats: int =5) -> list[str]:
+    '''
+    Times wrapper startup against the budget, and checks that startup loads
+    none of HEAVY_MODULES and headless commands load no GUI modules
+
+    Args:
+        target: path to target fits, from make_target
+        output: root output directory, from make_target
+        budget: seconds allowed from launch to ready for a command
+        repeats: startups timed, the median is checked
+
+    Returns: list of failures, empty if all checks pass
+    '''
+    failures = []
+    reports = [run_startup(target, output) for _ in range(repeats)]
+    wall = statistics.median(report['wall'] for report in reports)
+    print(f'startup: {wall:.3f}s median wall time over {repeats} runs '
+          f'(budget {budget:.3f}s)')
+    if wall > budget:
+        failures.append(f'startup took {wall:.3f}s, over budget of {budget:.3f}s')
+    loaded = [module for module in HEAVY_MODULES if module in reports[0]['startup_modules']]
+    if loaded:
+        failures.append('startup imports ' + ', '.join(loaded))
+    for name, command in HEADLESS_COMMANDS.items():
+        report = run_startup(target, output, command)
+        loaded = [module for module in GUI_MODULES + ['pyregion'] if module in report['modules']]
+        print(f'{name}: {report["wall"]:.3f}s')
+        if loaded:
+            failures.append(f'{name} imports ' + ', '.join(loaded))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check galfit wrapper startup time and imports')
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                        help='seconds allowed from launch to ready for a command')
+    parser.add_argument('--repeats', type=int, default=5, help='startups timed')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='gf_startup_')
+    try:
+        failures = check_startup(*make_target(work_dir), args.budget, args.repeats)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for failure in failures:
+        print('FAIL', failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,193 @@
+# Synthetic galfit wrapper targets for benchmarks
+# Author: Paxson Swierc & Daniel Babnigg
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+# DECam-like pixel scale in arcsec
+PIXEL_SCALE = 0.262
+ZERO_POINT = 30.0
+# Moffat parameters of synthetic psf
+PSF_FWHM = 4.0
+PSF_BETA = 2.5
+
+def make_wcs(size: int) -> WCS:
+    '''
+    Gets simple TAN wcs centered on image
+
+    Args:
+        size: image width and height in pixels
+
+    Returns: astropy WCS
+    '''
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [62.0, -53.5]
+    wcs.wcs.crpix = [size / 2, size / 2]
+    wcs.wcs.cdelt = [-PIXEL_SCALE / 3600, PIXEL_SCALE / 3600]
+    return wcs
+
+def add_sersic(image: np.ndarray, x: float, y: float, re: float, n: float,
+               q: float, angle: float, total: float) -> None:
+    '''
+    Adds sersic profile to image in place, rendered over a stamp of 8 Re.
+    Angle is in degrees counterclockwise from +y, as galfit uses
+
+    Args:
+        image: image to add to
+        x, y: center in pixels (1-indexed)
+        re: effective radius in pixels
+        n: sersic index
+        q: axis ratio
+        angle: position angle in degrees
+        total: approximate total flux
+
+    Returns: Nothing
+    '''
+    half = int(8 * re) + 1
+    x0, x1 = max(int(x) - half, 0), min(int(x) + half, image.shape[1])
+    y0, y1 = max(int(y) - half, 0), min(int(y) + half, image.shape[0])
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    dx, dy = xx + 1 - x, yy + 1 - y
+    theta = np.radians(angle)
+    major = -dx * np.sin(theta) + dy * np.cos(theta)
+    minor = dx * np.cos(theta) + dy * np.sin(theta)
+    r = np.sqrt(major**2 + (minor / q)**2)
+    bn = 2 * n - 1 / 3 + 4 / (405 * n)
+    profile = np.exp(-bn * ((r / re)**(1 / n) - 1))
+    image[y0:y1, x0:x1] += total * profile / profile.sum()
+
+def add_moffat(image: np.ndarray, x: float, y: float, total: float,
+               fwhm: float =PSF_FWHM, beta: float =PSF_BETA) -> None:
+    '''
+    Adds circular moffat profile to image in place, rendered over a stamp of
+    10 FWHM
+
+    Args:
+        image: image to add to
+        x, y: center in pixels (1-indexed)
+        total: approximate total flux
+        fwhm: full width at half maximum in pixels
+        beta: moffat power law
+
+    Returns: Nothing
+    '''
+    alpha = fwhm / (2 * np.sqrt(2**(1 / beta) - 1))
+    half = int(5 * fwhm) + 1
+    x0, x1 = max(int(x) - half, 0), min(int(x) + half, image.shape[1])
+    y0, y1 = max(int(y) - half, 0), min(int(y) + half, image.shape[0])
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    r2 = (xx + 1 - x)**2 + (yy + 1 - y)**2
+    profile = (1 + r2 / alpha**2)**-beta
+    image[y0:y1, x0:x1] += total * profile / profile.sum()
+
+def make_target(fits_file: str, size: int, n_sources: int, seed: int =0) -> dict:
+    '''
+    Writes synthetic target with sersic galaxies, moffat stars, sky and
+    noise, plus the ds9 regions a user would place on it
+
+    Args:
+        fits_file: path to write target fits to
+        size: image width and height in pixels
+        n_sources: number of galaxies plus stars
+        seed: random seed
+
+    Returns: dict with regions (galaxies, stars, excluded regions and box),
+             psf_regions (circle on brightest star and box) and the source
+             list
+    '''
+    rng = np.random.default_rng(seed)
+    image = np.full((size, size), 100.0, dtype=np.float32)
+    sources = []
+    n_stars = max(n_sources // 4, 1)
+    margin = min(40, size // 8)
+    for i in range(n_sources):
+        x, y = rng.uniform(margin, size - margin, 2)
+        if i < n_stars:
+            total = 10**rng.uniform(4, 5.5)
+            add_moffat(image, x, y, total)
+            sources.append({'type': 'star', 'x': x, 'y': y, 'flux': total})
+        else:
+            re, n = rng.uniform(2, 12), rng.uniform(0.6, 4)
+            q, angle = rng.uniform(0.3, 1), rng.uniform(0, 180)
+            total = 10**rng.uniform(4, 6)
+            add_sersic(image, x, y, re, n, q, angle, total)
+            sources.append({'type': 'galaxy', 'x': x, 'y': y, 're': re,
+                            'n': n, 'q': q, 'angle': angle, 'flux': total})
+    image += rng.normal(0, 5, image.shape).astype(np.float32)
+
+    header = make_wcs(size).to_header()
+    header['EXPTIME'] = 1.0
+    header['GAIN'] = 1.0
+    fits.writeto(fits_file, image, header, overwrite=True)
+
+    regions = ['# Region file format: DS9 version 4.1', 'image']
+    for i, source in enumerate(sources):
+        if source['type'] == 'star':
+            regions.append(f"point({source['x']:.2f},{source['y']:.2f}) # point=x")
+        else:
+            a = 2 * source['re']
+            # ds9 angle is counterclockwise from +x
+            regions.append(f"ellipse({source['x']:.2f},{source['y']:.2f},{a:.2f},"
+                           f"{a * source['q']:.2f},{(source['angle'] + 90) % 360:.2f})")
+        # exclude a spot near every other source
+        if i % 2:
+            regions.append(f"-circle({source['x'] + 15:.2f},{source['y'] + 15:.2f},6)")
+    regions.append(f'box({size / 2:.1f},{size / 2:.1f},{size - 2 * margin},{size - 2 * margin},0)')
+
+    star = max((source for source in sources if source['type'] == 'star'),
+               key=lambda source: source['flux'])
+    psf_regions = ['# Region file format: DS9 version 4.1', 'image',
+                   f"circle({star['x']:.2f},{star['y']:.2f},{PSF_FWHM:.1f})",
+                   f"box({star['x']:.2f},{star['y']:.2f},{10 * PSF_FWHM},{10 * PSF_FWHM},0)"]
+
+    return {'regions': '\n'.join(regions), 'psf_regions': '\n'.join(psf_regions),
+            'sources': sources}
+
+def make_psf_model(fits_file: str, fwhm: float =PSF_FWHM, radius: int =25) -> None:
+    '''
+    Writes normalised moffat psf model stamp
+
+    Args:
+        fits_file: path to write psf model to
+        fwhm: full width at half maximum in pixels
+        radius: half-width of stamp in pixels
+
+    Returns: Nothing
+    '''
+    stamp = np.zeros((2 * radius + 1, 2 * radius + 1))
+    add_moffat(stamp, radius + 1, radius + 1, 1.0, fwhm)
+    fits.writeto(fits_file, stamp / stamp.sum(), overwrite=True)
+
+def make_galfit_output(fits_file: str, shape: tuple[int, int], components: list[str],
+                       flags: str ='2 A-4 H-4') -> None:
+    '''
+    Writes galfit-like 4 extension output (empty, input, model, residual)
+    with the header keywords the wrapper reads
+
+    Args:
+        fits_file: path to write output to
+        shape: (y, x) shape of image extensions
+        components: galfit component types in order, e.g. ['sky', 'sersic']
+        flags: galfit FLAGS header value
+
+    Returns: Nothing
+    '''
+    header = fits.Header()
+    header['FLAGS'] = flags
+    for number, component in enumerate(components, 1):
+        header[f'COMP_{number}'] = component
+        if component in ['sersic', 'psf', 'moffat']:
+            header[f'{number}_XC'] = '50.0000 +/- 0.0100'
+            header[f'{number}_YC'] = '50.0000 +/- 0.0100'
+            header[f'{number}_MAG'] = '18.1234 +/- 0.0123'
+        if component == 'moffat':
+            header[f'{number}_FWHM'] = f'{PSF_FWHM:.4f} +/- 0.0100'
+        if component == 'sersic':
+            header[f'{number}_RE'] = '*5.2000* +/- 0.1000'
+            header[f'{number}_N'] = '[1.0000]'
+    data = np.zeros(shape, dtype=np.float32)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data),
+                  fits.ImageHDU(data, header=header),
+                  fits.ImageHDU(data)]).writeto(fits_file, overwrite=True)
@@ -0,0 +1,165 @@
+# Catalog export of fitted galfit parameters across all targets
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import workspace_index
+# astropy is imported where used, and pyarrow only for parquet output
+
+# Galfit output artifact read for each stage
+STAGE_ARTIFACTS = {'sersic': 'sersic_config_output_file',
+                   'psf': 'psf_config_output_file'}
+# Fit-wide header keywords exported with every component
+FIT_KEYWORDS = ['CHI2NU', 'CHISQ', 'NDOF', 'NFREE', 'NFIX', 'NITER', 'MAGZPT',
+                'FITSECT', 'CONVBOX', 'PSF', 'MASK', 'CONSTRNT', 'FLAGS']
+# Threads reading headers, since NFS reads are latency bound
+WORKERS = 16
+
+def parse_value(text: str) -> tuple[float|None, float|None, bool, bool]:
+    '''
+    Parses a galfit output header value such as '19.92 +/- 0.01'. Galfit
+    puts fixed values in [] and wraps values with problems (e.g. hitting a
+    constraint or numerical trouble) in *
+
+    Args:
+        text: header value
+
+    Returns: value, error (None if fixed or missing), fixed, problem
+    '''
+    text = str(text)
+    fixed = '[' in text
+    problem = '*' in text
+    parts = text.replace('[', '').replace(']', '').replace('*', '').split('+/-')
+    try:
+        value = float(parts[0])
+    except ValueError:
+        value = None
+    try:
+        error = float(parts[1]) if len(parts) > 1 else None
+    except ValueError:
+        error = None
+    return value, error, fixed, problem
+
+def find_models(path_to_output: str, stage: str ='sersic') -> list[tuple[str, str|None, str]]:
+    '''
+    Finds saved galfit outputs of every target, from the workspace index if
+    there is one, otherwise from each target's manifest
+
+    Args:
+        path_to_output: root output directory (~/gf_out/)
+        stage: 'sersic' or 'psf'
+
+    Returns: list of (target, band, galfit output path)
+    '''
+    artifact = STAGE_ARTIFACTS[stage]
+    if os.path.exists(workspace_index.index_path(path_to_output)):
+        _, rows = workspace_index.query(
+            path_to_output, 'SELECT a.target, t.band, a.path FROM artifacts a JOIN targets t '
+            'ON t.name = a.target WHERE a.name = ? ORDER BY a.target', [artifact])
+        return rows
+    from manifest import Manifest
+    models = []
+    for output_dir, target_filename in workspace_index.target_dirs(path_to_output):
+        data = Manifest(output_dir, target_filename).load()
+        if artifact in data['artifacts']:
+            models.append((target_filename, data.get('band'), data['artifacts'][artifact]['path']))
+    return models
+
+def read_model(target: str, band: str|None, path: str) -> list[dict]:
+    '''
+    Reads fitted parameters of each component from the model header of a
+    galfit output. Only headers are read, never pixel data
+
+    Args:
+        target: target filename
+        band: band of target
+        path: galfit output fits file
+
+    Returns: one row per component, with value, error, fixed and problem
+             columns per parameter
+    '''
+    from astropy.io import fits
+    try:
+        header = fits.getheader(path, 2)
+    except (OSError, IndexError) as error:
+        print(f'Skipping {path}: {error}')
+        return []
+    fit = {'target': target, 'band': band, 'file': path}
+    for keyword in FIT_KEYWORDS:
+        value = header.get(keyword)
+        if isinstance(value, str) and keyword not in ['FLAGS', 'FITSECT', 'CONVBOX']:
+            value = value.strip()
+        fit[keyword.lower()] = value
+    rows = []
+    for key in header:
+        if not key.startswith('COMP_'):
+            continue
+        number = key[5:]
+        row = dict(fit, component=int(number), type=str(header[key]).strip())
+        prefix = number + '_'
+        for param_key in header:
+            if not param_key.startswith(prefix):
+                continue
+            param = param_key[len(prefix):].lower()
+            value, error, fixed, problem = parse_value(header[param_key])
+            row[param] = value
+            row[param + '_err'] = error
+            row[param + '_fixed'] = fixed
+            row[param + '_problem'] = problem
+        rows.append(row)
+    return rows
+
+def export(path_to_output: str, output_file: str, stage: str ='sersic',
+           workers: int =WORKERS) -> int:
+    '''
+    Writes one catalog of fitted parameters for every target in the
+    workspace, one row per component. Headers are read concurrently.
+    Output is parquet if output_file ends in .parquet, CSV otherwise
+
+    Args:
+        path_to_output: root output directory (~/gf_out/)
+        output_file: catalog path
+        stage: 'sersic' or 'psf'
+        workers: threads reading headers
+
+    Returns: number of rows written
+    '''
+    models = find_models(path_to_output, stage)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = [row for model_rows in pool.map(lambda model: read_model(*model), models)
+                for row in model_rows]
+    # Union of columns, in order first seen, so every row has every column
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    if output_file.endswith('.parquet'):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_pylist([{column: row.get(column) for column in columns}
+                                           for row in rows])
+        pyarrow.parquet.write_table(table, output_file)
+    else:
+        with open(output_file, 'w', newline='') as catalog:
+            writer = csv.DictWriter(catalog, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    return len(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export fitted galfit parameters of all targets to one catalog')
+    parser.add_argument('catalog', help='output file, .parquet (needs pyarrow) or .csv')
+    parser.add_argument('--output', default=os.path.expanduser('~/gf_out/'),
+                        help='root output directory')
+    parser.add_argument('--stage', choices=list(STAGE_ARTIFACTS), default='sersic',
+                        help='export sersic models or psf fits')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='threads reading headers')
+    args = parser.parse_args()
+
+    if args.catalog.endswith('.parquet'):
+        try:
+            import pyarrow
+        except ImportError:
+            sys.exit('Parquet output needs pyarrow (pip install pyarrow), or write a .csv instead')
+    n_rows = export(args.output, args.catalog, args.stage, args.workers)
+    print(f'Wrote {n_rows} components to {args.catalog}')
@@ -0,0 +1,199 @@
+# Cutout staging so galfit reads only the fitting box of large images
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import re
+from galfit_config import GalfitConfig
+# astropy is imported where used
+
+# Pixels of margin kept around the fitting box, on top of half the
+# convolution box, so galfit convolves with the same image pixels
+CUTOUT_MARGIN = 16
+# Cutouts larger than this fraction of the image are not worth staging
+CUTOUT_MAX_FRACTION = 0.5
+# Absolute position constraints, e.g. "2 x 100 to 140"
+POSITION_CONSTRAINT = re.compile(r'^(\s*[\d_/]+\s+)([xy])(\s+)(\S+)(\s+to\s+)(\S+)(.*)$', re.S)
+# First number in a galfit header value such as "[512.30]" or "512.30 +/- 0.05"
+HEADER_NUMBER = re.compile(r'[-+]?\d+\.?\d*(?:[eE][-+]?\d+)?')
+
+def cutout_box(config: GalfitConfig, shape: tuple[int, int]) -> tuple[int, int, int, int]:
+    '''
+    Gets cutout of image needed by a config: its fitting box plus half the
+    convolution box and CUTOUT_MARGIN, clipped to the image
+
+    Args:
+        config: galfit config
+        shape: image shape (ny, nx)
+
+    Returns: cutout (xmin, xmax, ymin, ymax), 1-indexed inclusive
+    '''
+    xmin, xmax, ymin, ymax = [int(value) for value in config.header['H'].values[:4]]
+    margin = CUTOUT_MARGIN
+    if 'I' in config.header:
+        margin += max(int(float(value)) for value in config.header['I'].values[:2]) // 2
+    ny, nx = shape
+    return max(xmin - margin, 1), min(xmax + margin, nx), max(ymin - margin, 1), min(ymax + margin, ny)
+
+def write_cutout(input_file: str, output_file: str, box: tuple[int, int, int, int]) -> None:
+    '''
+    Writes a cutout of a fits image with all its header keywords, shifting
+    the WCS reference pixel and IRAF physical offset, where present, so
+    sky coordinates are unchanged. Only the cutout is read from disk
+
+    Args:
+        input_file: fits image
+        output_file: path to write cutout to
+        box: cutout (xmin, xmax, ymin, ymax), 1-indexed inclusive
+
+    Returns: Nothing
+    '''
+    from astropy.io import fits
+    xmin, xmax, ymin, ymax = box
+    with fits.open(input_file) as hdul:
+        data = hdul[0].section[ymin-1:ymax, xmin-1:xmax]
+        header = hdul[0].header.copy()
+    for key, offset in [('CRPIX1', xmin - 1), ('CRPIX2', ymin - 1),
+                        ('LTV1', -(xmin - 1)), ('LTV2', -(ymin - 1))]:
+        if key in header:
+            header[key] -= offset
+    fits.PrimaryHDU(data, header).writeto(output_file, overwrite=True)
+
+def shift_positions(config: GalfitConfig, dx: float, dy: float) -> None:
+    '''
+    Shifts fitting box and component positions of a config by (dx, dy).
+    Sky components have no position, their 1) is the sky level
+
+    Args:
+        config: galfit config, changed in place
+        dx, dy: shift in pixels
+
+    Returns: Nothing
+    '''
+    xmin, xmax, ymin, ymax = [int(value) for value in config.header['H'].values[:4]]
+    config.set_header('H', f'{xmin + dx} {xmax + dx} {ymin + dy} {ymax + dy}')
+    for component in config.components:
+        if component.type == 'sky' or '1' not in component or len(component['1'].values) < 2:
+            continue
+        values = component['1'].values
+        config.set_param(component, '1', [f'{float(values[0]) + dx:.4f}', f'{float(values[1]) + dy:.4f}']
+                         + values[2:])
+
+def shift_constraints(constraint_file: str, output_file: str, dx: int, dy: int) -> bool:
+    '''
+    Writes a copy of a constraint file with absolute position ranges
+    ("2 x 100 to 140") shifted by (dx, dy). Relative ranges are unchanged
+
+    Args:
+        constraint_file: galfit constraint file
+        output_file: path to write shifted constraints to
+        dx, dy: shift in pixels
+
+    Returns: True if any constraint was shifted (and output_file written)
+    '''
+    with open(constraint_file) as constraints:
+        lines = constraints.readlines()
+    shifted = False
+    for i, line in enumerate(lines):
+        match = POSITION_CONSTRAINT.match(line)
+        if match is None or line.lstrip().startswith('#'):
+            continue
+        shift = dx if match.group(2) == 'x' else dy
+        try:
+            low, high = float(match.group(4)) + shift, float(match.group(6)) + shift
+        except ValueError:
+            continue
+        lines[i] = ''.join([match.group(1), match.group(2), match.group(3), f'{low:g}',
+                            match.group(5), f'{high:g}', match.group(7)])
+        shifted = True
+    if shifted:
+        with open(output_file, 'w') as constraints:
+            constraints.writelines(lines)
+    return shifted
+
+def stage_cutout(config: GalfitConfig, run_dir: str) -> tuple[int, int]|None:
+    '''
+    Points a config at cutouts of its image, sigma image and mask written
+    into run_dir, with the fitting box, component positions and absolute
+    position constraints moved into cutout pixels. Nothing is staged if
+    the cutout would not be much smaller than the image, or the mask is
+    not a fits image
+
+    Args:
+        config: galfit config to be run, changed in place
+        run_dir: galfit run directory
+
+    Returns: (dx, dy) offset of cutout in image pixels, or None if not staged
+    '''
+    from astropy.io import fits
+    image = ' '.join(config.header['A'].values)
+    header = fits.getheader(image)
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    xmin, xmax, ymin, ymax = cutout_box(config, shape)
+    if (xmax - xmin + 1) * (ymax - ymin + 1) > CUTOUT_MAX_FRACTION * shape[0] * shape[1]:
+        return None
+    files = {}
+    for key, name in [('C', 'cutout_sigma.fits'), ('F', 'cutout_mask.fits')]:
+        path = ' '.join(config.header[key].values) if key in config.header else 'none'
+        if path == 'none' or not os.path.exists(path):
+            continue
+        if not path.endswith('.fits'):
+            # Text masks list pixel coordinates, which are not translated
+            return None
+        files[key] = (path, os.path.join(run_dir, name))
+    write_cutout(image, os.path.join(run_dir, 'cutout.fits'), (xmin, xmax, ymin, ymax))
+    config.set_header('A', os.path.join(run_dir, 'cutout.fits'))
+    for key, (path, cutout) in files.items():
+        write_cutout(path, cutout, (xmin, xmax, ymin, ymax))
+        config.set_header(key, cutout)
+    dx, dy = xmin - 1, ymin - 1
+    shift_positions(config, -dx, -dy)
+    constraint = ' '.join(config.header['G'].values) if 'G' in config.header else 'none'
+    if constraint != 'none' and os.path.exists(constraint):
+        shifted = os.path.join(run_dir, 'cutout_constraint.txt')
+        if shift_constraints(constraint, shifted, -dx, -dy):
+            config.set_header('G', shifted)
+    return dx, dy
+
+def restore_output(original: GalfitConfig, offset: tuple[int, int], output_fits: str|None,
+                   output_config: str|None) -> None:
+    '''
+    Translates galfit output of a cutout run back to the full image: the
+    output config gets the original input files, fitting box and image
+    positions, and the output fits headers get image positions, fitting
+    section and input file names
+
+    Args:
+        original: config as it was before staging
+        offset: (dx, dy) returned by stage_cutout
+        output_fits: galfit output fits, if written
+        output_config: galfit output config (galfit.NN), if written
+
+    Returns: Nothing
+    '''
+    from astropy.io import fits
+    dx, dy = offset
+    if output_config is not None and os.path.exists(output_config):
+        config = GalfitConfig.read(output_config)
+        shift_positions(config, dx, dy)
+        for key in ['A', 'C', 'F', 'G']:
+            if key in config.header and key in original.header:
+                config.set_header(key, ' '.join(original.header[key].values))
+        config.write(output_config)
+    if output_fits is None or not os.path.exists(output_fits):
+        return
+    with fits.open(output_fits, mode='update') as hdul:
+        for hdu in hdul:
+            header = hdu.header
+            for key in list(header.keys()):
+                shift = dx if key.endswith('_XC') else dy if key.endswith('_YC') else None
+                if shift is not None and isinstance(header[key], str):
+                    header[key] = HEADER_NUMBER.sub(lambda match: f'{float(match.group()) + shift:.4f}',
+                                                    header[key], count=1)
+            if 'FITSECT' in header:
+                x, y = header['FITSECT'].strip('[]').split(',')
+                (x0, x1), (y0, y1) = [int(v) for v in x.split(':')], [int(v) for v in y.split(':')]
+                header['FITSECT'] = f'[{x0 + dx}:{x1 + dx},{y0 + dy}:{y1 + dy}]'
+            for key, param in [('DATAIN', 'A'), ('NOISE', 'C'), ('SIGMA', 'C'), ('MASK', 'F'),
+                               ('CONSTRNT', 'G')]:
+                if key in header and param in original.header:
+                    header[key] = ' '.join(original.header[param].values)
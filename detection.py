@@ -0,0 +1,437 @@
+# Automatic source detection for galfit wrapper
+# Author: Paxson Swierc & Daniel Babnigg
+
+import numpy as np
+# scipy is imported where used, only psf star finding and source seeding need it
+
+# Peaks must be this many background sigma above background to be psf stars
+STAR_THRESHOLD = 50.0
+# Peaks this many sigma above background count as neighbours for isolation
+NEIGHBOUR_THRESHOLD = 5.0
+# Neighbours fainter than this fraction of a star's peak do not spoil it
+CONTAMINATION = 0.01
+# Radius in pixels that must be free of neighbours, also the half-width of
+# the fitting box placed on each star
+ISOLATION = 20
+# Radius in pixels of aperture used for star shape moments
+MOMENT_RADIUS = 6
+# Roundness (1 - ellipticity) below which a peak is not a point source
+MIN_ROUNDNESS = 0.8
+# FWHM in pixels below which a peak is a cosmic ray or hot pixel
+MIN_FWHM = 1.0
+# Fractional spread in FWHM, concentration and roundness of the stellar
+# locus, the clump of round sources sharing the psf profile
+LOCUS_WIDTH = 0.05
+# Smallest fractional spread allowed around the locus, for noiseless stars
+LOCUS_SCATTER = 0.01
+# Pixels sampled to estimate background, so huge images stay fast
+BACKGROUND_SAMPLE = 10**6
+# Pixels this many background sigma above background (after smoothing)
+# belong to a source when seeding components
+SEED_THRESHOLD = 3.0
+# Sources need a peak this many background sigma above background (after
+# smoothing), so noise is not seeded
+SEED_PEAK = 10.0
+# Sigma in pixels of gaussian smoothing before segmentation, against noise
+SEED_SMOOTHING = 1.0
+# Peaks closer than this many pixels to a brighter peak are the same source
+DEBLEND_RADIUS = 5
+# Peaks must rise this many background sigma (after smoothing) above the
+# dip between them and the nearest brighter peak to be separate sources
+DEBLEND_CONTRAST = 5.0
+# Points sampled along the line between peaks to find the dip
+DEBLEND_SAMPLES = 32
+# Segments with fewer pixels are noise
+MIN_AREA = 5
+# Round sources whose peak pixel holds at least this fraction of what the
+# psf peak holds are point sources. Resolved sources are flatter than the psf
+POINT_PEAK = 0.8
+# Neighbours looked at first in nearest neighbour searches, more are looked
+# at only for points without a match among them
+NEIGHBOUR_K = 16
+# Half-light radius of a gaussian in units of its sigma, to turn second
+# moments into effective radii
+GAUSSIAN_REFF = 1.1774
+
+def background(data: np.ndarray) -> tuple[float, float]:
+    '''
+    Estimates background level and noise from a subsample of the image,
+    clipping sources once so they do not inflate the noise
+
+    Args:
+        data: image
+
+    Returns: background level, background sigma
+    '''
+    step = max(1, int(np.sqrt(data.size / BACKGROUND_SAMPLE)))
+    sample = data[::step, ::step]
+    sample = sample[np.isfinite(sample)]
+    level = np.median(sample)
+    sigma = 1.4826 * np.median(np.abs(sample - level))
+    sample = sample[np.abs(sample - level) <= 3 * sigma]
+    level = np.median(sample)
+    sigma = 1.4826 * np.median(np.abs(sample - level))
+    return float(level), float(max(sigma, np.finfo(np.float32).tiny))
+
+def local_maxima(data: np.ndarray) -> np.ndarray:
+    '''
+    Finds pixels at least as bright as all 8 neighbours
+
+    Args:
+        data: image
+
+    Returns: boolean map of local maxima
+    '''
+    padded = np.pad(data, 1, constant_values=-np.inf)
+    ny, nx = data.shape
+    is_max = np.ones(data.shape, dtype=bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                is_max &= data >= padded[1+dy:1+dy+ny, 1+dx:1+dx+nx]
+    return is_max
+
+def stamps(data: np.ndarray, ys: np.ndarray, xs: np.ndarray, radius: int) -> np.ndarray:
+    '''
+    Gathers square stamps around many pixels at once. Pixels must be at
+    least radius from the image edge
+
+    Args:
+        data: image
+        ys, xs: array indices of stamp centres
+        radius: half-width of stamps
+
+    Returns: array of stamps, shape (n, 2*radius+1, 2*radius+1)
+    '''
+    offsets = np.arange(-radius, radius + 1)
+    return data[ys[:, None, None] + offsets[None, :, None],
+                xs[:, None, None] + offsets[None, None, :]]
+
+def shapes(data: np.ndarray, ys: np.ndarray, xs: np.ndarray, level: float,
+           radius: int =MOMENT_RADIUS) -> dict[str, np.ndarray]:
+    '''
+    Measures flux, centroid, FWHM, roundness and concentration of many
+    sources at once from background subtracted second moments in a circular
+    aperture. Concentration is the fraction of flux within half the radius
+
+    Args:
+        data: image
+        ys, xs: array indices of source peaks, at least radius from edges
+        level: background level
+        radius: aperture radius in pixels
+
+    Returns: dict of arrays x, y (1-indexed centroids), flux, fwhm,
+             roundness, concentration
+    '''
+    offsets = np.arange(-radius, radius + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+    aperture = dy**2 + dx**2 <= radius**2
+    weights = np.clip(stamps(data, ys, xs, radius) - level, 0, None) * aperture
+    flux = weights.sum(axis=(1, 2))
+    core = (weights * (dy**2 + dx**2 <= radius**2 / 4)).sum(axis=(1, 2))
+    norm = np.where(flux > 0, flux, 1)
+    mx = (weights * dx).sum(axis=(1, 2)) / norm
+    my = (weights * dy).sum(axis=(1, 2)) / norm
+    mxx = (weights * dx**2).sum(axis=(1, 2)) / norm - mx**2
+    myy = (weights * dy**2).sum(axis=(1, 2)) / norm - my**2
+    mxy = (weights * dx * dy).sum(axis=(1, 2)) / norm - mx * my
+    size = np.where(mxx + myy > 0, mxx + myy, np.inf)
+    ellipticity = np.sqrt((mxx - myy)**2 + 4 * mxy**2) / size
+    return {'x': xs + mx + 1, 'y': ys + my + 1, 'flux': flux,
+            'fwhm': 2.3548 * np.sqrt(np.clip((mxx + myy) / 2, 0, None)),
+            'roundness': 1 - ellipticity, 'concentration': core / norm}
+
+def find_stars(data: np.ndarray, n: int =5, threshold: float =STAR_THRESHOLD,
+               isolation: int =ISOLATION, saturation: float|None =None,
+               min_roundness: float =MIN_ROUNDNESS) -> list[dict]:
+    '''
+    Finds bright, isolated, unsaturated point sources to fit as psf stars.
+    Peaks are local maxima far enough above background. They are dropped if
+    saturated (above the saturation level, or flat topped), too close to a
+    neighbour or the image edge, not round, or off the stellar locus (the
+    FWHM, concentration and roundness most round sources share, since stars
+    all have the psf profile while galaxies scatter). The rest are ranked by flux
+
+    Args:
+        data: image
+        n: number of stars returned
+        threshold: peak height above background, in background sigma
+        isolation: radius in pixels free of neighbours, and from image edge
+        saturation: saturation level of image (e.g. SATURATE header), if known
+        min_roundness: roundness (1 - ellipticity) of point sources
+
+    Returns: up to n stars, brightest first, as dicts with x, y (1-indexed,
+             ds9 image coordinates), peak, flux, fwhm, roundness and
+             nearest (distance to nearest neighbour)
+    '''
+    from scipy.spatial import cKDTree
+    data = np.asarray(data, dtype=np.float32)
+    level, sigma = background(data)
+    data = np.where(np.isfinite(data), data, level)
+    maxima = local_maxima(data)
+    # Neighbour peaks, and candidate stars among them away from the edges
+    ys, xs = np.nonzero(maxima & (data > level + NEIGHBOUR_THRESHOLD * sigma))
+    peaks = data[ys, xs]
+    margin = max(isolation, MOMENT_RADIUS) + 1
+    ny, nx = data.shape
+    candidate = (peaks > level + threshold * sigma) & (ys >= margin) & (ys < ny - margin) \
+                & (xs >= margin) & (xs < nx - margin)
+    if saturation is not None:
+        candidate &= peaks < saturation
+    cy, cx, cpeak = ys[candidate], xs[candidate], peaks[candidate]
+    if len(cy) == 0:
+        return []
+    # Flat topped peaks are saturated even without a known saturation level
+    flat = (stamps(data, cy, cx, 1) == cpeak[:, None, None]).sum(axis=(1, 2)) > 1
+    cy, cx, cpeak = cy[~flat], cx[~flat], cpeak[~flat]
+    # Candidates with a neighbour bright enough to spoil them within isolation
+    tree = cKDTree(np.stack([ys, xs], axis=1))
+    spoiler = CONTAMINATION * (cpeak - level) + level
+    neighbours = tree.query_ball_point(np.stack([cy, cx], axis=1), isolation)
+    owner = np.repeat(np.arange(len(cy)), [len(i) for i in neighbours])
+    index = np.concatenate(neighbours).astype(int) if len(owner) else np.zeros(0, dtype=int)
+    spoils = ((ys[index] != cy[owner]) | (xs[index] != cx[owner])) & (peaks[index] > spoiler[owner])
+    isolated = np.bincount(owner[spoils], minlength=len(cy)) == 0
+    cy, cx, cpeak, spoiler = cy[isolated], cx[isolated], cpeak[isolated], spoiler[isolated]
+    if len(cy) == 0:
+        return []
+    measured = shapes(data, cy, cx, level)
+    point = (measured['roundness'] >= min_roundness) & (measured['fwhm'] >= MIN_FWHM)
+    if not point.any():
+        return []
+    # Stellar locus: profile with the most round sources within LOCUS_WIDTH
+    profile = np.stack([measured['fwhm'], measured['concentration'], measured['roundness']], axis=1)
+    near = (np.abs(profile[point][:, None] - profile[point][None, :])
+            <= LOCUS_WIDTH * profile[point][:, None]).all(axis=2)
+    members = profile[point][near[np.argmax(near.sum(axis=1))]]
+    locus = np.median(members, axis=0)
+    # Keep sources within 3 sigma of the locus scatter, no wider than LOCUS_WIDTH
+    spread = 1.4826 * np.median(np.abs(members - locus), axis=0)
+    tolerance = np.clip(3 * spread, LOCUS_SCATTER * locus, LOCUS_WIDTH * locus)
+    point &= (np.abs(profile - locus) <= tolerance).all(axis=1)
+    order = np.argsort(-measured['flux'] * point)[:point.sum()][:n]
+    # Distance to nearest spoiling neighbour, only for the stars returned
+    sy, sx, sspoiler = cy[order], cx[order], spoiler[order]
+    _, nearest = nearest_neighbour(tree, np.stack([sy, sx], axis=1),
+                                   lambda i, j: ((ys[j] != sy[i]) | (xs[j] != sx[i]))
+                                                & (peaks[j] > sspoiler[i]))
+    return [{'x': float(measured['x'][i]), 'y': float(measured['y'][i]),
+             'peak': float(cpeak[i]), 'flux': float(measured['flux'][i]),
+             'fwhm': float(measured['fwhm'][i]), 'roundness': float(measured['roundness'][i]),
+             'nearest': float(distance)} for i, distance in zip(order, nearest)]
+
+def nearest_neighbour(tree, points: np.ndarray, accept, k: int =NEIGHBOUR_K) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds the nearest point of a k-d tree to each of points that passes a
+    test, looking at the k nearest first and at more only for points with
+    no match among them, so memory stays linear in the number of points
+
+    Args:
+        tree: scipy.spatial.cKDTree of candidate neighbours
+        points: (n, 2) array of points
+        accept: function(i, j) of index arrays into points and tree data,
+                True where tree point j may be the neighbour of point i
+        k: neighbours looked at first
+
+    Returns: index into tree data (-1 if none passes) and distance (inf if
+             none passes) of nearest accepted neighbour of each point
+    '''
+    index = np.full(len(points), -1)
+    distance = np.full(len(points), np.inf)
+    todo = np.arange(len(points))
+    while len(todo) > 0 and tree.n > 0:
+        k = min(k, tree.n)
+        found_distance, found = tree.query(points[todo], k=k)
+        found_distance, found = found_distance.reshape(len(todo), k), found.reshape(len(todo), k)
+        accepted = accept(todo[:, None], found)
+        match = accepted.any(axis=1)
+        first = accepted.argmax(axis=1)[match]
+        index[todo[match]] = found[match, first]
+        distance[todo[match]] = found_distance[match, first]
+        if k == tree.n:
+            break
+        todo = todo[~match]
+        k *= 4
+    return index, distance
+
+def star_regions(star: dict, isolation: int =ISOLATION) -> str:
+    '''
+    Gets ds9 region string for a psf fit of a star, as a user would place
+    it: a circle on the star and a box for the fitting region
+
+    Args:
+        star: star found by find_stars
+        isolation: half-width of fitting box in pixels
+
+    Returns: ds9 region string
+    '''
+    size = 2 * isolation
+    return '\n'.join(['# Region file format: DS9 version 4.1', 'image',
+                      f"circle({star['x']:.2f},{star['y']:.2f},{max(star['fwhm'], 1):.2f})",
+                      f"box({star['x']:.2f},{star['y']:.2f},{size},{size},0)"])
+
+def segment(data: np.ndarray, level: float, sigma: float, threshold: float =SEED_THRESHOLD,
+            peak: float =SEED_PEAK) -> tuple[np.ndarray, int]:
+    '''
+    Segments an image into sources: pixels above threshold are labelled into
+    connected segments, segments without a significant peak are dropped,
+    and segments with several peaks (blended sources) are split between
+    them by watershed. Peaks within DEBLEND_RADIUS of a brighter peak in
+    the same segment, or not rising DEBLEND_CONTRAST above the dip between
+    them, are part of its source
+
+    Args:
+        data: smoothed image
+        level, sigma: background level and noise of data
+        threshold: segmentation threshold, in background sigma
+        peak: peak height of a source, in background sigma
+
+    Returns: label image (0 for background), number of sources
+    '''
+    from scipy import ndimage
+    from scipy.spatial import cKDTree
+    segments, _ = ndimage.label(data > level + threshold * sigma, structure=np.ones((3, 3)))
+    # Peaks, brightest first, without those near a brighter peak
+    ys, xs = np.nonzero(local_maxima(data) & (data > level + peak * sigma) & (segments > 0))
+    if len(ys) == 0:
+        return np.zeros(data.shape, dtype=np.int32), 0
+    order = np.argsort(-data[ys, xs])
+    ys, xs = ys[order], xs[order]
+    # Pairs are (brighter, fainter) as peaks are sorted
+    pairs = cKDTree(np.stack([ys, xs], axis=1)).query_pairs(DEBLEND_RADIUS, output_type='ndarray')
+    shadowed = np.zeros(len(ys), dtype=bool)
+    shadowed[pairs.max(axis=1)] = True
+    ys, xs = ys[~shadowed], xs[~shadowed]
+    # Nearest brighter peak in the same segment, and the dip on the way to it
+    peak_segments = segments[ys, xs]
+    brightest = np.zeros(len(ys), dtype=bool)
+    brightest[np.unique(peak_segments, return_index=True)[1]] = True
+    secondary = np.flatnonzero(~brightest)
+    if secondary.size > 0:
+        parent, _ = nearest_neighbour(cKDTree(np.stack([ys, xs], axis=1)),
+                                      np.stack([ys[secondary], xs[secondary]], axis=1),
+                                      lambda i, j: (peak_segments[j] == peak_segments[secondary][i])
+                                                   & (j < secondary[i]))
+        t = np.linspace(0, 1, DEBLEND_SAMPLES)
+        line_y = np.rint(ys[secondary, None] + t * (ys[parent] - ys[secondary])[:, None]).astype(int)
+        line_x = np.rint(xs[secondary, None] + t * (xs[parent] - xs[secondary])[:, None]).astype(int)
+        dip = data[line_y, line_x].min(axis=1)
+        faint = np.zeros(len(ys), dtype=bool)
+        faint[secondary] = data[ys[secondary], xs[secondary]] - dip < DEBLEND_CONTRAST * sigma
+        ys, xs = ys[~faint], xs[~faint]
+    # Number sources by peak, so segments with one peak keep it as their label
+    peak_segments = segments[ys, xs]
+    counts = np.bincount(peak_segments, minlength=segments.max() + 1)
+    number = np.zeros(len(counts), dtype=np.int32)
+    single = counts == 1
+    single[0] = False
+    number[single] = np.arange(1, single.sum() + 1)
+    labels = number[segments]
+    n = int(single.sum())
+    # Split blended segments between their peaks over inverted, log scaled
+    # brightness, in their bounding boxes only
+    scaled = np.log1p(np.clip((data - level) / sigma, 0, None))
+    scaled = (65535 * (1 - scaled / max(scaled.max(), 1))).astype(np.uint16)
+    boxes = ndimage.find_objects(segments)
+    for blended in np.flatnonzero(counts > 1):
+        box = boxes[blended - 1]
+        markers = np.where(segments[box] == blended, 0, -1).astype(np.int32)
+        in_segment = peak_segments == blended
+        k = int(in_segment.sum())
+        markers[ys[in_segment] - box[0].start, xs[in_segment] - box[1].start] = np.arange(n + 1, n + k + 1)
+        split = ndimage.watershed_ift(scaled[box], markers)
+        labels[box] = np.where(segments[box] == blended, np.clip(split, 0, None), labels[box])
+        n += k
+    return labels, n
+
+def find_sources(data: np.ndarray, threshold: float =SEED_THRESHOLD, min_area: int =MIN_AREA,
+                 psf_peak: float|None =None, zero_point: float|None =None) -> list[dict]:
+    '''
+    Finds sources to seed galfit components with. The smoothed image is
+    segmented (see segment) and every source is measured at once from
+    background subtracted pixel moments, with bincount over the labels.
+    Round sources as peaked as the psf (their peak pixel holds at least
+    POINT_PEAK of the fraction of flux the psf peak holds) are point sources
+
+    Args:
+        data: image, or the fitting box cut out of it
+        threshold: segmentation threshold, in background sigma
+        min_area: smallest source in pixels
+        psf_peak: fraction of psf flux in its peak pixel. If None, all
+                  sources are extended
+        zero_point: zero point for magnitudes, if None magnitudes are None
+
+    Returns: sources, brightest first, as dicts with x, y (1-indexed in data),
+             a, b (effective semi-axes), angle (degrees counterclockwise
+             from +x, as ds9), flux, mag, peak (fraction of flux in peak
+             pixel), roundness, area and point
+    '''
+    from scipy import ndimage
+    data = np.asarray(data, dtype=np.float32)
+    level, _ = background(data)
+    data = np.where(np.isfinite(data), data, level)
+    smoothed = ndimage.gaussian_filter(data, SEED_SMOOTHING)
+    labels, n = segment(smoothed, *background(smoothed), threshold)
+    if n == 0:
+        return []
+    # Moments of every source in one pass over the labelled pixels
+    ys, xs = np.nonzero(labels)
+    index = labels[ys, xs]
+    values = data[ys, xs] - level
+    weights = np.clip(values, 0, None)
+    area = np.bincount(index, minlength=n + 1)[1:]
+    flux = np.bincount(index, values, minlength=n + 1)[1:]
+    peak = ndimage.maximum(values, index, np.arange(1, n + 1))
+    norm = np.bincount(index, weights, minlength=n + 1)[1:]
+    norm = np.where(norm > 0, norm, 1)
+    def moment(quantity):
+        return np.bincount(index, weights * quantity, minlength=n + 1)[1:] / norm
+    xs, ys = xs.astype(float), ys.astype(float)
+    mx, my = moment(xs), moment(ys)
+    mxx, myy, mxy = moment(xs**2) - mx**2, moment(ys**2) - my**2, moment(xs * ys) - mx * my
+    # Axes and angle from eigenvalues and eigenvectors of the covariance
+    half_trace = (mxx + myy) / 2
+    root = np.sqrt(((mxx - myy) / 2)**2 + mxy**2)
+    major = np.sqrt(np.clip(half_trace + root, 0, None))
+    minor = np.sqrt(np.clip(half_trace - root, 0, None))
+    angle = np.degrees(0.5 * np.arctan2(2 * mxy, mxx - myy)) % 180
+    roundness = minor / np.where(major > 0, major, np.inf)
+    peak = peak / np.where(flux > 0, flux, np.inf)
+    point = np.zeros(n, dtype=bool)
+    if psf_peak is not None:
+        point = (peak >= POINT_PEAK * psf_peak) & (roundness >= MIN_ROUNDNESS)
+    mag = None
+    if zero_point is not None:
+        mag = zero_point - 2.5 * np.log10(np.clip(flux, np.finfo(np.float32).tiny, None))
+    keep = np.flatnonzero((area >= min_area) & (flux > 0))
+    keep = keep[np.argsort(-flux[keep])]
+    return [{'x': float(mx[i] + 1), 'y': float(my[i] + 1),
+             'a': float(max(GAUSSIAN_REFF * major[i], 1)), 'b': float(max(GAUSSIAN_REFF * minor[i], 1)),
+             'angle': float(angle[i]), 'flux': float(flux[i]),
+             'mag': float(mag[i]) if mag is not None else None, 'peak': float(peak[i]),
+             'roundness': float(roundness[i]), 'area': int(area[i]), 'point': bool(point[i])}
+            for i in keep]
+
+def source_regions(sources: list[dict], box: list[int]|None =None) -> str:
+    '''
+    Gets ds9 region string seeding galfit components, as a user would place
+    them: an ellipse per extended source, a point per point source, and the
+    fitting box
+
+    Args:
+        sources: sources found by find_sources, in image coordinates
+        box: fitting box as galfit H) xmin xmax ymin ymax, if any
+
+    Returns: ds9 region string
+    '''
+    lines = ['# Region file format: DS9 version 4.1', 'image']
+    for source in sources:
+        if source['point']:
+            lines.append(f"point({source['x']:.2f},{source['y']:.2f})")
+        else:
+            lines.append(f"ellipse({source['x']:.2f},{source['y']:.2f},{source['a']:.2f},"
+                         f"{source['b']:.2f},{source['angle']:.1f})")
+    if box is not None:
+        xmin, xmax, ymin, ymax = box
+        lines.append(f'box({(xmin + xmax) / 2},{(ymin + ymax) / 2},{xmax - xmin},{ymax - ymin},0)')
+    return '\n'.join(lines)
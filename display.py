@@ -0,0 +1,231 @@
+# ds9 display layer that drops redundant commands and reloads
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import contextlib
+
+# Commands that set a piece of ds9 state, keyed by the words naming the
+# setting. Resending the same value is a wasted XPA round trip
+SETTINGS = ['tile', 'cmap', 'mode', 'region shape', 'scale mode', 'scale',
+            'rgb lock scale', 'rgb lock colorbar', 'rgb lock scalelimits',
+            'lock frame']
+# Settings that belong to the current frame (or rgb channel), forgotten
+# whenever the current frame changes
+FRAME_SETTINGS = ['scale mode', 'scale']
+# Commands that load a file into a new frame
+LOADS = ['fits new', 'mecube new']
+# Commands that change which frame (or rgb channel) is current
+FRAME_COMMANDS = ['fits', 'mecube', 'frame', 'rgb', 'url', 'array']
+
+def setting(command: str) -> tuple[str, str]|None:
+    '''
+    Gets which setting a command sets, e.g. 'scale mode 99.5' ->
+    ('scale mode', '99.5'). Longest setting names are matched first
+
+    Returns: (setting, value), or None if command is not a setting
+    '''
+    words = command.split()
+    for name in sorted(SETTINGS, key=len, reverse=True):
+        n = len(name.split())
+        if words[:n] == name.split() and len(words) > n:
+            # 'scale limits ...', 'rgb lock ...' etc are not plain 'scale'/'rgb'
+            if name == 'scale' and words[1] in ['limits', 'mode']:
+                continue
+            return name, ' '.join(words[n:])
+    return None
+
+class Display():
+    '''
+    Class wrapping a pyds9 DS9 instance (or anything with set/get) to cut
+    XPA round trips. Settings already in effect are not resent, a file
+    already shown in the current frame is not reloaded, and commands sent
+    inside batch() are queued and coalesced before being sent.
+
+    XPA takes one command per round trip, so a batch cannot be sent as a
+    single message. Instead, a batch drops commands that a later command in
+    the same batch overrides, along with repeats of settings already in
+    effect. It is flushed before any get and when the batch ends.
+
+    Attributes:
+        ds9: wrapped DS9 instance
+        state: setting -> value last sent
+        loaded: (command, path, mtime) of file shown in current frame
+        pending: queued commands while batching, None otherwise
+
+    Methods:
+        set: sends command to ds9
+        get: queries ds9
+        batch: queues and coalesces commands inside a with block
+        flush: sends queued commands
+        sync: forgets tracked state, e.g. after user may have changed ds9
+        show: loads file into a frame and applies standard view settings
+    '''
+    def __init__(self, ds9):
+        self.ds9 = ds9
+        self.state = {}
+        self.loaded = None
+        self.pending = None
+
+    def set(self, command: str, *args) -> None:
+        '''
+        Sends command to ds9, unless it changes nothing. Queued while
+        batching
+
+        Args:
+            command: ds9 XPA command, e.g. 'scale mode 99.5'
+            args: extra arguments passed to pyds9 set (e.g. data)
+
+        Returns: Nothing
+        '''
+        if args:
+            self.flush()
+            self.track(command)
+            self.ds9.set(command, *args)
+            return
+        if self.redundant(command):
+            return
+        self.track(command)
+        if self.pending is not None:
+            self.pending.append(command)
+        else:
+            self.ds9.set(command)
+
+    def get(self, command: str):
+        '''
+        Queries ds9, sending any queued commands first
+
+        Args:
+            command: ds9 XPA query, e.g. 'region -system image'
+
+        Returns: ds9 response
+        '''
+        self.flush()
+        return self.ds9.get(command)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Queues commands inside the with block and sends them coalesced when
+        it ends
+        '''
+        outer = self.pending is not None
+        if not outer:
+            self.pending = []
+        try:
+            yield self
+        finally:
+            if not outer:
+                self.flush()
+                self.pending = None
+
+    def flush(self) -> None:
+        '''
+        Sends queued commands, dropping settings overridden later in the
+        queue before the frame changes
+        '''
+        if not self.pending:
+            return
+        commands = []
+        seen = {}
+        for command in reversed(self.pending):
+            name = setting(command)
+            if name is not None:
+                if name[0] in seen:
+                    continue
+                seen[name[0]] = True
+            elif command.split()[0] in FRAME_COMMANDS:
+                seen = {}
+            commands.append(command)
+        self.pending = []
+        for command in reversed(commands):
+            self.ds9.set(command)
+
+    def sync(self) -> None:
+        '''
+        Forgets tracked state, so the next commands are all sent. Called
+        before each TUI command, since the user may have changed ds9 by hand
+        '''
+        self.flush()
+        self.state = {}
+        self.loaded = None
+
+    def redundant(self, command: str) -> bool:
+        '''
+        Checks if command would change nothing. A file load is redundant if
+        the same unchanged file is still shown in the current frame; its
+        regions are then cleared so the frame looks freshly loaded
+
+        Args:
+            command: ds9 XPA command
+
+        Returns: True if command can be skipped
+        '''
+        name = setting(command)
+        if name is not None:
+            return self.state.get(name[0]) == name[1]
+        load = self.load_key(command)
+        if load is None or load != self.loaded:
+            return False
+        # Confirm ds9 still shows the file, the user may have closed it
+        shown = str(self.get('file')).strip()
+        if not shown.startswith(load[1]):
+            self.loaded = None
+            return False
+        self.set('region delete all')
+        return True
+
+    def track(self, command: str) -> None:
+        '''
+        Updates tracked state for a command about to be sent
+        '''
+        name = setting(command)
+        if name is not None:
+            self.state[name[0]] = name[1]
+            return
+        words = command.split()
+        if words and words[0] == 'scale':
+            # e.g. scale limits, which switches off scale mode
+            self.state.pop('scale mode', None)
+            return
+        if not words or words[0] not in FRAME_COMMANDS:
+            return
+        for key in FRAME_SETTINGS:
+            self.state.pop(key, None)
+        self.loaded = self.load_key(command)
+
+    def load_key(self, command: str) -> tuple[str, str, int]|None:
+        '''
+        Returns: (load command, path, mtime) if command loads a file into a
+                 new frame, None otherwise
+        '''
+        for load in LOADS:
+            if command.startswith(load + ' '):
+                path = command[len(load) + 1:].strip()
+                mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+                return load, path, mtime
+        return None
+
+    def show(self, file: str, cube: bool =False, scale: str ='99.5',
+             mode: str|None =None) -> None:
+        '''
+        Loads file into a new frame (unless already shown) and applies the
+        standard view: no tiling, default colormap, scale and zoom to fit
+
+        Args:
+            file: fits file to show
+            cube: True to load galfit output as a cube and play it
+            scale: ds9 scale mode, e.g. '99.5' or 'minmax'
+            mode: ds9 edit mode, e.g. 'region', 'none' or 'pan'
+
+        Returns: Nothing
+        '''
+        with self.batch():
+            self.set(('mecube new ' if cube else 'fits new ') + file)
+            self.set('tile no')
+            self.set('cmap 1 0.5')
+            self.set('scale mode ' + scale)
+            if mode is not None:
+                self.set('mode ' + mode)
+            self.set('zoom to fit')
+            if cube:
+                self.set('cube play')
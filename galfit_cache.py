@@ -0,0 +1,170 @@
+# Content-addressed cache of galfit results
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from galfit_config import GalfitConfig
+
+# Cache lives next to target output directories
+CACHE_DIR = os.path.expanduser('~/gf_out/.galfit_cache/')
+# Least recently used results are evicted past this total size
+CACHE_MAX_BYTES = 2 * 1024**3
+# Config header parameters that name input files, hashed by content
+FILE_PARAMS = ['A', 'C', 'D', 'F', 'G']
+# Config header parameters that do not change the fit
+IGNORED_PARAMS = ['B', 'O']
+
+# (path, size, mtime) -> sha256 of file, so unchanged inputs are hashed once
+_file_hashes = {}
+
+def file_hash(path: str) -> str:
+    '''
+    Gets sha256 of file contents, or of the value itself if it is not a file
+    (e.g. 'none')
+    '''
+    if not os.path.isfile(path):
+        return 'value:' + path
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+def command_hash(command: str) -> str:
+    '''
+    Gets hash of a galfit command (e.g. '/usr/local/bin/galfit' or
+    'python3 fake_galfit.py'), with every word that names an executable or
+    file counted by content, so a rebuilt or replaced galfit misses the cache
+    '''
+    return ' '.join(file_hash(shutil.which(word) or os.path.expanduser(word))
+                    for word in command.split())
+
+class GalfitCache():
+    '''
+    Class for an on disk cache of galfit output (4 frame fits and galfit.01),
+    keyed by a hash of the normalised config, the contents of its target,
+    psf, mask and constraint files, and the galfit executable. Size bounded
+    with LRU eviction.
+
+    Attributes:
+        cache_dir: directory holding one subdirectory per cached result
+        max_bytes: maximum total size of cache
+
+    Methods:
+        key: gets cache key for a config
+        get: copies cached result into a run directory
+        put: stores a run's result
+        evict: removes least recently used results past max_bytes
+    '''
+    def __init__(self, cache_dir: str =CACHE_DIR, max_bytes: int =CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, config: GalfitConfig, options: str ='', galfit_path: str ='') -> str:
+        '''
+        Gets cache key from parameter values only, so comments, spacing and
+        output paths do not matter, and input files and galfit itself count
+        by content
+
+        Args:
+            config: galfit config to be run
+            options: galfit command line options
+            galfit_path: path to galfit (or command running it)
+
+        Returns: hex digest key
+        '''
+        digest = hashlib.sha256()
+        digest.update(command_hash(galfit_path).encode())
+        digest.update(('\n' + ' '.join(options.split())).encode())
+        for key, param in config.header.items():
+            if key in IGNORED_PARAMS:
+                continue
+            if key in FILE_PARAMS:
+                value = file_hash(' '.join(param.values))
+            else:
+                value = ' '.join(param.values)
+            digest.update(f'\n{key}) {value}'.encode())
+        for component in config.components:
+            for key, param in component.params.items():
+                digest.update(f'\n{component.number}:{key}) {" ".join(param.values)}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key: str, run_dir: str, config: GalfitConfig) -> bool:
+        '''
+        Copies cached output fits and galfit.01 into run_dir. The cached
+        galfit.01 is pointed at the input files of the current config
+
+        Args:
+            key: cache key
+            run_dir: galfit run directory
+            config: galfit config being run
+
+        Returns: True on cache hit
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.exists(os.path.join(entry, 'output.fits')):
+            return False
+        shutil.copyfile(os.path.join(entry, 'output.fits'), os.path.join(run_dir, 'output.fits'))
+        if os.path.exists(os.path.join(entry, 'galfit.01')):
+            output_config = GalfitConfig.read(os.path.join(entry, 'galfit.01'))
+            for param in FILE_PARAMS + ['B']:
+                if param in config.header and param in output_config.header:
+                    output_config.set_header(param, ' '.join(config.header[param].values))
+            output_config.write(os.path.join(run_dir, 'galfit.01'))
+        # Mark as recently used
+        now = time.time()
+        os.utime(entry, (now, now))
+        return True
+
+    def put(self, key: str, output_fits: str, output_config: str|None) -> None:
+        '''
+        Stores a galfit result. Written to a temporary directory first and
+        renamed into place, so readers never see a partial entry
+
+        Args:
+            key: cache key
+            output_fits: galfit output fits
+            output_config: galfit output config, if any
+
+        Returns: Nothing
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='.put_', dir=self.cache_dir)
+        shutil.copyfile(output_fits, os.path.join(temp_dir, 'output.fits'))
+        if output_config is not None:
+            shutil.copyfile(output_config, os.path.join(temp_dir, 'galfit.01'))
+        try:
+            os.rename(temp_dir, entry)
+        except OSError:
+            # Another run stored the same result first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        '''
+        Removes least recently used results until cache is under max_bytes
+        '''
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,185 @@
+# Parser and writer for galfit config (feedme) files
+# Author: Paxson Swierc & Daniel Babnigg
+
+import re
+
+# Matches parameter lines such as "A) file.fits", " 1) 10 20 1 1", "B2) 0.1 1"
+PARAM_LINE = re.compile(r'^(\s*)([A-Za-z]\d*|\d+)\)(.*)$')
+
+class Parameter():
+    '''
+    Class for a single parameter line of a galfit config.
+
+    Attributes:
+        key: parameter key, e.g. 'A', '1', 'Z', 'B2'
+        values: value tokens of the line (values followed by fit toggles)
+        comment: trailing comment, without the #
+        line: index of the line in the config
+        indent: leading whitespace of the line
+    '''
+    def __init__(self, key: str, values: list[str], comment: str|None,
+                 line: int, indent: str =''):
+        self.key = key
+        self.values = values
+        self.comment = comment
+        self.line = line
+        self.indent = indent
+
+    def value(self, i: int =0) -> float:
+        '''
+        Returns: i-th value token as float
+        '''
+        return float(self.values[i])
+
+    def free(self) -> list[bool]:
+        '''
+        Fit toggles of a component parameter. Position (1) has two values
+        and two toggles, every other parameter has one value and one toggle
+
+        Returns: list of True for free, False for fixed
+        '''
+        n_values = 2 if self.key == '1' else 1
+        return [toggle == '1' for toggle in self.values[n_values:]]
+
+    def render(self) -> str:
+        '''
+        Returns: config line for this parameter
+        '''
+        line = f"{self.indent}{self.key}) {' '.join(self.values)}"
+        if self.comment is not None:
+            line += f"  # {self.comment}"
+        return line + '\n'
+
+class Component():
+    '''
+    Class for a single component (sky, sersic, psf, ...) of a galfit config.
+
+    Attributes:
+        number: component number, counted from 1 in file order as galfit does
+        type: component type from the 0) line
+        params: dict of parameter key -> Parameter, in file order
+    '''
+    def __init__(self, number: int, type: str):
+        self.number = number
+        self.type = type
+        self.params = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.params
+
+    def __getitem__(self, key: str) -> Parameter:
+        return self.params[key]
+
+class GalfitConfig():
+    '''
+    Class for a parsed galfit config. The raw lines are kept so that
+    unchanged lines (comments, spacing) are written back untouched.
+
+    Attributes:
+        lines: lines of config file
+        header: dict of header parameter key (A-P) -> Parameter
+        components: list of Component in file order
+
+    Methods:
+        read: parses config file
+        write: writes config file
+        text: returns config text
+        component: gets component by number
+        set_header: sets value of header parameter
+        set_param: sets values of component parameter
+    '''
+    def __init__(self, lines: list[str]):
+        self.lines = list(lines)
+        self.header = {}
+        self.components = []
+        self.parse()
+
+    @classmethod
+    def read(cls, config_file: str) -> 'GalfitConfig':
+        '''
+        Parses galfit config file
+
+        Args:
+            config_file: path to galfit config file
+
+        Returns: parsed config
+        '''
+        with open(config_file) as config:
+            return cls(config.readlines())
+
+    def parse(self) -> None:
+        '''
+        Builds header and components from lines in a single pass
+        '''
+        component = None
+        for i, line in enumerate(self.lines):
+            if line.strip().startswith('#'):
+                continue
+            match = PARAM_LINE.match(line.rstrip('\n'))
+            if match is None:
+                continue
+            indent, key, rest = match.groups()
+            value, _, comment = rest.partition('#')
+            param = Parameter(key, value.split(),
+                              comment.strip() if comment else None, i, indent)
+            if key == '0':
+                component = Component(len(self.components) + 1, param.values[0])
+                self.components.append(component)
+                component.params[key] = param
+            elif component is None:
+                self.header[key] = param
+            else:
+                component.params[key] = param
+
+    def text(self) -> str:
+        '''
+        Returns: config text
+        '''
+        return ''.join(self.lines)
+
+    def write(self, config_file: str) -> None:
+        '''
+        Writes config to file
+
+        Args:
+            config_file: path to write config to
+
+        Returns: Nothing
+        '''
+        with open(config_file, 'w') as config:
+            config.writelines(self.lines)
+
+    def component(self, number: int) -> Component:
+        '''
+        Returns: component with given number
+        '''
+        return self.components[number - 1]
+
+    def set_header(self, key: str, value: str) -> None:
+        '''
+        Sets value of header parameter, e.g. set_header('G', 'none')
+
+        Args:
+            key: header parameter key
+            value: new value
+
+        Returns: Nothing
+        '''
+        param = self.header[key]
+        param.values = str(value).split()
+        self.lines[param.line] = param.render()
+
+    def set_param(self, component: Component, key: str, values: list) -> None:
+        '''
+        Sets values (and toggles) of component parameter
+
+        Args:
+            component: component to change
+            key: component parameter key
+            values: new value tokens
+
+        Returns: Nothing
+        '''
+        param = component.params[key]
+        param.values = [str(value) for value in values]
+        self.lines[param.line] = param.render()
@@ -0,0 +1,300 @@
+# Class for running galfit in an isolated scratch directory
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import re
+import glob
+import time
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+from galfit_config import GalfitConfig
+from galfit_cache import GalfitCache
+from cutout import stage_cutout, restore_output
+import timing
+
+# Matches galfit progress lines such as
+# "Iteration : 6     Chi2nu: 1.107e+00     dChi2/Chi2: -5.26e-04    alamda: 1e+00"
+ITERATION_LINE = re.compile(r'Iteration\s*:\s*(\d+)\s+Chi(?:2nu|\^2/nu)\s*[:=]\s*([-+0-9.eEdD]+)')
+# Default limits for every run, None for no limit. Set by batch runner
+TIMEOUT = None
+MAX_ITERATIONS = None
+# Default for staging box cutouts of image, sigma and mask. Set by batch runner
+CUTOUT = False
+
+class GalfitRun():
+    '''
+    Class to run galfit once inside its own scratch working directory, so
+    concurrent runs never clobber each other's galfit.NN or output fits.
+    The output image block is redirected into the scratch directory and
+    only moved into place when collected.
+
+    Attributes:
+        galfit_path: path to galfit
+        config_file: path to galfit config file being run
+        output_dir: directory where model outputs are saved
+        options: extra command line options for galfit (e.g. -o2)
+        config: parsed config that will be run, may be edited before run
+        run_dir: scratch working directory of this run
+        output_fits: path to galfit output fits (4 frames) in run_dir
+        output_config: path to galfit output config (galfit.NN) in run_dir
+        returncode: exit code of galfit
+        use_cache: whether to reuse and store results in the galfit cache
+        cached: True if result came from the cache instead of galfit
+        quiet: whether to only send galfit output to the log file, instead
+               of also echoing it to the terminal
+        cutout: whether to run galfit on a cutout of the fitting box
+        offset: (dx, dy) of the staged cutout in the image, None if the full
+                image was run
+        timeout: wall-clock seconds after which galfit is killed, or None
+        max_iterations: iteration after which galfit is killed, or None
+        progress: function called as progress(iteration, chi2nu, elapsed)
+                  each time galfit reports an iteration
+        log_file: path to galfit output log, kept after cleanup
+        iteration: last iteration reported by galfit
+        chi2nu: last reduced chi squared reported by galfit
+        started: time galfit started
+        finished: time galfit finished
+        process: running galfit process
+        cancelled: True if run was cancelled
+        stopped: reason galfit was killed by a limit, None otherwise
+
+    Methods:
+        run: runs galfit inside run_dir
+        read_output: streams galfit output to log and parses progress
+        cancel: stops galfit
+        stop: kills galfit because a limit was hit
+        kill: kills galfit process group
+        elapsed: gets seconds galfit has been running
+        has_fits: checks for output fits
+        has_config: checks for output config
+        save_fits: moves output fits into place
+        save_config: moves output config into place
+        cleanup: removes run_dir
+    '''
+    def __init__(self, galfit_path: str, config_file: str, output_dir: str,
+                 options: str ='', use_cache: bool =True, quiet: bool =False,
+                 timeout: float|None =None, max_iterations: int|None =None,
+                 progress=None, cutout: bool|None =None):
+        self.galfit_path = galfit_path
+        self.config_file = config_file
+        self.output_dir = output_dir
+        self.options = options
+        self.config = GalfitConfig.read(config_file)
+        self.run_dir = None
+        self.output_fits = None
+        self.output_config = None
+        self.returncode = None
+        self.use_cache = use_cache
+        self.cached = False
+        self.quiet = quiet
+        self.cutout = cutout if cutout is not None else CUTOUT
+        self.offset = None
+        self.timeout = timeout if timeout is not None else TIMEOUT
+        self.max_iterations = max_iterations if max_iterations is not None else MAX_ITERATIONS
+        self.progress = progress
+        self.log_file = None
+        self.iteration = None
+        self.chi2nu = None
+        self.started = None
+        self.finished = None
+        self.process = None
+        self.cancelled = False
+        self.stopped = None
+
+    def run(self) -> None:
+        '''
+        Writes config into a fresh scratch directory, pointing its output
+        image block there, and runs galfit from inside it. With cutout,
+        galfit reads cutouts staged in the scratch directory and its output
+        is moved back to image coordinates before it is cached or saved
+
+        Args: None
+
+        Returns: Nothing
+        '''
+        # Scratch dir lives in output dir so results can be renamed atomically
+        self.run_dir = tempfile.mkdtemp(prefix='galfit_run_', dir=self.output_dir)
+        self.output_fits = os.path.join(self.run_dir, 'output.fits')
+        feedme = os.path.join(self.run_dir, 'galfit.feedme')
+        config = GalfitConfig(self.config.lines)
+        config.set_header('B', self.output_fits)
+        # Skip galfit if an identical run is cached
+        if self.use_cache:
+            cache = GalfitCache()
+            with timing.span('galfit_cache'):
+                key = cache.key(config, self.options, self.galfit_path)
+                hit = cache.get(key, self.run_dir, config)
+            if hit:
+                print('\nUsing cached galfit result')
+                self.cached = True
+                self.returncode = 0
+                self.find_output_config()
+                return
+        if self.cancelled:
+            return
+        # Cache key above is taken on the full image config
+        if self.cutout:
+            with timing.span('cutout'):
+                self.offset = stage_cutout(config, self.run_dir)
+        config.write(feedme)
+        command = self.galfit_path.rstrip()+' '+feedme+' '+self.options
+        # Line buffer galfit output so progress arrives as it is printed
+        if shutil.which('stdbuf') is not None:
+            command = 'stdbuf -oL ' + command
+        # Log lives outside run_dir so it outlasts cleanup
+        log_dir = os.path.join(self.output_dir, 'galfit_logs')
+        os.makedirs(log_dir, exist_ok=True)
+        config_name = os.path.splitext(os.path.basename(self.config_file))[0]
+        self.log_file = os.path.join(log_dir, config_name + time.strftime('_%Y%m%d-%H%M%S_')
+                                     + os.path.basename(self.run_dir)[len('galfit_run_'):] + '.log')
+        # Run galfit in its own process group so it can be cancelled
+        self.started = time.time()
+        with timing.span('galfit'):
+            self.process = subprocess.Popen(['/bin/bash', '-c', command], cwd=self.run_dir,
+                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                            text=True, errors='replace', start_new_session=True)
+            timer = None
+            if self.timeout is not None:
+                timer = threading.Timer(self.timeout, self.stop,
+                                        [f'wall-clock timeout of {self.timeout}s'])
+                timer.daemon = True
+                timer.start()
+            self.read_output()
+            self.returncode = self.process.wait()
+        self.finished = time.time()
+        if timer is not None:
+            timer.cancel()
+        if self.stopped is not None:
+            print(f'\nGalfit killed after {self.elapsed():.0f}s: {self.stopped}. See {self.log_file}')
+        if self.cancelled:
+            return
+        self.find_output_config()
+        if self.offset is not None:
+            with timing.span('cutout'):
+                restore_output(self.config, self.offset, self.output_fits, self.output_config)
+        # Store successful runs. Runs with -o options write no galfit.01
+        if self.use_cache and self.stopped is None and self.has_fits() \
+           and (self.has_config() or '-o' in self.options):
+            with timing.span('galfit_cache'):
+                cache.put(key, self.output_fits, self.output_config)
+
+    def read_output(self) -> None:
+        '''
+        Streams galfit output line by line into the log file (and terminal
+        unless quiet), tracking iteration and reduced chi squared as galfit
+        reports them
+
+        Args: None
+
+        Returns: Nothing
+        '''
+        with open(self.log_file, 'w', buffering=1) as log:
+            for line in self.process.stdout:
+                log.write(line)
+                if not self.quiet:
+                    print(line, end='', flush=True)
+                match = ITERATION_LINE.search(line)
+                if match is None:
+                    continue
+                self.iteration = int(match.group(1))
+                self.chi2nu = float(match.group(2).replace('d', 'e').replace('D', 'e'))
+                if self.progress is not None:
+                    self.progress(self.iteration, self.chi2nu, self.elapsed())
+                if self.max_iterations is not None and self.iteration > self.max_iterations:
+                    self.stop(f'more than {self.max_iterations} iterations')
+
+    def cancel(self) -> None:
+        '''
+        Stops galfit if it is running, or keeps it from starting
+        '''
+        self.cancelled = True
+        self.kill()
+
+    def stop(self, reason: str) -> None:
+        '''
+        Kills galfit because a timeout or iteration limit was hit
+
+        Args:
+            reason: description of limit hit
+
+        Returns: Nothing
+        '''
+        if self.stopped is None:
+            self.stopped = reason
+        self.kill()
+
+    def kill(self) -> None:
+        '''
+        Kills galfit and anything it started, if it is running
+        '''
+        if self.process is not None and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def elapsed(self) -> float:
+        '''
+        Returns: seconds galfit has been running
+        '''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def find_output_config(self) -> None:
+        '''
+        Finds output config in run_dir. Galfit numbers its output configs
+        galfit.01, galfit.02, ...
+        '''
+        output_configs = sorted(glob.glob(os.path.join(self.run_dir, 'galfit.[0-9][0-9]*')))
+        if output_configs:
+            self.output_config = output_configs[-1]
+
+    def has_fits(self) -> bool:
+        '''
+        Returns: True if galfit wrote an output fits
+        '''
+        return self.output_fits is not None and os.path.exists(self.output_fits)
+
+    def has_config(self) -> bool:
+        '''
+        Returns: True if galfit wrote an output config
+        '''
+        return self.output_config is not None and os.path.exists(self.output_config)
+
+    def save_fits(self, output_file: str) -> None:
+        '''
+        Atomically moves galfit output fits to output_file
+
+        Args:
+            output_file: final path for output fits
+
+        Returns: Nothing
+        '''
+        os.replace(self.output_fits, output_file)
+
+    def save_config(self, output_file: str) -> None:
+        '''
+        Atomically moves galfit output config to output_file, pointing its
+        output image block back to the one in the original config
+
+        Args:
+            output_file: final path for output config
+
+        Returns: Nothing
+        '''
+        config = GalfitConfig.read(self.output_config)
+        config.set_header('B', ' '.join(self.config.header['B'].values))
+        temp_file = os.path.join(self.run_dir, 'galfit.out')
+        config.write(temp_file)
+        os.replace(temp_file, output_file)
+
+    def cleanup(self) -> None:
+        '''
+        Removes scratch directory and anything left in it
+        '''
+        if self.run_dir is not None and os.path.exists(self.run_dir):
+            shutil.rmtree(self.run_dir, ignore_errors=True)
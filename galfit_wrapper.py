@@ -4,12 +4,21 @@
 import os
 import sys
 import time
-import shutil
-import pyds9
-from astropy.io import fits
-from psf import PSF
+import sqlite3
+from psf import PSF, AUTO_CANDIDATES
 from sersic import Sersic
-from utils import get_paths, my_filebrowser
+from jobs import JobQueue
+from timing import command, prompt, DS9Proxy
+from display import Display
+from manifest import Manifest, DESCRIPTIONS
+from region_file import read_regions
+import galfit_run
+import workspace_index
+from workspace_index import print_queries, print_table
+from utils import get_paths, my_filebrowser, init_target, saved_files, \
+                  read_zero_point, write_zero_point
+# pyds9 and astropy are imported where used, so the prompt comes up fast and
+# commands that do not need ds9 never load it
 
 def take_action(action: str) -> None:
     '''
@@ -39,6 +48,12 @@ def take_action(action: str) -> None:
                'psf create': psf_write_config,
                'psf c': psf_write_config,
                'pc': psf_write_config,
+               'psf create file': psf_create_file,
+               'psf c file': psf_create_file,
+               'pcf': psf_create_file,
+               'psf auto': psf_auto,
+               'psf a': psf_auto,
+               'pa': psf_auto,
                'psf visualize': psf_visualize,
                'psf v': psf_visualize,
                'pv': psf_visualize,
@@ -48,9 +63,24 @@ def take_action(action: str) -> None:
                'psf upload': psf_upload,
                'psf u': psf_upload,
                'pu': psf_upload,
+               'psf library add': psf_library_add,
+               'psf lib add': psf_library_add,
+               'pla': psf_library_add,
+               'psf library link': psf_library_link,
+               'psf lib link': psf_library_link,
+               'pll': psf_library_link,
+               'psf library list': psf_library_list,
+               'psf lib list': psf_library_list,
+               'pls': psf_library_list,
                'sersic create config': sersic_create_config,
                'sersic cc': sersic_create_config,
                'scc': sersic_create_config,
+               'sersic create config file': sersic_create_config_file,
+               'sersic cc file': sersic_create_config_file,
+               'sccf': sersic_create_config_file,
+               'sersic seed config': sersic_seed_config,
+               'sersic sc': sersic_seed_config,
+               'ssc': sersic_seed_config,
                'sersic add constraint': sersic_add_constraint,
                'sersic add c': sersic_add_constraint,
                'sac': sersic_add_constraint,
@@ -60,6 +90,9 @@ def take_action(action: str) -> None:
                'sersic edit config': sersic_edit_config,
                'sersic ec': sersic_edit_config,
                'sec': sersic_edit_config,
+               'sersic edit config file': sersic_edit_config_file,
+               'sersic ec file': sersic_edit_config_file,
+               'secf': sersic_edit_config_file,
                'sersic optimize config': sersic_optimize,
                'sersic oc': sersic_optimize,
                'soc': sersic_optimize,
@@ -90,7 +123,28 @@ def take_action(action: str) -> None:
                'mult fits': mult_fits,
                'calc mag': sersic_calc_mag,
                'sersic redo psf': sersic_redo_psf,
-               'srp': sersic_redo_psf}
+               'srp': sersic_redo_psf,
+               'background': toggle_background,
+               'bg': toggle_background,
+               'job list': job_list,
+               'job l': job_list,
+               'jobs': job_list,
+               'jl': job_list,
+               'job wait': job_wait,
+               'job w': job_wait,
+               'jw': job_wait,
+               'job cancel': job_cancel,
+               'job c': job_cancel,
+               'jc': job_cancel,
+               'job info': job_info,
+               'job i': job_info,
+               'ji': job_info,
+               'index query': index_query,
+               'index q': index_query,
+               'iq': index_query,
+               'index rebuild': index_rebuild,
+               'index r': index_rebuild,
+               'ir': index_rebuild}
     if action not in actions:
         print('\nUnkown command. Type help for assistance\n')
     else:
@@ -111,12 +165,20 @@ def help():
     change zero point
 
     psf create
+    psf create file
+    psf auto
     psf visualize
     psf flags
     psf upload
+    psf library add
+    psf library link
+    psf library list
 
     sersic create config
+    sersic create config file
+    sersic seed config
     sersic edit config
+    sersic edit config file
     sersic add constraint
     sersic remove constraint
     sersic optimize config
@@ -128,6 +190,15 @@ def help():
     sersic upload config
     sersic upload model
     sersic upload constraint
+
+    background
+    job list
+    job wait
+    job cancel
+    job info
+
+    index query
+    index rebuild
     '''
     print(text)
 
@@ -135,55 +206,33 @@ def help():
 
 def list_target():
     '''
-    Checks progress in the given directory
-    '''
-    def get_time(file_name):
-        '''
-        Given a file path, returns the last modified date/time in nice format
-        '''
-        time_obj = time.strptime(time.ctime(os.path.getmtime(os.path.join(path_to_output,file_name))))
-
-        return str(time.strftime("%Y-%m-%d %H:%M:%S", time_obj))
-
-    files = os.listdir(path_to_output)
-    file_,psfc_,psf_,c_,cst_,m_ = False,False,False,False,False,False
-    for file in files:
-        if file == target_filename + ".fits":
-            file_ = True
-        if file == target_filename + '_psf_config.txt':
-            psfc_ = True
-        if file == target_filename + '_psf_model.fits':
-            psf_ = True
-        if file == target_filename + '_config.txt':
-            c_ = True
-        if file == target_filename + '_constraint.txt':
-            cst_ = True
-        if file == target_filename + '_model.fits':
-            m_ = True
+    Checks progress in the given directory, from its manifest
+    '''
+    data = Manifest(path_to_output, target_filename).load()
     print("\nCurrently Saved:")
-    if file_:
-        print('- '+get_time(target_filename+".fits")+'\t'+(target_filename+".fits")+'             '+'original file')
-    if psfc_:
-        print('- '+get_time(target_filename + "_psf_config.txt")+'\t'+(target_filename + "_psf_config.txt")+'   '+'psf config')
-    if psf_:
-        print('- '+get_time(target_filename + "_psf_model.fits")+'\t'+(target_filename + "_psf_model.fits")+'   '+'psf model FITS')
-    if c_:
-        print('- '+get_time(target_filename + "_config.txt")+'\t'+(target_filename + "_config.txt")+'       '+'model config')
-    if cst_:
-        print('- '+get_time(target_filename + "_constraint.txt")+'\t'+(target_filename + "_constraint.txt")+'   '+'model constraint')
-    if m_:
-        print('- '+get_time(target_filename + "_model.fits")+'\t'+(target_filename + "_model.fits")+'       '+'multi-band model FITS')
+    for name, description in DESCRIPTIONS.items():
+        if name not in data['artifacts']:
+            continue
+        entry = data['artifacts'][name]
+        saved_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry['mtime_ns'] / 1e9))
+        print(f"- {saved_time}\t{os.path.basename(entry['path']):<30} {description}")
+    library_status = psf.library.status(psf)
+    if library_status is not None:
+        print(f"\nPSF: {library_status}")
+    # Last run of each stage, to see where work left off
+    last_runs = {run['stage']: run for run in data['runs']}
+    if last_runs:
+        print("\nLast Runs:")
+    for stage, run in last_runs.items():
+        chi2nu = f"chi2nu {run['chi2nu']:.4f}" if run['chi2nu'] is not None else ''
+        print(f"- {run['started']}\t{stage:<15} {run['status']:<9} {run['seconds']:>8.1f}s  {chi2nu}")
     print()
     
 def visualize_target():
     '''
     Opens target image in ds9
     '''
-    d.set("fits new " + target_path)
-    d.set("tile no")
-    d.set("cmap 1 0.5")
-    d.set("scale mode 99.5")
-    d.set("zoom to fit")
+    d.show(target_path)
 
 def visualize_target_rgb():
     '''
@@ -207,12 +256,9 @@ def edit_zero_point():
     '''
     Changes zero point saved in file
     '''
-    zero_point = input('What is the zero point of the image? Input number and hit enter > ')
+    zero_point = prompt('What is the zero point of the image? Input number and hit enter > ')
     # Write to zero point file for future reference
-    zero_point_file = open(path_to_output + 'zero_point.txt', 'w')
-    zero_point_file.write(zero_point)
-    zero_point_file.close()
-    zero_point = float(zero_point)
+    zero_point = write_zero_point(path_to_output, zero_point)
     psf.zero_point = zero_point
     sersic.zero_point = zero_point
 
@@ -222,6 +268,37 @@ def psf_write_config():
     '''
     psf.write_config(d)
 
+def region_input() -> str|None:
+    '''
+    Prompts for a ds9 region file or JSON region file and reads it
+
+    Returns: region string, or None if it could not be read
+    '''
+    path = prompt('Path to region file (.reg or .json) > ').strip()
+    try:
+        return read_regions(path)
+    except (OSError, ValueError) as error:
+        print(f'\nCould not read regions: {error}\n')
+        return None
+
+def psf_create_file():
+    '''
+    psf create file - makes new psf from a region file with a circle for the
+    star and a box for frame, without ds9
+    '''
+    regions = region_input()
+    if regions is not None and psf.fit(regions):
+        print('\nPSF model saved. Review it with psf visualize\n')
+
+def psf_auto():
+    '''
+    psf auto - makes new psf from the best of the brightest isolated stars,
+    without placing regions
+    '''
+    answer = prompt(f'Number of candidate stars to fit (enter for {AUTO_CANDIDATES}) > ').strip()
+    if psf.auto_fit(int(answer) if answer.isdigit() else AUTO_CANDIDATES):
+        print('Review it with psf visualize\n')
+
 def psf_visualize():
     '''
     Opens psf in ds9 if psf exists
@@ -241,12 +318,74 @@ def psf_upload():
     psf_file = my_filebrowser()
     psf.upload_psf(psf_file)
 
+def psf_library_add():
+    '''
+    Adds this target's psf to the library, for targets from the same
+    exposure and CCD (or group id) to reuse
+    '''
+    group = prompt('PSF group id (blank to match by exposure and CCD in header) > ').strip()
+    entry = psf.library.add(psf, group or None)
+    if entry is not None:
+        print(f'\nAdded psf to library as {entry["key"]} (version {entry["version"]})\n')
+
+def psf_library_link():
+    '''
+    Links a compatible psf from the library in place of fitting one
+    '''
+    group = prompt('PSF group id (blank to match by exposure and CCD in header) > ').strip()
+    entry = psf.library.find(psf, group or None)
+    if entry is None:
+        print('\nNo compatible psf in library. Create one with psf create, then psf library add\n')
+    elif entry['source'] == psf.ouput_dir:
+        print('\nThis target is the source of that library psf\n')
+    else:
+        psf.library.link(psf, entry)
+        print(f'\nLinked psf {entry["key"]} (version {entry["version"]}) from {entry["source_target"]}\n')
+
+def psf_library_list():
+    '''
+    Lists psfs in the library and where this target's psf comes from
+    '''
+    entries = psf.library.load()
+    if not entries:
+        print('\nPSF library is empty\n')
+        return
+    print('\nPSF library:')
+    for entry in entries.values():
+        print(f'- {entry["key"]:<40} v{entry["version"]}  from {entry["source_target"]:<20} '
+              f'{len(entry["links"])} linked  {entry["added"]}')
+    status = psf.library.status(psf)
+    print(f'\nThis target: {status or "not using the library"}\n')
+
 def sersic_create_config():
     '''
     Create overall config using regions
     '''
     sersic.create_config(d)
 
+def sersic_create_config_file():
+    '''
+    Creates overall config from a region file, without ds9
+    '''
+    if psf.model_file is None:
+        print('\nPlease create or upload psf first\n')
+        return
+    regions = region_input()
+    if regions is not None:
+        sersic.make_config(regions)
+        print('\nConfig written. Fit it with sersic optimize config\n')
+
+def sersic_seed_config():
+    '''
+    Creates overall config from sources found in a fitting box, without
+    placing regions
+    '''
+    answer = prompt('Fitting box as xmin xmax ymin ymax (enter for whole image) > ').split()
+    if answer and (len(answer) != 4 or not all(value.isdigit() for value in answer)):
+        print('\nPlease give four pixel numbers\n')
+    elif sersic.auto_config([int(value) for value in answer] if answer else None):
+        print('Check it with sersic visualize regions, fit it with sersic optimize config\n')
+
 def sersic_add_constraint():
     '''
     Creates constraint file for sersic config
@@ -265,6 +404,19 @@ def sersic_edit_config():
     '''
     sersic.edit_config(d)
 
+def sersic_edit_config_file():
+    '''
+    Rewrites config from an edited region file, without ds9, keeping fitted
+    magnitudes of existing components
+    '''
+    if sersic.config_file is None:
+        print('\nPlease create config file first\n')
+        return
+    regions = region_input()
+    if regions is not None:
+        sersic.edit_regions(regions)
+        print('\nConfig rewritten. Fit it with sersic optimize config\n')
+
 def sersic_optimize():
     '''
     Run existing model config through galfit
@@ -339,13 +491,12 @@ def sersic_upload_constraint():
 def mult_fits():
     '''
     Specialty function for DELVE data. Multiplies data by 10000 and adjusts
-    header
+    header, through the delve preset of preprocess.py. Already multiplied
+    targets are left alone
     '''
-    data, header = fits.getdata(target_path, header=True)
-    header['EXPTIME'] = 1.0
-    header['GAIN'] = 1.0
-    data = data*10000
-    fits.writeto(target_path, data, header, overwrite=True)
+    from preprocess import preprocess, PRESETS
+    if not preprocess(target_path, target_path, PRESETS['delve']):
+        print('\nTarget was already multiplied\n')
 
 def sersic_calc_mag():
     '''
@@ -363,6 +514,121 @@ def sersic_redo_psf():
     sersic.optimize_config_(d)
     print("DONE")
 
+def toggle_background():
+    '''
+    Toggles running psf create, sersic optimize config and sersic produce
+    config as background jobs
+    '''
+    global queue
+    if queue is None:
+        queue = JobQueue()
+    if psf.queue is None:
+        psf.queue = queue
+        sersic.queue = queue
+        print('\nGalfit runs will now run in the background. Results are reviewed at the next prompt\n')
+    else:
+        psf.queue = None
+        sersic.queue = None
+        print('\nGalfit runs will now run in the foreground\n')
+
+def get_job():
+    '''
+    Prompts user for job number
+
+    Returns: job number, None if blank or invalid
+    '''
+    if queue is None or not queue.jobs:
+        print('\nNo jobs submitted. Type background to run galfit in the background\n')
+        return None
+    job_id = prompt('Job number > ').strip()
+    if job_id == '':
+        return None
+    if not job_id.isdigit() or queue.get(int(job_id)) is None:
+        print('\nNo job with that number\n')
+        return None
+    return int(job_id)
+
+def job_list():
+    '''
+    Lists background jobs and their status
+    '''
+    if queue is None or not queue.jobs:
+        print('\nNo jobs submitted. Type background to run galfit in the background\n')
+        return
+    print('\n id  status       time  command (target)')
+    for job in queue.jobs.values():
+        print(job.describe())
+    print()
+
+def job_wait():
+    '''
+    Waits for a background job, or all of them, to finish
+    '''
+    if queue is None or not queue.jobs:
+        print('\nNo jobs submitted. Type background to run galfit in the background\n')
+        return
+    job_id = prompt('Job number (blank for all) > ').strip()
+    if job_id != '' and (not job_id.isdigit() or queue.get(int(job_id)) is None):
+        print('\nNo job with that number\n')
+        return
+    print('\nWaiting...')
+    queue.wait(int(job_id) if job_id else None)
+
+def job_cancel():
+    '''
+    Cancels a background job
+    '''
+    job_id = get_job()
+    if job_id is not None:
+        queue.cancel(job_id)
+        print(f'\nCancelled job {job_id}\n')
+
+def job_info():
+    '''
+    Prints details of a background job
+    '''
+    job_id = get_job()
+    if job_id is not None:
+        print()
+        print(queue.get(job_id).info())
+        print()
+
+def index_query():
+    '''
+    Runs a saved query or SQL on the index of all targets
+    '''
+    print_queries()
+    sql = prompt('Query name or SQL > ').strip()
+    if sql == '':
+        return
+    args = []
+    if '?' in workspace_index.QUERIES.get(sql, (sql,))[0]:
+        args = [prompt('Value (e.g. flag 2) > ').strip()]
+    if not os.path.exists(workspace_index.index_path(root_output)):
+        index_rebuild()
+    try:
+        print_table(*workspace_index.query(root_output, sql, args))
+    except sqlite3.Error as error:
+        print(f'\nQuery failed: {error}\n')
+
+def index_rebuild():
+    '''
+    Rebuilds the index of all targets from their manifests
+    '''
+    print('\nIndexing targets...')
+    print(f'\nIndexed {workspace_index.rebuild(root_output)} targets\n')
+
+def open_ds9() -> Display:
+    '''
+    Opens ds9 with an empty frame list
+
+    Returns: ds9 display
+    '''
+    import pyds9
+    d = Display(DS9Proxy(pyds9.DS9()))
+    d.set("frame delete all")
+    return d
+
 if __name__ == '__main__':
     # Commands that if called, trigger ds9 to open
     ds9_commands = ['target visualize', 'target v', 'tv',
@@ -380,11 +646,29 @@ if __name__ == '__main__':
                     'sersic redo psf', 'srp']
     # Reads in paths from local config file. If none, prompts user for them
     path_to_galfit, path_to_output, galfit_output = get_paths()
-
-    if len(sys.argv) > 1:
-        if os.path.exists(sys.argv[1]):
+    root_output = path_to_output
+    # --profile dumps a cProfile file per command, --cutout runs galfit on
+    # cutouts of the fitting box instead of the full image
+    profile = '--profile' in sys.argv
+    galfit_run.CUTOUT = '--cutout' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ['--profile', '--cutout']]
+    # --psf-regions and --regions make configs from region files (.reg or
+    # .json) without ds9 or the tui, --regions auto seeds sources found in
+    # the image instead, --zero-point skips its prompt
+    options = {}
+    for option in ['--psf-regions', '--regions', '--zero-point']:
+        if option in args:
+            i = args.index(option)
+            if i + 1 >= len(args):
+                print(f'\nPlease give a value for {option}\n')
+                quit()
+            options[option] = args[i + 1]
+            del args[i:i+2]
+
+    if len(args) > 0:
+        if os.path.exists(args[0]):
             # Checks for input path to target
-            target_path = sys.argv[1]
+            target_path = args[0]
         else:
             print('\nPlease input a valid target path!\n')
             quit()
@@ -395,89 +679,79 @@ if __name__ == '__main__':
     if target_path[-5:] != '.fits':
         print('Error: please upload .fits type target file\n')
         quit()
-    # Make path to directory for target
-    target_filename = os.path.basename(target_path)[:-5]
-    path_to_output = os.path.join(path_to_output, target_filename, '')
-    # Check if output directory for this file already exists
-    if not os.path.exists(path_to_output):
-        # Should only happen when user manually changes path_config.txt
-        os.makedirs(path_to_output)
-    # Copy target file to output dir
-    if not os.path.exists(path_to_output + os.path.basename(target_path)):
-        shutil.copyfile(target_path, path_to_output + os.path.basename(target_path))
-    target_path = path_to_output + os.path.basename(target_path)
-    # Initialize possible data as None
-    psf_config_file = None
-    psf_config_output_file = None
-    psf_model_file = None
-    psf_mask = None
-    sersic_config_file = None
-    sersic_config_output_file = None
-    sersic_constraint = None
-    sersic_mask = None
+    # Make directory for target and copy target file to it
+    target_path, target_filename, path_to_output = init_target(target_path, path_to_output)
     # Check for zero point file
-    if not os.path.exists(path_to_output + 'zero_point.txt'):
+    if '--zero-point' in options:
+        write_zero_point(path_to_output, options['--zero-point'])
+    zero_point = read_zero_point(path_to_output)
+    if zero_point is None:
         zero_point = input('What is the zero point of the image? Input number and hit enter > ')
-        # Write to zero point file for future reference
-        zero_point_file = open(path_to_output + 'zero_point.txt', 'w')
-        zero_point_file.write(zero_point)
-        zero_point_file.close()
-        zero_point = float(zero_point)
-    else:
-        # Load in zero point info
-        zero_point_file = open(path_to_output + 'zero_point.txt')
-        zero_point = zero_point_file.readlines()
-        zero_point = float(zero_point[0])
+        zero_point = write_zero_point(path_to_output, zero_point)
     # Check for any saved data in output dir and add path for it
-    files = os.listdir(path_to_output)
-    for file in files:
-        if file == target_filename + '_psf_config.txt':
-            psf_config_file = path_to_output + file
-
-        if file == target_filename + '_psf.fits':
-            psf_config_output_file = path_to_output + file
-
-        if file == target_filename + '_psf_model.fits':
-            psf_model_file = path_to_output + file
-
-        if file == target_filename + '_psf_mask.fits':
-            psf_mask = path_to_output + file
-
-        if file == target_filename + '_config.txt':
-            sersic_config_file = path_to_output + file
-
-        if file == target_filename + '_model.fits':
-            sersic_config_output_file = path_to_output + file
-
-        if file == target_filename + '_constraint.txt':
-            sersic_constraint = path_to_output + file
-
-        if file == target_filename + '_mask.fits':
-            sersic_mask = path_to_output + file
+    saved = saved_files(path_to_output, target_filename)
         
     # Initialize psf and sersic objects
     psf = PSF('?', target_path, path_to_output, path_to_galfit,
-                target_filename, zero_point, psf_config_file,
-                psf_config_output_file, psf_model_file, psf_mask)
+                target_filename, zero_point, saved['psf_config_file'],
+                saved['psf_config_output_file'], saved['psf_model_file'],
+                saved['psf_mask'])
     sersic = Sersic('?', target_path, path_to_output, path_to_galfit,
-                target_filename, zero_point, sersic_config_file,
-                sersic_config_output_file, sersic_mask, sersic_constraint, psf)
+                target_filename, zero_point, saved['sersic_config_file'],
+                saved['sersic_config_output_file'], saved['sersic_mask'],
+                saved['sersic_constraint'], psf)
+    # Every command is timed into a log in the target output dir
+    timing_log = path_to_output + 'timing.jsonl'
+    profile_dir = path_to_output + 'profiles/' if profile else None
+
+    if '--psf-regions' in options or '--regions' in options:
+        with command('regions', timing_log, profile_dir):
+            try:
+                if '--psf-regions' in options and not psf.fit(read_regions(options['--psf-regions'])):
+                    quit()
+                if '--regions' in options:
+                    if psf.model_file is None:
+                        print('\nPlease create or upload psf first\n')
+                        quit()
+                    if options['--regions'] != 'auto':
+                        sersic.make_config(read_regions(options['--regions']))
+                    elif not sersic.auto_config():
+                        quit()
+                    print(f'\nWrote {sersic.config_file}\n')
+            except (OSError, ValueError) as error:
+                print(f'\nCould not read regions: {error}\n')
+        quit()
 
     # Initialize event loop
     print('\nWelcome to galfit wrapper. Type help for assistance\n')
     software_open = True
     ds9_open = False
+    queue = None
     # Begin event loop
     while software_open:
+        # Review any background jobs that finished, which needs ds9
+        if queue is not None and queue.finished():
+            with command('job review', timing_log, profile_dir):
+                if ds9_open:
+                    d.sync()
+                if not ds9_open:
+                    ds9_open = True
+                    d = open_ds9()
+                queue.review(d)
         action = input(' > ')
-        if not ds9_open:
-            if action in ds9_commands:
-                ds9_open = True
-                d = pyds9.DS9()
-                d.set("frame delete all")
         if action == ('quit') or action == ('exit'):
             software_open = False
+            if queue is not None:
+                queue.shutdown()
             if ds9_open:
                 d.set('exit')
-        else:
+            continue
+        with command(action, timing_log, profile_dir):
+            # User may have changed ds9 by hand since the last command
+            if ds9_open:
+                d.sync()
+            if not ds9_open:
+                if action in ds9_commands:
+                    ds9_open = True
+                    d = open_ds9()
             take_action(action)
@@ -0,0 +1,216 @@
+# Background galfit job queue for galfit wrapper TUI
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from galfit_run import GalfitRun
+
+# Galfit runs are single threaded processes, so allow one per core
+MAX_JOBS = os.cpu_count()
+
+class Job():
+    '''
+    Class for a galfit run submitted to the background queue.
+
+    Attributes:
+        id: job number
+        name: command that submitted the job
+        target_filename: filename of target
+        galfit_run: GalfitRun being executed
+        review: function called with ds9 instance once job completes
+        future: future of the run in the executor
+        submitted: time job was submitted
+        started: time galfit started, None while queued
+        finished: time galfit finished, None until done
+        reviewed: True once review has been done
+
+    Methods:
+        execute: runs galfit
+        status: gets current state of job
+        elapsed: gets seconds galfit has been running
+        describe: gets one-line description of job
+        info: gets multi-line details of job
+    '''
+    def __init__(self, id: int, name: str, target_filename: str,
+                 galfit_run: GalfitRun, review):
+        self.id = id
+        self.name = name
+        self.target_filename = target_filename
+        self.galfit_run = galfit_run
+        self.review = review
+        self.future = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.reviewed = False
+
+    def execute(self) -> None:
+        '''
+        Runs galfit, recording timing. Called from executor thread
+        '''
+        self.started = time.time()
+        try:
+            self.galfit_run.run()
+        finally:
+            self.finished = time.time()
+
+    def status(self) -> str:
+        '''
+        Returns: queued, running, cancelled, failed, done or reviewed
+        '''
+        if self.future.cancelled() or self.galfit_run.cancelled:
+            return 'cancelled'
+        if not self.future.done():
+            return 'running' if self.started is not None else 'queued'
+        if self.future.exception() is not None:
+            return 'failed'
+        # Review moves output out of the run directory
+        if self.reviewed:
+            return 'reviewed'
+        return 'done' if self.galfit_run.has_fits() else 'failed'
+
+    def elapsed(self) -> float:
+        '''
+        Returns: seconds galfit has been running
+        '''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def describe(self) -> str:
+        '''
+        Returns: one-line description of job
+        '''
+        progress = ''
+        if self.galfit_run.iteration is not None:
+            progress = f'  [iter {self.galfit_run.iteration}, chi2nu {self.galfit_run.chi2nu:.4g}]'
+        return f'{self.id:>3}  {self.status():<9} {self.elapsed():>7.1f}s  {self.name} ({self.target_filename}){progress}'
+
+    def info(self) -> str:
+        '''
+        Returns: multi-line details of job
+        '''
+        lines = [f'job {self.id}: {self.name}',
+                 f'- target: {self.target_filename}',
+                 f'- status: {self.status()}',
+                 f'- submitted: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.submitted))}',
+                 f'- galfit time: {self.elapsed():.1f}s',
+                 f'- config: {self.galfit_run.config_file}',
+                 f'- run directory: {self.galfit_run.run_dir}',
+                 f'- cached result: {self.galfit_run.cached}',
+                 f'- return code: {self.galfit_run.returncode}',
+                 f'- iteration: {self.galfit_run.iteration}',
+                 f'- chi2nu: {self.galfit_run.chi2nu}',
+                 f'- log file: {self.galfit_run.log_file}']
+        if self.galfit_run.stopped is not None:
+            lines.append(f'- killed: {self.galfit_run.stopped}')
+        if self.future.done() and not self.future.cancelled() and self.future.exception() is not None:
+            lines.append(f'- error: {self.future.exception()}')
+        return '\n'.join(lines)
+
+class JobQueue():
+    '''
+    Class to run galfit jobs in background threads while the TUI keeps
+    taking commands.
+
+    Attributes:
+        executor: thread pool running jobs
+        jobs: dict of job number -> Job
+
+    Methods:
+        submit: submits a galfit run
+        get: gets job by number
+        finished: gets completed jobs waiting for review
+        review: runs review of completed jobs
+        wait: blocks until a job completes
+        cancel: cancels a job
+        shutdown: cancels all jobs and stops executor
+    '''
+    def __init__(self, max_jobs: int =MAX_JOBS):
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self.jobs = {}
+        self.next_id = 1
+
+    def submit(self, name: str, target_filename: str, galfit_run: GalfitRun,
+               review) -> Job:
+        '''
+        Submits galfit run to background. Galfit output only goes to the
+        run's log file so it does not interleave with the prompt
+
+        Args:
+            name: command submitting the job
+            target_filename: filename of target
+            galfit_run: GalfitRun to execute
+            review: function called with ds9 instance once job completes
+
+        Returns: submitted job
+        '''
+        galfit_run.quiet = True
+        job = Job(self.next_id, name, target_filename, galfit_run, review)
+        self.next_id += 1
+        job.future = self.executor.submit(job.execute)
+        job.future.add_done_callback(lambda _: print(f'\n[job {job.id} {job.status()}: {job.name}]'))
+        self.jobs[job.id] = job
+        print(f'\nSubmitted job {job.id}: {name}\n')
+        return job
+
+    def get(self, id: int) -> Job|None:
+        '''
+        Returns: job with given number, or None
+        '''
+        return self.jobs.get(id)
+
+    def finished(self) -> list[Job]:
+        '''
+        Returns: jobs that completed and have not been reviewed, in order
+        '''
+        return [job for job in self.jobs.values()
+                if job.future.done() and not job.reviewed]
+
+    def review(self, d) -> None:
+        '''
+        Runs review (display and prompts) of each completed job, in order
+
+        Args:
+            d: pyds9 DS9 instance
+
+        Returns: Nothing
+        '''
+        for job in self.finished():
+            status = job.status()
+            job.reviewed = True
+            if status == 'cancelled':
+                job.galfit_run.cleanup()
+                continue
+            print(f'\nJob {job.id} finished: {job.name} ({job.target_filename})')
+            job.review(d)
+
+    def wait(self, id: int|None =None) -> None:
+        '''
+        Blocks until job completes, or all jobs if no number given
+        '''
+        jobs = self.jobs.values() if id is None else [self.jobs[id]]
+        for job in jobs:
+            if not job.future.cancelled():
+                job.future.exception()
+
+    def cancel(self, id: int) -> None:
+        '''
+        Cancels queued job or stops running galfit
+        '''
+        job = self.jobs[id]
+        if not job.future.cancel():
+            job.galfit_run.cancel()
+
+    def shutdown(self) -> None:
+        '''
+        Cancels all jobs and stops executor
+        '''
+        for job in self.jobs.values():
+            if not job.future.done():
+                self.cancel(job.id)
+        self.executor.shutdown(wait=True)
+        for job in self.jobs.values():
+            if not job.reviewed:
+                job.galfit_run.cleanup()
@@ -0,0 +1,309 @@
+# Per-target manifest of saved artifacts and galfit run history
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import json
+import time
+import fcntl
+import tempfile
+import contextlib
+import timing
+import workspace_index
+from galfit_cache import file_hash
+
+# Manifest file kept in each target output directory
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+# Artifacts tracked for a target, by filename suffix
+ARTIFACTS = {'target': '.fits',
+             'psf_config_file': '_psf_config.txt',
+             'psf_config_output_file': '_psf.fits',
+             'psf_model_file': '_psf_model.fits',
+             'psf_mask': '_psf_mask.fits',
+             'sersic_config_file': '_config.txt',
+             'sersic_config_output_file': '_model.fits',
+             'sersic_constraint': '_constraint.txt',
+             'sersic_mask': '_mask.fits',
+             'sersic_model_prod': '_model_prod.fits'}
+# Descriptions of artifacts shown by target list
+DESCRIPTIONS = {'target': 'original file',
+                'psf_config_file': 'psf config',
+                'psf_config_output_file': 'psf galfit output FITS',
+                'psf_model_file': 'psf model FITS',
+                'psf_mask': 'psf mask',
+                'sersic_config_file': 'model config',
+                'sersic_config_output_file': 'multi-band model FITS',
+                'sersic_constraint': 'model constraint',
+                'sersic_mask': 'model mask',
+                'sersic_model_prod': 'produced model FITS'}
+# Files larger than this (e.g. big targets) are tracked by size and mtime only
+HASH_MAX_BYTES = 256 * 1024**2
+# Runs kept in history, oldest dropped first
+MAX_RUNS = 1000
+# Target header keywords naming the band, in order of preference
+BAND_KEYWORDS = ['FILTER', 'BAND', 'FILTNAM']
+
+class Manifest():
+    '''
+    Class for the manifest of a target output directory: a JSON file of
+    saved artifacts (path, size, mtime, content hash) and the history of
+    galfit runs. Startup and target list read it instead of scanning the
+    directory, and it is the record of where interrupted work left off.
+
+    Every change is a locked read-modify-write, written to a temporary file
+    and moved over the manifest, so concurrent writers (background jobs,
+    batch workers) never lose each other's updates or leave it half written.
+    A missing or unreadable manifest is rebuilt from the files on disk.
+    Every write is passed on to the workspace index of all targets.
+
+    Attributes:
+        output_dir: target output directory
+        target_filename: filename of target
+        path: path to manifest file
+
+    Methods:
+        load: reads manifest, rebuilding it if needed
+        update: locked read-modify-write of manifest inside a with block
+        rebuild: makes manifest contents from files on disk
+        record: records artifacts as saved, or as removed
+        record_run: adds a finished galfit run to the history
+        saved: gets path of each saved artifact
+        runs: gets run history
+    '''
+    def __init__(self, output_dir: str, target_filename: str):
+        self.output_dir = output_dir
+        self.target_filename = target_filename
+        self.path = os.path.join(output_dir, MANIFEST_FILE)
+
+    def load(self) -> dict:
+        '''
+        Reads manifest, rebuilding and writing it if missing or unreadable
+
+        Returns: manifest dict
+        '''
+        data = self.read()
+        if data is None:
+            with self.update() as data:
+                pass
+        return data
+
+    def read(self) -> dict|None:
+        '''
+        Returns: manifest dict, or None if missing or unreadable
+        '''
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as manifest:
+                data = json.load(manifest)
+        except (OSError, ValueError):
+            print(f'\nManifest {self.path} is unreadable, rebuilding it from disk\n')
+            return None
+        if data.get('version') != MANIFEST_VERSION:
+            return None
+        return data
+
+    @contextlib.contextmanager
+    def update(self):
+        '''
+        Locks manifest and yields its contents to be changed in place. The
+        changes are written atomically when the with block ends, and
+        dropped if it raises
+        '''
+        with timing.span('manifest'), locked(self.path):
+            data = self.read()
+            if data is None:
+                data = self.rebuild()
+            n_runs = len(data['runs'])
+            yield data
+            new_runs = data['runs'][n_runs:]
+            data['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            data['runs'] = data['runs'][-MAX_RUNS:]
+            write_json(self.path, data)
+            workspace_index.update_target(self.output_dir, data, new_runs)
+
+    def rebuild(self) -> dict:
+        '''
+        Makes manifest contents from the artifacts found on disk. Run
+        history cannot be recovered, so it starts empty
+
+        Returns: manifest dict
+        '''
+        data = {'version': MANIFEST_VERSION, 'target': self.target_filename,
+                'band': None, 'updated': None, 'artifacts': {}, 'runs': []}
+        files = os.listdir(self.output_dir)
+        for name, suffix in ARTIFACTS.items():
+            if self.target_filename + suffix in files:
+                path = os.path.join(self.output_dir, self.target_filename + suffix)
+                data['artifacts'][name] = artifact(path)
+        if 'target' in data['artifacts']:
+            data['band'] = read_band(data['artifacts']['target']['path'])
+        return data
+
+    def record(self, *names: str) -> None:
+        '''
+        Records artifacts as saved, with their current size, mtime and hash.
+        Artifacts whose file does not exist are recorded as removed
+
+        Args:
+            names: artifact names, e.g. 'psf_config_file'
+
+        Returns: Nothing
+        '''
+        with self.update() as data:
+            for name in names:
+                file = os.path.join(self.output_dir, self.target_filename + ARTIFACTS[name])
+                if os.path.exists(file):
+                    data['artifacts'][name] = artifact(file)
+                else:
+                    data['artifacts'].pop(name, None)
+
+    def record_run(self, stage: str, galfit_run) -> None:
+        '''
+        Adds a finished galfit run to the history. Call before its output
+        is moved or cleaned up, so its flags can be read
+
+        Args:
+            stage: what the run was for, e.g. 'psf', 'sersic', 'sersic produce'
+            galfit_run: finished GalfitRun
+
+        Returns: Nothing
+        '''
+        if galfit_run.stopped is not None:
+            status = 'killed'
+        elif galfit_run.cancelled:
+            status = 'cancelled'
+        elif galfit_run.has_fits():
+            status = 'done'
+        else:
+            status = 'failed'
+        run = {'stage': stage, 'config': galfit_run.config_file,
+               'options': galfit_run.options,
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(galfit_run.started))
+                          if galfit_run.started is not None else None,
+               'seconds': round(galfit_run.elapsed(), 3), 'status': status,
+               'returncode': galfit_run.returncode, 'cached': galfit_run.cached,
+               'iteration': galfit_run.iteration, 'chi2nu': galfit_run.chi2nu,
+               'stopped': galfit_run.stopped, 'log': galfit_run.log_file,
+               'flags': read_flags(galfit_run.output_fits) if status == 'done' else None}
+        with self.update() as data:
+            data['runs'].append(run)
+
+    def saved(self) -> dict[str, str|None]:
+        '''
+        Gets saved artifacts from the manifest. Only the recorded paths are
+        checked, in case a file was deleted by hand
+
+        Returns: dict of artifact name -> path, or None if not saved
+        '''
+        saved = dict.fromkeys(ARTIFACTS)
+        for name, entry in self.load()['artifacts'].items():
+            if os.path.exists(entry['path']):
+                saved[name] = entry['path']
+        return saved
+
+    def runs(self, stage: str|None =None) -> list[dict]:
+        '''
+        Gets run history, oldest first
+
+        Args:
+            stage: only runs of this stage, or all if None
+
+        Returns: list of run dicts
+        '''
+        return [run for run in self.load()['runs'] if stage is None or run['stage'] == stage]
+
+def artifact(path: str) -> dict:
+    '''
+    Gets manifest entry of a file: path, size, mtime and sha256 (None past
+    HASH_MAX_BYTES)
+    '''
+    stat = os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_hash(path) if stat.st_size <= HASH_MAX_BYTES else None}
+
+def read_flags(output_fits: str|None) -> list[str]|None:
+    '''
+    Reads galfit FLAGS from the model header of a galfit output, None if
+    it cannot be read
+    '''
+    if output_fits is None or not os.path.exists(output_fits):
+        return None
+    from astropy.io import fits
+    try:
+        with timing.span('fits_read'):
+            header = fits.getheader(output_fits, 2)
+    except (OSError, IndexError):
+        return None
+    return str(header.get('FLAGS', '')).split()
+
+@contextlib.contextmanager
+def locked(path: str):
+    '''
+    Holds an exclusive lock on path (through a .lock file next to it) inside
+    the with block, across threads and processes
+    '''
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def write_json(path: str, data) -> None:
+    '''
+    Writes JSON to a temporary file and moves it over path, so readers
+    never see it half written
+    '''
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '_',
+                                     dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as temp:
+            json.dump(data, temp, indent=1)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def read_band(path: str) -> str|None:
+    '''
+    Reads band of target from its primary header (see BAND_KEYWORDS)
+
+    Returns: band, or None if not in header
+    '''
+    values = read_cards(path)
+    for keyword in BAND_KEYWORDS:
+        if values.get(keyword):
+            return values[keyword]
+    return None
+
+def read_cards(path: str) -> dict[str, str]:
+    '''
+    Reads keyword values of a fits primary header as strings. The header
+    cards are parsed directly, so astropy is not loaded at startup
+
+    Returns: dict of keyword -> value
+    '''
+    values = {}
+    with open(path, 'rb') as fits_file:
+        # Headers are 2880 byte blocks of 80 character cards, ended by END
+        while 'END' not in values:
+            block = fits_file.read(2880)
+            if len(block) < 2880:
+                break
+            for i in range(0, 2880, 80):
+                card = block[i:i+80].decode('ascii', 'replace')
+                keyword = card[:8].strip()
+                if keyword == 'END':
+                    values['END'] = None
+                    break
+                if card[8:10] != '= ':
+                    continue
+                value = card[10:].strip()
+                if value.startswith("'"):
+                    value = value[1:].split("'")[0]
+                else:
+                    value = value.split('/')[0]
+                values[keyword] = value.strip()
+    values.pop('END', None)
+    return values
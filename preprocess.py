@@ -0,0 +1,240 @@
+# Chunked preprocessing of target images before fitting
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# numpy and astropy are imported where used
+
+# Rows are read, processed and written this many bytes at a time, so images
+# of any size are preprocessed in bounded memory
+CHUNK_BYTES = 64 * 1024**2
+# Header keyword holding the hash of the steps an image was preprocessed with
+PROVENANCE_HASH = 'PREPHASH'
+# Named step chains. delve is what mult fits used to do to DELVE cutouts
+PRESETS = {'delve': [{'step': 'scale', 'factor': 10000},
+                     {'step': 'header', 'EXPTIME': 1.0, 'GAIN': 1.0}],
+           'counts': [{'step': 'clean'},
+                      {'step': 'units', 'to': 'counts'},
+                      {'step': 'defaults', 'GAIN': 1.0}]}
+
+def scale_step(header, factor: float):
+    '''
+    Multiplies pixels by factor
+    '''
+    return lambda data: data * factor
+
+def units_step(header, to: str):
+    '''
+    Converts pixels between counts/s and counts using the EXPTIME header
+    keyword, recording the new unit in BUNIT. Nothing is done if BUNIT
+    already is the unit asked for
+    '''
+    units = {'counts': 'COUNTS', 'counts/s': 'COUNTS/S'}
+    if to not in units:
+        raise ValueError(f'units: unknown unit {to!r}, expected one of {", ".join(units)}')
+    if str(header.get('BUNIT', '')).upper().replace(' ', '') == units[to]:
+        return None
+    if not header.get('EXPTIME'):
+        raise ValueError('units: image has no EXPTIME to convert with')
+    exptime = float(header['EXPTIME'])
+    header['BUNIT'] = units[to]
+    if to == 'counts':
+        return lambda data: data * exptime
+    return lambda data: data / exptime
+
+def header_step(header, **cards):
+    '''
+    Sets header keywords, replacing existing values
+    '''
+    for key, value in cards.items():
+        header[key] = value
+    return None
+
+def defaults_step(header, **cards):
+    '''
+    Sets header keywords that are missing
+    '''
+    for key, value in cards.items():
+        if key not in header:
+            header[key] = value
+    return None
+
+def clean_step(header, value: float =0.0):
+    '''
+    Replaces NaN and infinite pixels with value
+    '''
+    import numpy as np
+    return lambda data: np.where(np.isfinite(data), data, value)
+
+# Step name -> function(header, **params). A step edits the output header
+# in place and returns a function applied to every chunk of rows, or None
+# if it leaves pixels alone
+STEPS = {'scale': scale_step, 'units': units_step, 'header': header_step,
+         'defaults': defaults_step, 'clean': clean_step}
+
+def read_steps(steps: str|list[dict]) -> list[dict]:
+    '''
+    Gets step chain from a preset name, a .json file or a list of steps
+    such as
+        [{"step": "clean", "value": 0}, {"step": "units", "to": "counts"},
+         {"step": "scale", "factor": 10000}, {"step": "defaults", "GAIN": 1.0}]
+
+    Args:
+        steps: preset name, path to .json file, or list of steps
+
+    Returns: list of steps
+    '''
+    if isinstance(steps, str):
+        if steps in PRESETS:
+            return PRESETS[steps]
+        with open(os.path.expanduser(steps)) as steps_file:
+            steps = json.load(steps_file)
+    for i, step in enumerate(steps):
+        if step.get('step') not in STEPS:
+            raise ValueError(f'step {i}: unknown step {step.get("step")!r}, '
+                             f'expected one of {", ".join(STEPS)}')
+    return steps
+
+def steps_hash(steps: list[dict]) -> str:
+    '''
+    Returns: hash of a step chain
+    '''
+    return hashlib.sha1(json.dumps(steps, sort_keys=True).encode()).hexdigest()
+
+def preprocess(input_file: str, output_file: str, steps: list[dict]) -> bool:
+    '''
+    Applies a step chain to the primary image of a fits file, streaming it
+    through in chunks of rows. The output header records the steps (as
+    HISTORY cards), source file and time, and the hash of the steps, so
+    files that were already preprocessed with the same steps are skipped.
+    Output is written to a temporary file and moved into place, so input
+    and output may be the same file
+
+    Args:
+        input_file: fits image to preprocess
+        output_file: path to write preprocessed image to
+        steps: step chain (see read_steps)
+
+    Returns: True if written, False if skipped as already preprocessed
+    '''
+    import numpy as np
+    from astropy.io import fits
+    sha = steps_hash(steps)
+    same = os.path.exists(output_file) and os.path.samefile(input_file, output_file)
+    if os.path.exists(output_file) and fits.getheader(output_file).get(PROVENANCE_HASH) == sha \
+       and (same or os.path.getmtime(output_file) >= os.path.getmtime(input_file)):
+        return False
+    temp_file = output_file + '.preprocess.tmp'
+    with fits.open(input_file) as hdul:
+        header = hdul[0].header.copy()
+        ny, nx = header['NAXIS2'], header['NAXIS1']
+        operations = []
+        for step in steps:
+            params = {key: value for key, value in step.items() if key != 'step'}
+            operation = STEPS[step['step']](header, **params)
+            if operation is not None:
+                operations.append(operation)
+        # Scaled pixels are floats, keep double precision inputs as they are
+        dtype = np.float64 if header['BITPIX'] == -64 else np.float32
+        header['BITPIX'] = -64 if dtype == np.float64 else -32
+        for key in ['BSCALE', 'BZERO', 'BLANK']:
+            header.remove(key, ignore_missing=True)
+        header[PROVENANCE_HASH] = (sha, 'steps hash')
+        header['PREPSRC'] = (os.path.basename(input_file), 'preprocessed from')
+        header['PREPDATE'] = (time.strftime('%Y-%m-%dT%H:%M:%S'), 'preprocessed at')
+        for step in steps:
+            header.add_history('preprocess: ' + json.dumps(step, sort_keys=True))
+        rows = max(1, CHUNK_BYTES // (nx * np.dtype(dtype).itemsize))
+        try:
+            stream = fits.StreamingHDU(temp_file, header)
+            for y0 in range(0, ny, rows):
+                data = np.asarray(hdul[0].section[y0:y0 + rows], dtype=dtype)
+                for operation in operations:
+                    data = operation(data)
+                stream.write(data.astype(dtype, copy=False))
+            stream.close()
+            # Extensions other than the primary image are kept as they are
+            for hdu in hdul[1:]:
+                fits.append(temp_file, hdu.data, hdu.header)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+    os.replace(temp_file, output_file)
+    return True
+
+def output_path(input_file: str, output_dir: str|None, suffix: str) -> str:
+    '''
+    Returns: path preprocessed image of input_file is written to, in place
+             when there is no output directory or suffix
+    '''
+    directory = output_dir if output_dir is not None else os.path.dirname(input_file)
+    name, extension = os.path.splitext(os.path.basename(input_file))
+    return os.path.join(directory, name + suffix + extension)
+
+def preprocess_files(input_files: list[str], steps: list[dict], output_dir: str|None =None,
+                     suffix: str ='', workers: int =1) -> list[tuple[str, str]]:
+    '''
+    Preprocesses many fits files (e.g. every band of a tile of cutouts)
+    through a process pool
+
+    Args:
+        input_files: fits images to preprocess
+        steps: step chain (see read_steps)
+        output_dir: directory to write preprocessed images to, None for
+                    next to the inputs
+        suffix: added to output file names, e.g. '_prep'. With neither
+                output_dir nor suffix, inputs are preprocessed in place
+        workers: number of worker processes
+
+    Returns: list of (input file, 'written', 'skipped' or error), in
+             completion order
+    '''
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(preprocess, input_file, output_path(input_file, output_dir, suffix),
+                               steps): input_file for input_file in input_files}
+        for future in as_completed(futures):
+            try:
+                status = 'written' if future.result() else 'skipped'
+            except Exception as error:
+                status = f'{type(error).__name__}: {error}'
+            results.append((futures[future], status))
+            print(f'[{len(results)}/{len(input_files)}] {status} {os.path.basename(futures[future])}')
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess target images in chunks before fitting')
+    parser.add_argument('files', nargs='+', help='fits images or glob patterns')
+    parser.add_argument('-s', '--steps', default='delve',
+                        help=f'preset ({", ".join(PRESETS)}) or .json file of steps (default: delve)')
+    parser.add_argument('-d', '--output-dir', default=None,
+                        help='write preprocessed images here instead of in place')
+    parser.add_argument('--suffix', default='',
+                        help='add to output file names instead of preprocessing in place')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    input_files = sorted({path for pattern in args.files for path in glob.glob(os.path.expanduser(pattern))})
+    if not input_files:
+        sys.exit('No fits files found')
+    try:
+        steps = read_steps(args.steps)
+    except (OSError, ValueError) as error:
+        sys.exit(f'Could not read steps: {error}')
+    results = preprocess_files(input_files, steps, args.output_dir, args.suffix, args.workers)
+    failed = [(input_file, status) for input_file, status in results if status not in ['written', 'skipped']]
+    print(f'\n{len(results) - len(failed)}/{len(results)} files preprocessed\n')
+    for input_file, status in failed:
+        print('-', input_file, status)
+    if failed:
+        sys.exit(1)
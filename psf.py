@@ -1,11 +1,77 @@
 # Class for PSF models
 # Author: Paxson Swierc & Daniel Babnigg
 
-from astropy.io import fits
 import os
-from region_to_config import input_to_galfit
-import subprocess
+import math
 import shutil
+import hashlib
+from galfit_run import GalfitRun
+from galfit_config import GalfitConfig
+from manifest import Manifest
+from psf_library import PSFLibrary
+import timing
+# numpy, astropy and pyregion (through region_to_config) are imported where
+# used, so startup and headless commands do not pay for them
+
+# Default convolution box size, in multiples of the fitted moffat FWHM
+CONV_BOX_FWHM = 10
+# Default half-width in pixels of psf model stamps used by sersic fits
+STAMP_RADIUS = 25
+# Number of psf star candidates fitted by psf auto
+AUTO_CANDIDATES = 5
+# Scratch directory in target output directory for psf auto candidate fits
+AUTO_DIR = 'psf_auto'
+
+def psf_stamp(data: 'np.ndarray', radius: int) -> 'np.ndarray':
+    '''
+    Crops a psf image to a (2*radius+1) square stamp with its peak on the
+    central pixel, zero padding past the image edges, and normalises it to
+    unit sum
+
+    Args:
+        data: psf image
+        radius: half-width of stamp in pixels
+
+    Returns: psf stamp
+    '''
+    import numpy as np
+    data = np.nan_to_num(np.asarray(data, dtype=float))
+    peak_y, peak_x = np.unravel_index(np.argmax(data), data.shape)
+    size = 2 * radius + 1
+    stamp = np.zeros((size, size))
+    # Overlap of stamp with image
+    y0, x0 = peak_y - radius, peak_x - radius
+    ys, ye = max(0, y0), min(data.shape[0], y0 + size)
+    xs, xe = max(0, x0), min(data.shape[1], x0 + size)
+    stamp[ys-y0:ye-y0, xs-x0:xe-x0] = data[ys:ye, xs:xe]
+    total = stamp.sum()
+    if total > 0:
+        stamp /= total
+    return stamp
+
+def residual_score(output_fits: str) -> tuple[bool, float, float]:
+    '''
+    Scores a psf fit by its residuals, for ranking candidate stars. Lower is
+    better: fits galfit flagged for numerical convergence errors rank last,
+    then by fraction of the model flux left in the residual, then chi2nu
+
+    Args:
+        output_fits: galfit output (4 frames)
+
+    Returns: (convergence flag, residual fraction, chi2nu)
+    '''
+    import numpy as np
+    from astropy.io import fits
+    with timing.span('fits_read'), fits.open(output_fits, memmap=False) as hdul:
+        model = np.nan_to_num(hdul[2].data.astype(float))
+        residual = np.nan_to_num(hdul[3].data.astype(float))
+        header = hdul[2].header
+    # Model minimum is roughly the sky, so the rest is the star
+    flux = (model - model.min()).sum()
+    fraction = np.abs(residual - np.median(residual)).sum() / flux if flux > 0 else math.inf
+    chi2nu = header.get('CHI2NU')
+    return ('2' in str(header.get('FLAGS', '')).split(), float(fraction),
+            float(chi2nu) if chi2nu is not None else math.inf)
 
 class PSF():
     '''
@@ -22,17 +88,36 @@ class PSF():
         config_output_file: path to fits file outputted by galfit (4 frames)
         model_file: path to fits file with model frame from galfit output
         mask: path to mask fits file for galfit
+        conv_box: convolution box policy for fits using this psf. 'auto' sizes
+                  it from the fitted FWHM, 'full' uses the whole fitting box,
+                  and a number of pixels gives a fixed size
+        stamp_radius: half-width in pixels of the psf model stamp
+        queue: background job queue for galfit runs, None to run in foreground
+        manifest: manifest of target output directory, updated on every save
+        library: psf library shared by all targets in the root output directory
 
     Methods:
         write_config: creates galfit config file with ds9 
+        fit: creates and optimizes galfit config without ds9
+        auto_fit: finds psf stars and keeps the best of their fits, without ds9
+        make_config: writes galfit config file from ds9 regions
+        review_write: loads finished psf run into ds9 for review
+        run_config: runs galfit for current config file
+        collect_run: moves galfit output into place
+        save_model: saves galfit output as psf model
         visualize: opens up psf model in ds9
         upload_psf: copies uploaded psf model to dir and loads it to instance
+        unlink_library: stops using a psf linked from the library
+        write_stamp: writes cropped, centred and normalised psf model
         flags: prints flags from galfit model
+        fwhm: gets fitted FWHM of psf
+        convolution_box: gets convolution box size for sersic fits
     '''
     def __init__(self, filter: str, target_file: str, ouput_dir: str,
                  galfit_path: str, target_filename: str, zero_point: float,
                  config_file: str|None =None, config_output_file: str|None =None,
-                 model_file: str|None =None, mask: str|None =None):
+                 model_file: str|None =None, mask: str|None =None,
+                 conv_box: str|int ='auto', stamp_radius: int =STAMP_RADIUS):
         self.filter = filter
         self.target_file = target_file
         self.ouput_dir = ouput_dir
@@ -43,6 +128,11 @@ class PSF():
         self.config_output_file = config_output_file
         self.model_file = model_file
         self.mask = mask
+        self.conv_box = conv_box
+        self.stamp_radius = stamp_radius
+        self.queue = None
+        self.manifest = Manifest(ouput_dir, target_filename)
+        self.library = PSFLibrary(os.path.dirname(os.path.normpath(ouput_dir)))
 
     def write_config(self, d) -> None:
         '''
@@ -55,69 +145,210 @@ class PSF():
         Returns: Nothing
         '''
         # Open ds9 window
-        d.set("fits new "+self.target_file)
-        d.set("tile no")
-        d.set("cmap 1 0.5")
-        d.set("scale mode 99.5")
-        d.set("zoom to fit")
-        d.set("mode region")
+        d.show(self.target_file, mode='region')
         # Prompt user to place circle region on star
         d.set("region shape circle")
-        input('\nPlace circle for star. Hit enter when region is placed')
+        timing.prompt('\nPlace circle for star. Hit enter when region is placed')
         # Prompt user to place box region for area to run model
         d.set("region shape box")
-        input('\nPlace box for frame. Hit enter when region is placed')
+        timing.prompt('\nPlace box for frame. Hit enter when region is placed')
         psf_regions = d.get("region -system image")
-        # Establish filenames
-        output_config = self.ouput_dir + self.target_filename + '_psf_config.txt'
-        output_fits = self.ouput_dir + self.target_filename + '_psf.fits'
-        output_model = self.ouput_dir + self.target_filename + '_psf_model.fits'
-        output_mask = self.ouput_dir + self.target_filename + '_psf_mask.fits'
         # Set galfit config file
-        input_to_galfit(self.target_file, True, psf_regions, self.zero_point,
-                        output_config, output_fits, output_mask, 'none',
-                        False, False, False, [0]*4, 'none', 'none')
-        self.config_file = output_config
+        self.make_config(psf_regions)
         # Delete old regions
         d.set('region select all')
         d.set('region delete select')
-        # Get rid of any old psf models
-        if os.path.exists(output_fits):
-                os.remove(output_fits)
-        # Run galfit
-        subprocess.run(['/bin/bash', '-c', str(self.galfit_path.rstrip()+' '+self.config_file)])
-        # subprocess.run(['/bin/bash', '-c', self.galfit_path+" "+output_config])
+        # Run galfit, in background if job queue is set
+        galfit_run = GalfitRun(self.galfit_path, self.config_file, self.ouput_dir)
+        if self.queue is not None:
+            self.queue.submit('psf create', self.target_filename, galfit_run,
+                              lambda d: self.review_write(galfit_run, d))
+        else:
+            galfit_run.run()
+            self.review_write(galfit_run, d)
+
+    def review_write(self, galfit_run: GalfitRun, d) -> None:
+        '''
+        Loads finished psf run into ds9 and prompts user to keep it
+
+        Args:
+            galfit_run: finished galfit run of psf config
+            d: pyds9 DS9 instance
+
+        Returns: Nothing
+        '''
         # Check if galfit ran correctly
-        if os.path.exists(output_fits):
-            # Remove galfit output file
-            os.remove('galfit.01')
+        if self.collect_run(galfit_run):
             print("\ngalfit run done, loading into DS9...")
             # Load model into ds9
-            d.set("mecube new "+output_fits)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode minmax")
-            d.set("mode none")
-            d.set("zoom to fit")
-            d.set("cube play")
+            d.show(self.ouput_dir + self.target_filename + '_psf.fits', cube=True, scale='minmax', mode='none')
             # Prompt user to see if model is satisfactory
-            done = input('\nAre you satisfied? yes/enter to continue, no to restart, or quit > ')
+            done = timing.prompt('\nAre you satisfied? yes/enter to continue, no to restart, or quit > ')
             if done == 'no':
                 # Repeat process if unsatisfied
                 self.write_config(d)
             if done != 'quit':
                 # Save changes as long as user did not quit out
-                self.config_file = output_config
-                self.config_output_file = output_fits
+                self.save_model()
+
+    def fit(self, regions: str|None =None) -> bool:
+        '''
+        Creates galfit config from a region string (if given) and optimizes
+        it without ds9 or prompts. Saves the psf model if galfit succeeds
 
-                hdul = fits.open(output_fits)
-                data = hdul[2].data
-                fits.writeto(output_model, data, overwrite=True)
+        Args:
+            regions: ds9 region string with circle for star and box for frame.
+                     If None, the existing config file is used
 
-                self.model_file = output_model
+        Returns: True if psf model was saved
+        '''
+        if regions is not None:
+            self.make_config(regions)
+        elif self.config_file is None:
+            print('\nPlease create or upload psf galfit config file first\n')
+            return False
+        if not self.run_config():
+            return False
+        self.save_model()
+        return True
 
-        else:
-            print('\nGalfit crashed! Please try again\n')
+    def auto_fit(self, n: int =AUTO_CANDIDATES) -> bool:
+        '''
+        Creates psf model without placing regions: finds the n best psf
+        star candidates in the target (see detection.find_stars), fits them
+        all concurrently and keeps the fit with the smallest residuals. The
+        saturation level is read from the SATURATE header keyword if present
+
+        Args:
+            n: number of candidate stars to fit
+
+        Returns: True if psf model was saved
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        from astropy.io import fits
+        from region_to_config import input_to_galfit
+        from detection import find_stars, star_regions
+        with timing.span('fits_read'), fits.open(self.target_file, memmap=False) as hdul:
+            data = hdul[0].data
+            saturation = hdul[0].header.get('SATURATE')
+        stars = find_stars(data, n, saturation=saturation)
+        if not stars:
+            print('\nNo bright isolated stars found, please place regions with psf create\n')
+            return False
+        # Candidate configs are written to scratch so the saved psf is untouched
+        scratch_dir = self.ouput_dir + AUTO_DIR + '/'
+        os.makedirs(scratch_dir, exist_ok=True)
+        runs = []
+        for i, star in enumerate(stars):
+            name = scratch_dir + self.target_filename + f'_psf_{i}'
+            input_to_galfit(self.target_file, True, star_regions(star), self.zero_point,
+                            name + '_config.txt', name + '.fits', name + '_mask.fits', 'none',
+                            False, False, False, [0]*4, 'none', 'none')
+            runs.append(GalfitRun(self.galfit_path, name + '_config.txt', self.ouput_dir, quiet=True))
+        print(f'\nFitting {len(runs)} candidate psf stars...')
+        with ThreadPoolExecutor(max_workers=len(runs)) as pool:
+            list(pool.map(GalfitRun.run, runs))
+        scores = {}
+        for i, galfit_run in enumerate(runs):
+            if galfit_run.has_fits():
+                scores[i] = residual_score(galfit_run.output_fits)
+                print(f'- star at ({stars[i]["x"]:.1f}, {stars[i]["y"]:.1f}): residual '
+                      f'{scores[i][1]:.3f}, chi2nu {scores[i][2]:.3f}'
+                      + (', convergence error' if scores[i][0] else ''))
+            else:
+                print(f'- star at ({stars[i]["x"]:.1f}, {stars[i]["y"]:.1f}): galfit crashed')
+        best = min(scores, key=scores.get, default=None)
+        for i, galfit_run in enumerate(runs):
+            if i != best:
+                self.manifest.record_run('psf auto', galfit_run)
+                galfit_run.cleanup()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        if best is None:
+            print('\nGalfit crashed on every candidate! Please try psf create\n')
+            return False
+        print(f'\nKept star at ({stars[best]["x"]:.1f}, {stars[best]["y"]:.1f})\n')
+        self.make_config(star_regions(stars[best]))
+        runs[best].config_file = self.config_file
+        if not self.collect_run(runs[best]):
+            return False
+        self.save_model()
+        return True
+
+    def make_config(self, regions: str) -> None:
+        '''
+        Writes galfit psf config file from ds9 region string
+
+        Args:
+            regions: ds9 region string with circle for star and box for frame
+
+        Returns: Nothing
+        '''
+        from region_to_config import input_to_galfit
+        # Establish filenames
+        output_config = self.ouput_dir + self.target_filename + '_psf_config.txt'
+        output_fits = self.ouput_dir + self.target_filename + '_psf.fits'
+        output_mask = self.ouput_dir + self.target_filename + '_psf_mask.fits'
+        # Set galfit config file
+        self.mask = input_to_galfit(self.target_file, True, regions, self.zero_point,
+                                    output_config, output_fits, output_mask, 'none',
+                                    False, False, False, [0]*4, 'none', 'none')
+        self.config_file = output_config
+        self.manifest.record('psf_config_file', 'psf_mask')
+
+    def run_config(self) -> bool:
+        '''
+        Runs galfit for current psf config file
+
+        Args: None
+
+        Returns: True if galfit ran correctly
+        '''
+        # Run galfit in its own scratch directory
+        galfit_run = GalfitRun(self.galfit_path, self.config_file, self.ouput_dir)
+        galfit_run.run()
+        return self.collect_run(galfit_run)
+
+    def collect_run(self, galfit_run: GalfitRun) -> bool:
+        '''
+        Moves psf galfit output into place if galfit ran correctly
+
+        Args:
+            galfit_run: finished galfit run of psf config
+
+        Returns: True if galfit ran correctly
+        '''
+        output_fits = self.ouput_dir + self.target_filename + '_psf.fits'
+        self.manifest.record_run('psf', galfit_run)
+        if galfit_run.has_fits():
+            self.unlink_library()
+            galfit_run.save_fits(output_fits)
+            galfit_run.cleanup()
+            self.manifest.record('psf_config_output_file')
+            return True
+        galfit_run.cleanup()
+        print('\nGalfit crashed! Please try again\n')
+        return False
+
+    def save_model(self) -> None:
+        '''
+        Saves galfit psf output and makes single frame psf model from it
+
+        Args: None
+
+        Returns: Nothing
+        '''
+        output_fits = self.ouput_dir + self.target_filename + '_psf.fits'
+        output_model = self.ouput_dir + self.target_filename + '_psf_model.fits'
+
+        self.config_file = self.ouput_dir + self.target_filename + '_psf_config.txt'
+        self.config_output_file = output_fits
+
+        self.unlink_library()
+        self.write_stamp(output_fits, output_model)
+
+        self.model_file = output_model
+        self.manifest.record('psf_config_file', 'psf_config_output_file', 'psf_model_file')
+        self.library.refresh(self)
 
     def optimize_config_(self, d) -> None:
         '''
@@ -131,68 +362,23 @@ class PSF():
         if self.config_file is None:
             print('\nPlease create or upload psf galfit config file first\n')
         else:
-            config = open(self.config_file, 'r')
-            lines = config.readlines()
-            
-            comp_num = 0
-            comp_type = ""
-            for i, line in enumerate(lines):
-                # check for a line that contains the start of a component
-                if 'Component number:' in line:
-                    comp_num += 1
-                words = line.split()
-                # gets the component type (psf, sersic, sky, etc.)
-                if '0)' in line and '=0)' not in line and '10)' not in line:
-                    comp_type = words[1]
-                if comp_type == 'sky':
-                    if 'Z)' in line:
-                        lines[i] = "Z) 1\n"
-            config.close()
+            config = GalfitConfig.read(self.config_file)
+            # Skip sky components in output image
+            for component in config.components:
+                if component.type == 'sky' and 'Z' in component:
+                    config.set_param(component, 'Z', [1])
             # Write update to config file
-            with open(self.config_file, 'w') as file:
-                file.writelines(lines)
-
-            # Get rid of any previous galfit output config files
-            if os.path.exists('galfit.01'):
-                os.remove('galfit.01')
-            # Final output file
-            output_fits = self.ouput_dir + self.target_filename + '_psf.fits'
-            output_config = self.ouput_dir + self.target_filename + '_psf_config.txt'
-            output_model = self.ouput_dir + self.target_filename + '_psf_model.fits'
-            # Remove any previous temporary model outputs
-            if os.path.exists(output_fits):
-                os.remove(output_fits)
-            # Run galfit
-            # subprocess.run(['/bin/bash', '-c', self.galfit_path+" "+self.config_file])
-            # print(str(self.galfit_path.rstrip()+' '+self.config_file))
-            subprocess.run(['/bin/bash', '-c', str(self.galfit_path.rstrip()+' '+self.config_file)])
-            print('\nFitting finished')
-            # Check if galfit was successful
-            if os.path.exists(output_fits) and os.path.exists('galfit.01'):
+            config.write(self.config_file)
+            self.manifest.record('psf_config_file')
+
+            # Run galfit and check if it was successful
+            if self.run_config():
                 print("\ngalfit run done, loading into DS9...\n")
                 # Open output in ds9
-                d.set("mecube new " + output_fits)
-                d.set("tile no")
-                d.set("cmap 1 0.5")
-                d.set("scale mode minmax")
-                d.set("mode none")
-                d.set("zoom to fit")
-                d.set("cube play")
+                d.show(self.ouput_dir + self.target_filename + '_psf.fits', cube=True, scale='minmax', mode='none')
 
                 # Save changes as long as user did not quit out
-                self.config_file = output_config
-                self.config_output_file = output_fits
-
-                hdul = fits.open(output_fits)
-                data = hdul[2].data
-                fits.writeto(output_model, data, overwrite=True)
-
-                self.model_file = output_model
-            else:
-                if os.path.exists(output_fits):
-                    print('\nCorrupted output. Check for buffer overflow.\nMay have to do with output directory path or target fits file path being too long\n')
-                else:
-                    print('\nGalfit crashed. Please edit/remake config file and try again\n')
+                self.save_model()
 
     def visualize(self, d) -> None:
         '''
@@ -208,18 +394,9 @@ class PSF():
         if self.config_output_file is None and self.model_file is None:
             print('\nPlease upload or create psf model first\n')
         elif self.config_output_file is not None:
-            d.set("mecube new "+ self.config_output_file)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode minmax")
-            d.set("mode none")
-            d.set("zoom to fit")
-            d.set("cube play")
+            d.show(self.config_output_file, cube=True, scale='minmax', mode='none')
         elif self.model_file is not None:
-            d.set("fits new "+ self.model_file)
-            d.set("scale mode minmax")
-            d.set("mode none")
-            d.set("zoom to fit")
+            d.show(self.model_file, scale='minmax', mode='none')
 
     def upload_psf(self, filename: str) -> None:
         '''
@@ -232,23 +409,71 @@ class PSF():
 
         Returns: Nothing
         '''
-        hdul = fits.open(filename)
+        from astropy.io import fits
+        with fits.open(filename) as hdul:
+            n_frames = len(hdul)
 
         output_fits = self.ouput_dir + self.target_filename + '_psf.fits'
         output_model = self.ouput_dir + self.target_filename + '_psf_model.fits'
 
-        if len(hdul) == 1:
-            # Copy single frame image
-            if filename != output_model:
-                shutil.copyfile(filename, output_model)
+        self.unlink_library()
+        if n_frames == 1:
+            # Make stamp from single frame image
+            self.write_stamp(filename, output_model)
         else:
             # Copy 4 frame galfit output and make 1 frame model fits file
             if filename != output_fits:
                 shutil.copyfile(filename, output_fits)
             self.config_output_file = output_fits
-            data = hdul[2].data
-            fits.writeto(output_model, data, overwrite=True)
+            self.write_stamp(output_fits, output_model)
         self.model_file = output_model
+        self.manifest.record('psf_config_output_file', 'psf_model_file')
+        self.library.refresh(self)
+
+    def unlink_library(self) -> None:
+        '''
+        Removes links to a library psf, so the target's own psf can be
+        written without overwriting the library copy
+
+        Args: None
+
+        Returns: Nothing
+        '''
+        for suffix in ['_psf.fits', '_psf_model.fits']:
+            path = self.ouput_dir + self.target_filename + suffix
+            if os.path.islink(path):
+                os.remove(path)
+                if path == self.config_output_file:
+                    self.config_output_file = None
+
+    def write_stamp(self, source_file: str, output_model: str) -> None:
+        '''
+        Writes psf model stamp used by sersic fits: the psf model cropped to
+        stamp_radius around its peak, centred and normalised. The stamp
+        records a hash of its source file, so it is only remade when the
+        source psf or the radius changes
+
+        Args:
+            source_file: galfit psf output (model in frame 2) or single frame psf
+            output_model: path to write stamp to
+
+        Returns: Nothing
+        '''
+        from astropy.io import fits
+        with open(source_file, 'rb') as source:
+            source_hash = hashlib.sha1(source.read()).hexdigest()
+        if os.path.exists(output_model) and output_model != source_file:
+            with timing.span('fits_read'):
+                header = fits.getheader(output_model)
+            if header.get('PSFSRC') == source_hash and header.get('PSFRAD') == self.stamp_radius:
+                return
+        with timing.span('fits_read'), fits.open(source_file, memmap=False) as hdul:
+            data = hdul[2].data if len(hdul) > 2 else hdul[0].data
+            stamp = psf_stamp(data, self.stamp_radius)
+        header = fits.Header()
+        header['PSFSRC'] = (source_hash, 'sha1 of source psf file')
+        header['PSFRAD'] = (self.stamp_radius, 'stamp half-width [pix]')
+        fits.writeto(output_model, stamp, header, overwrite=True)
 
     def flags(self) -> None:
         '''
@@ -260,6 +485,7 @@ class PSF():
 
         Returns: Nothing
         '''
+        from astropy.io import fits
         # dictionary containing meanings of all possible flags
         flag_dict = {
                     "1": "Maximum number of iterations reached.  Quit out early.",
@@ -286,10 +512,66 @@ class PSF():
         if self.config_output_file is None:
             print("\nPlease upload or create psf model first\n")
         else:
-            hdulist = fits.open(self.config_output_file)
-            galfitheader = hdulist[2].header
+            with timing.span('fits_read'):
+                hdulist = fits.open(self.config_output_file)
+                galfitheader = hdulist[2].header
             galfit_flags = galfitheader["FLAGS"].split()
             print()
             for flag in galfit_flags:
                 print("-",flag_dict[flag])
             print()
+
+    def fwhm(self) -> float|None:
+        '''
+        Gets FWHM of the moffat component of the psf, preferring the fitted
+        value in the galfit output header over the config file
+
+        Args: None
+
+        Returns: FWHM in pixels, or None if there is no moffat component
+        '''
+        from astropy.io import fits
+        if self.config_output_file is not None and os.path.exists(self.config_output_file):
+            with timing.span('fits_read'):
+                header = fits.getheader(self.config_output_file, 2)
+            for key in header:
+                if key.startswith('COMP_') and header[key] == 'moffat':
+                    fwhm = header.get(key[5:] + '_FWHM')
+                    if fwhm is not None:
+                        # Strip galfit markers for fixed [] and problem ** values
+                        return float(fwhm.split()[0].strip('*[]'))
+        if self.config_file is not None and os.path.exists(self.config_file):
+            config = GalfitConfig.read(self.config_file)
+            for component in config.components:
+                if component.type == 'moffat' and '4' in component:
+                    return component['4'].value()
+        return None
+
+    def convolution_box(self) -> tuple[int, int]|None:
+        '''
+        Gets size of galfit convolution box for fits using this psf, from
+        the conv_box policy. The box is never smaller than the psf model
+        stamp. input_to_galfit clips it to the fitting box
+
+        Args: None
+
+        Returns: (x, y) size in pixels, or None for the full fitting box
+        '''
+        from astropy.io import fits
+        if self.conv_box == 'full':
+            return None
+        if self.conv_box == 'auto':
+            fwhm = self.fwhm()
+            if fwhm is None:
+                return None
+            size = int(math.ceil(CONV_BOX_FWHM * fwhm))
+        else:
+            size = int(self.conv_box)
+        # Convolution box must contain the whole psf stamp
+        size_x, size_y = size, size
+        if self.model_file is not None and os.path.exists(self.model_file):
+            with timing.span('fits_read'):
+                header = fits.getheader(self.model_file)
+            size_x = max(size_x, header['NAXIS1'])
+            size_y = max(size_y, header['NAXIS2'])
+        return size_x, size_y
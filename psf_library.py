@@ -0,0 +1,231 @@
+# Library of finished psf models shared between targets
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import json
+import time
+import shutil
+import hashlib
+from manifest import locked, write_json, read_cards, BAND_KEYWORDS
+
+# Library lives in the root output directory (~/gf_out/). Hidden, so it is
+# not taken for a target
+LIBRARY_DIR = '.psf_library'
+LIBRARY_FILE = 'library.json'
+# Target header keywords identifying where a psf applies: any of each group
+# of alternatives. Exposure and CCD are required, band is used if present
+EXPOSURE_KEYWORDS = ['EXPNUM', 'EXPID', 'EXPOSURE', 'FRAMENUM']
+CCD_KEYWORDS = ['CCDNUM', 'DETECTOR', 'CCDNAME', 'CHIPID', 'EXTNAME']
+
+def library_key(target_file: str, group: str|None =None) -> str|None:
+    '''
+    Gets library key of a target: the group id if given, otherwise its
+    exposure, CCD and band from the target header
+
+    Args:
+        target_file: path to target fits file
+        group: explicit psf group id, e.g. 'exp12345_ccd17'
+
+    Returns: key, or None if target header lacks exposure or CCD
+    '''
+    if group:
+        return 'group=' + group
+    cards = read_cards(target_file)
+    key = []
+    for name, keywords in [('exposure', EXPOSURE_KEYWORDS), ('ccd', CCD_KEYWORDS),
+                           ('band', BAND_KEYWORDS)]:
+        value = next((cards[keyword] for keyword in keywords if cards.get(keyword)), None)
+        if value is None and name != 'band':
+            return None
+        if value is not None:
+            key.append(f'{name}={value}')
+    return ','.join(key)
+
+def file_sha(path: str) -> str:
+    '''
+    Returns: sha1 of file contents
+    '''
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+class PSFLibrary():
+    '''
+    Class for the library of finished psf models, so targets from the same
+    exposure and CCD (or sharing a group id) reuse one psf instead of each
+    being fitted.
+
+    Each entry holds a copy of the source target's psf model stamp and
+    galfit output, versioned. Targets use an entry by linking (symlinking)
+    their psf files to its current version. Rules for invalidation:
+        - redoing the psf of a source target adds a new version of its entry.
+          Linked targets keep the version they were fitted with until
+          relinked, and are reported as stale
+        - an entry is only compatible with targets using the same stamp
+          radius
+        - an entry whose files are missing is dropped
+
+    Attributes:
+        path_to_output: root output directory (~/gf_out/)
+        library_dir: directory holding library files
+        path: path to library index file
+
+    Methods:
+        load: reads library entries
+        add: adds psf of a target to the library
+        find: finds compatible entry for a target
+        link: links target psf files to an entry
+        refresh: adds a new version when a source target redoes its psf
+        status: describes library state of a target's psf
+    '''
+    def __init__(self, path_to_output: str):
+        self.path_to_output = path_to_output
+        self.library_dir = os.path.join(path_to_output, LIBRARY_DIR, '')
+        self.path = self.library_dir + LIBRARY_FILE
+
+    def load(self) -> dict:
+        '''
+        Returns: dict of key -> entry
+        '''
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as library:
+            return json.load(library)
+
+    def add(self, psf, group: str|None =None) -> dict|None:
+        '''
+        Adds psf model of a target to the library, as a new version if the
+        key already has a different psf
+
+        Args:
+            psf: PSF instance with a saved model
+            group: explicit group id, otherwise keyed by target header
+
+        Returns: library entry, or None if psf cannot be added
+        '''
+        if psf.model_file is None or psf.config_output_file is None:
+            print('\nPlease create psf model first. Only fitted psfs can be added\n')
+            return None
+        key = library_key(psf.target_file, group)
+        if key is None:
+            print('\nTarget header has no exposure and CCD keywords, give a psf group id instead\n')
+            return None
+        source_hash = file_sha(psf.model_file)
+        os.makedirs(self.library_dir, exist_ok=True)
+        with locked(self.path):
+            entries = self.load()
+            entry = entries.get(key)
+            if entry is not None and entry['source_hash'] == source_hash:
+                return entry
+            version = entry['version'] + 1 if entry is not None else 1
+            name = hashlib.sha1(key.encode()).hexdigest()[:12] + f'_v{version}'
+            shutil.copyfile(psf.model_file, self.library_dir + name + '_psf_model.fits')
+            shutil.copyfile(psf.config_output_file, self.library_dir + name + '_psf.fits')
+            entries[key] = {'key': key, 'group': group, 'version': version,
+                            'model_file': self.library_dir + name + '_psf_model.fits',
+                            'output_file': self.library_dir + name + '_psf.fits',
+                            'source': psf.ouput_dir, 'source_target': psf.target_filename,
+                            'source_hash': source_hash, 'stamp_radius': psf.stamp_radius,
+                            'added': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'links': entry['links'] if entry is not None else {}}
+            write_json(self.path, entries)
+        if version > 1 and entries[key]['links']:
+            print(f'\n{len(entries[key]["links"])} target(s) linked to an older version of this psf, '
+                  'relink them with psf library link\n')
+        return entries[key]
+
+    def find(self, psf, group: str|None =None) -> dict|None:
+        '''
+        Finds library entry compatible with a target: same key, same stamp
+        radius and files still present
+
+        Args:
+            psf: PSF instance of target
+            group: explicit group id, otherwise keyed by target header
+
+        Returns: library entry, or None if there is none
+        '''
+        key = library_key(psf.target_file, group)
+        entry = self.load().get(key) if key is not None else None
+        if entry is None:
+            return None
+        if entry['stamp_radius'] != psf.stamp_radius:
+            print(f'\nLibrary psf for {key} has stamp radius {entry["stamp_radius"]}, '
+                  f'not {psf.stamp_radius}\n')
+            return None
+        if not os.path.exists(entry['model_file']) or not os.path.exists(entry['output_file']):
+            with locked(self.path):
+                entries = self.load()
+                entries.pop(key, None)
+                write_json(self.path, entries)
+            print(f'\nLibrary psf for {key} is missing its files, dropped it\n')
+            return None
+        return entry
+
+    def link(self, psf, entry: dict) -> None:
+        '''
+        Points a target's psf model and galfit output at a library entry,
+        in place of fitting its own
+
+        Args:
+            psf: PSF instance of target
+            entry: library entry
+
+        Returns: Nothing
+        '''
+        output_fits = psf.ouput_dir + psf.target_filename + '_psf.fits'
+        output_model = psf.ouput_dir + psf.target_filename + '_psf_model.fits'
+        for source, link in [(entry['output_file'], output_fits), (entry['model_file'], output_model)]:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(source, link)
+        psf.config_output_file = output_fits
+        psf.model_file = output_model
+        psf.manifest.record('psf_config_output_file', 'psf_model_file')
+        with locked(self.path):
+            entries = self.load()
+            if entry['key'] in entries and psf.ouput_dir != entry['source']:
+                entries[entry['key']]['links'][psf.ouput_dir] = entry['version']
+                write_json(self.path, entries)
+
+    def refresh(self, psf) -> None:
+        '''
+        Adds a new version of any entry this target is the source of, after
+        its psf was redone. Targets linked to an entry stop being linked
+        once they fit or upload their own psf
+
+        Args:
+            psf: PSF instance whose psf was just saved
+
+        Returns: Nothing
+        '''
+        entries = self.load()
+        for entry in entries.values():
+            if entry['source'] == psf.ouput_dir:
+                self.add(psf, entry['group'])
+            elif psf.ouput_dir in entry['links']:
+                with locked(self.path):
+                    current = self.load()
+                    current[entry['key']]['links'].pop(psf.ouput_dir, None)
+                    write_json(self.path, current)
+
+    def status(self, psf) -> str|None:
+        '''
+        Describes where a target's psf comes from in the library
+
+        Args:
+            psf: PSF instance of target
+
+        Returns: description, or None if target does not use the library
+        '''
+        for entry in self.load().values():
+            if entry['source'] == psf.ouput_dir:
+                return (f'source of library psf {entry["key"]} (version {entry["version"]}, '
+                        f'{len(entry["links"])} linked)')
+            if psf.ouput_dir in entry['links']:
+                version = entry['links'][psf.ouput_dir]
+                if version < entry['version']:
+                    return (f'STALE: linked to version {version} of library psf {entry["key"]}, '
+                            f'source {entry["source_target"]} has since redone it (version '
+                            f'{entry["version"]}). Relink with psf library link')
+                return f'linked to library psf {entry["key"]} from {entry["source_target"]}'
+        return None
@@ -0,0 +1,74 @@
+# Reading ds9 region files and their JSON equivalent without ds9
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+
+# Parameters of each JSON shape, in ds9 order. Coordinates are image pixels,
+# 1-indexed like ds9 image coordinates
+SHAPES = {'ellipse': ['x', 'y', 'a', 'b', 'angle'],
+          'circle': ['x', 'y', 'r'],
+          'point': ['x', 'y'],
+          'box': ['x', 'y', 'width', 'height', 'angle'],
+          'polygon': ['points']}
+# Parameters that may be left out of a JSON shape, with their defaults
+DEFAULTS = {'angle': 0}
+
+def json_to_regions(shapes: list[dict]|dict) -> str:
+    '''
+    Converts JSON regions to a ds9 region string. Regions are a list (or an
+    object with a "regions" list) of shapes such as
+        {"shape": "ellipse", "x": 512.3, "y": 498.1, "a": 12, "b": 8, "angle": 30}
+        {"shape": "point", "x": 530, "y": 470, "background": true}
+        {"shape": "circle", "x": 120.9, "y": 263.6, "r": 4.9}
+        {"shape": "box", "x": 512, "y": 512, "width": 200, "height": 200}
+        {"shape": "polygon", "points": [[10, 10], [40, 10], [25, 30]], "exclude": true}
+    "exclude": true masks the shape out of the fit, "background": true keeps
+    its component out of the model image (as with ds9 background regions)
+
+    Args:
+        shapes: JSON regions
+
+    Returns: ds9 region string in image coordinates
+    '''
+    if isinstance(shapes, dict):
+        shapes = shapes['regions']
+    lines = ['# Region file format: DS9 version 4.1', 'image']
+    for i, shape in enumerate(shapes):
+        name = shape.get('shape')
+        if name not in SHAPES:
+            raise ValueError(f'region {i}: unknown shape {name!r}, expected one of {", ".join(SHAPES)}')
+        try:
+            values = [shape[key] if key in shape else DEFAULTS[key] for key in SHAPES[name]]
+        except KeyError as error:
+            required = [key for key in SHAPES[name] if key not in DEFAULTS]
+            raise ValueError(f'region {i}: {name} needs {", ".join(required)}, missing {error}')
+        if name == 'polygon':
+            values = [coordinate for point in values[0] for coordinate in point]
+        line = ('-' if shape.get('exclude') else '') + name + '(' + ','.join(str(value) for value in values) + ')'
+        if shape.get('background'):
+            line += ' # background'
+        lines.append(line)
+    return '\n'.join(lines)
+
+def read_regions(path: str) -> str:
+    '''
+    Reads regions from a ds9 region file, or a .json file of JSON regions
+    (see json_to_regions)
+
+    Args:
+        path: region file
+
+    Returns: ds9 region string
+    '''
+    with open(os.path.expanduser(path)) as region_file:
+        if path.endswith('.json'):
+            return json_to_regions(json.load(region_file))
+        return region_file.read()
+
+if __name__ == '__main__':
+    # Converts JSON regions to a ds9 region file, e.g. to check them in ds9
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python3 region_file.py regions.json > regions.reg')
+    print(read_regions(sys.argv[1]))
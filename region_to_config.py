@@ -5,12 +5,129 @@ import pyregion
 from astropy.io import fits
 import astropy.wcs
 import numpy as np
+import os
+import glob
 import math
+import copy
+import hashlib
+import timing
+from pyregion.region_to_filter import as_region_filter
 
-# function for fits file and regions -> galfit file, for both psf and normal galfit
+# gets array bounds (y0, y1, x0, x1) of a region, clipped to the image shape.
+# region coordinates are 1-based, so pixel index i has its center at i+1
+def region_bbox(region, shape):
+    ny, nx = shape
+    coords = region.coord_list
+    if region.name == 'polygon':
+        xs, ys = coords[::2], coords[1::2]
+        x_lo, x_hi, y_lo, y_hi = min(xs), max(xs), min(ys), max(ys)
+    else:
+        if region.name == 'circle':
+            extent = coords[2]
+        elif region.name == 'ellipse':
+            extent = max(coords[2:-1])
+        elif region.name in ('box', 'rotbox'):
+            extent = math.hypot(coords[2], coords[3]) / 2
+        elif region.name == 'annulus':
+            extent = max(coords[2:])
+        else:
+            # unknown extent, fall back to the full image
+            return 0, ny, 0, nx
+        x_lo, x_hi = coords[0] - extent, coords[0] + extent
+        y_lo, y_hi = coords[1] - extent, coords[1] + extent
+    x0, x1 = max(0, int(math.floor(x_lo)) - 1), min(nx, int(math.ceil(x_hi)) + 1)
+    y0, y1 = max(0, int(math.floor(y_lo)) - 1), min(ny, int(math.ceil(y_hi)) + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return y0, y1, x0, x1
+
+# rasterizes a single region over its bounding box only
+def region_mask(region, bbox):
+    y0, y1, x0, x1 = bbox
+    shifted = copy.copy(region)
+    coords = list(region.coord_list)
+    if region.name == 'polygon':
+        coords[::2] = [x - x0 for x in coords[::2]]
+        coords[1::2] = [y - y0 for y in coords[1::2]]
+    else:
+        coords[0] -= x0
+        coords[1] -= y0
+    shifted.coord_list = coords
+    shifted.exclude = False
+    return as_region_filter([shifted], origin=1).mask((y1 - y0, x1 - x0))
+
+# sums pixel values under a region, touching only its bounding box.
+# fits_data may be an array or a fits section, which reads only the box
+def region_sum(region, fits_data, shape):
+    bbox = region_bbox(region, shape)
+    if bbox is None:
+        return 0.0
+    y0, y1, x0, x1 = bbox
+    with timing.span('fits_read'):
+        data = np.asarray(fits_data[y0:y1, x0:x1])
+    with timing.span('mask'):
+        mask = region_mask(region, bbox)
+    return float(np.sum(data[mask]))
+
+# mask header keyword holding the hash of the exclude regions it was made from
+MASK_HASH = 'MASKHASH'
+
+# hashes exclude regions and image shape, which fully determine a mask
+def mask_hash(excluded_regions, shape):
+    sha = hashlib.sha1(repr(tuple(shape)).encode())
+    for region in excluded_regions:
+        sha.update(f"{region.name}{[round(c, 6) for c in region.coord_list]}".encode())
+    return sha.hexdigest()
+
+# gets hash a mask file was written with, None if there is none
+def read_mask_hash(mask_file):
+    try:
+        return fits.getheader(mask_file).get(MASK_HASH)
+    except (OSError, IndexError):
+        return None
+
+# writes uint8 mask of exclude regions to mask_file and returns the path for F),
+# or 'none' when nothing is excluded. the write is skipped when mask_file was
+# made from the same exclusions, and another mask with the same exclusions in
+# the same directory (e.g. psf and sersic masks) is hard linked instead
+def write_mask(excluded_regions, shape, mask_file):
+    if not excluded_regions:
+        if os.path.exists(mask_file):
+            os.remove(mask_file)
+        return 'none'
+    mask_sha = mask_hash(excluded_regions, shape)
+    with timing.span('fits_read'):
+        if read_mask_hash(mask_file) == mask_sha:
+            return mask_file
+        # remove first, so a mask shared by hard link is not overwritten for both
+        if os.path.exists(mask_file):
+            os.remove(mask_file)
+        for other in glob.glob(os.path.join(os.path.dirname(mask_file) or '.', '*mask.fits')):
+            if read_mask_hash(other) == mask_sha:
+                try:
+                    os.link(other, mask_file)
+                    return mask_file
+                except OSError:
+                    break
+    excluded_regions_mask = np.zeros(shape, dtype=np.uint8)
+    for region in excluded_regions:
+        bbox = region_bbox(region, shape)
+        if bbox is not None:
+            y0, y1, x0, x1 = bbox
+            with timing.span('mask'):
+                excluded_regions_mask[y0:y1, x0:x1] |= region_mask(region, bbox)
+    hdu = fits.PrimaryHDU(excluded_regions_mask)
+    hdu.header[MASK_HASH] = (mask_sha, 'exclude regions hash')
+    with timing.span('fits_write'):
+        hdu.writeto(mask_file, overwrite=True)
+    return mask_file
+
+
+# function for fits file and regions -> galfit file, for both psf and normal galfit.
+# returns the mask file written to F), or None when nothing is excluded
 def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
                     mask_file, psf_file, pre_box, pre_mags, pre_psf_mags,
-                    sky_info, constraint_file, bending):
+                    sky_info, constraint_file, bending, conv_box=None):
     # creates lines for sky component
     def create_sky_component(component_number, fits_data, sky_info):
         if sky_info[3] == 0:
@@ -91,17 +208,26 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
 
 
 
-    # gets data and header from input FITS file
-    hdulist_fits = fits.open(fits_file)
-    fits_data = hdulist_fits[0].data
-    header = hdulist_fits[0].header
-    hdulist_fits.close()
+    # opens input FITS file. only the header is read here; pixels are read
+    # through the section for the fitting and region boxes, which also works
+    # for scaled (BZERO, BSCALE or BLANK) images
+    with timing.span('fits_read'):
+        hdulist_fits = fits.open(fits_file)
+        fits_data = hdulist_fits[0].section
+        header = hdulist_fits[0].header
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    wcs = astropy.wcs.WCS(header)
 
-    ps_x,ps_y = 3600*astropy.wcs.utils.proj_plane_pixel_scales(astropy.wcs.WCS(fits_file))[0:2]
+    ps_x,ps_y = 3600*astropy.wcs.utils.proj_plane_pixel_scales(wcs)[0:2]
     if pre_box:
+        # convolution box is sized from the old fitting box like a new one
+        conv_x = int(pre_box[1]) - int(pre_box[0]) + 1
+        conv_y = int(pre_box[3]) - int(pre_box[2]) + 1
+        if conv_box is not None:
+            conv_x, conv_y = min(conv_x, conv_box[0]), min(conv_y, conv_box[1])
         info_lines = [
             f"H) {pre_box[0]} {pre_box[1]} {pre_box[2]} {pre_box[3]}",
-            f"I) {pre_box[4]} {pre_box[5]}",
+            f"I) {conv_x} {conv_y}",
             f"J) {zpt}",
             f"K) {ps_x} {ps_y}",
             "O) regular",
@@ -111,7 +237,8 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
 
     # declares fitting region if box region is given
     # will delete last box region from regions once read in
-    regions = pyregion.parse(regions)
+    with timing.span('region_parse'):
+        regions = pyregion.parse(regions)
     box_idx = -1
     idx = 0
     for region in regions:
@@ -119,10 +246,13 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
             box_idx = idx
             cx, cy, x, y, _ = region.coord_list
             xmin,xmax,ymin,ymax = int(np.round(cx-x/2)),int(np.round(cx+x/2)),int(np.round(cy-y/2)),int(np.round(cy+y/2))
-            ps_x,ps_y = 3600*astropy.wcs.utils.proj_plane_pixel_scales(astropy.wcs.WCS(fits_file))[0:2]
+            # convolution box is the whole fitting box unless a smaller size is given
+            conv_x, conv_y = xmax-xmin+1, ymax-ymin+1
+            if conv_box is not None:
+                conv_x, conv_y = min(conv_x, conv_box[0]), min(conv_y, conv_box[1])
             info_lines = [
                 f"H) {xmin} {xmax} {ymin} {ymax}",
-                f"I) {xmax-xmin+1} {ymax-ymin+1}",
+                f"I) {conv_x} {conv_y}",
                 f"J) {zpt}",
                 f"K) {ps_x} {ps_y}",
                 "O) regular",
@@ -133,15 +263,16 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
     if box_idx != -1:
         regions.pop(box_idx)
 
-    # initializes the components and masks
+    # initializes the components and exclude regions
     component_regions = []
-    excluded_regions_mask = np.zeros(fits_data.shape)
-    small_regions_mask_mag = np.zeros(fits_data.shape)
+    excluded_regions = []
     component_number = 1
 
     # creates sky component
     xmin,xmax,ymin,ymax = [int(i) for i in info_lines[0].split()[1:]]
-    component_regions.append(create_sky_component(component_number, fits_data[ymin:ymax,xmin:xmax], sky_info))
+    with timing.span('fits_read'):
+        sky_data = fits_data[ymin:ymax,xmin:xmax]
+    component_regions.append(create_sky_component(component_number, sky_data, sky_info))
     component_number += 1
 
     sersic_count = 0
@@ -149,7 +280,7 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
     for region in regions:
         if region.__dict__['exclude']:
             region.__dict__['exclude'] = False
-            excluded_regions_mask += pyregion.get_mask([region], fits_data).astype(int)
+            excluded_regions.append(region)
         elif region.name == 'point':
             x, y = region.coord_list
             if "background" in region.__dict__["attr"][0]:
@@ -179,13 +310,13 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
                 b = 1
             if a == 0:
                 a = 1
-            small_regions_mask_mag = pyregion.get_mask([region], fits_data).astype(int)
-            sum_pixels = (np.sum(fits_data * small_regions_mask_mag)) * 2
             zeropoint = zpt
             if pre_mags and (sersic_count+1) <= len(pre_mags):
                 magnitude = pre_mags[sersic_count]
                 sersic_count += 1
             else:
+                # only rasterize the ellipse when no magnitude is given
+                sum_pixels = region_sum(region, fits_data, shape) * 2
                 magnitude = (-2.5 * math.log10(sum_pixels)) + zeropoint
             bend = ' '
             if bending and (sersic_count) <= len(bending) and bending[sersic_count-1] is not None:
@@ -198,8 +329,7 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
                 skip = 1
             else:
                 skip = 0
-            small_regions_mask_mag = pyregion.get_mask([region], fits_data).astype(int)
-            sum_pixels = (np.sum(fits_data * small_regions_mask_mag)) * 2
+            sum_pixels = region_sum(region, fits_data, shape) * 2
             zeropoint = zpt
             magnitude = (-2.5 * math.log10(sum_pixels)) + zeropoint
             component_regions.append(create_moffat_component(component_number, x, y, r, r, 0, magnitude, skip))
@@ -207,12 +337,16 @@ def input_to_galfit(fits_file, psf, regions, zpt, output_file, output_fits,
         else:
             print(region,"will be ignored")
 
-    # create mask and mask file
-    excluded_regions_mask = np.ma.masked_greater(excluded_regions_mask,0).filled(1)
-    fits.PrimaryHDU(excluded_regions_mask).writeto(mask_file, overwrite=True)
+    hdulist_fits.close()
+
+    # create mask file, unless unchanged or nothing is excluded
+    mask_file = write_mask(excluded_regions, shape, mask_file)
+    file_lines[5] = f"F) {mask_file}"
 
     # writes galfit output file
     with open(output_file, 'w') as h:
         h.write("\n".join(file_lines)) 
         h.write("\n".join(info_lines))
-        h.write('\n'.join(component_regions))
\ No newline at end of file
+        h.write('\n'.join(component_regions))
+
+    return mask_file if mask_file != 'none' else None
\ No newline at end of file
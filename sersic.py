@@ -1,14 +1,15 @@
 # Class for sersic models
 # Author: Paxson Swierc & Daniel Babnigg
 
-from astropy.io import fits
-import numpy as np
 import os
-from region_to_config import input_to_galfit
-from utils import open_textfile
-import subprocess
+from galfit_run import GalfitRun
+from galfit_config import GalfitConfig
+from manifest import Manifest
 import shutil
-import pyregion
+import timing
+# numpy, astropy, pyregion (through region_to_config) and tkinter (through
+# utils.open_textfile) are imported where used, so startup and headless
+# commands do not pay for them
 
 class Sersic():
     '''
@@ -26,18 +27,31 @@ class Sersic():
         mask: path to mask fits file for galfit
         constraint_file: path to constraint file for galfit
         psf: instance of psf class
+        galfit_run: last galfit run, holding output until saved
+        queue: background job queue for galfit runs, None to run in foreground
+        manifest: manifest of target output directory, updated on every save
 
     Methods:
         create_config: creates galfit config file with ds9 
         edit_config: allows editing of current config with ds9
         optimize_config: runs galfit for current config file
+        review_optimize: loads finished galfit run into ds9 for review
+        fit: creates and optimizes galfit config without ds9
+        make_config: writes galfit config file from ds9 regions
+        auto_config: writes galfit config from sources found in fitting box
+        edit_regions: rewrites current config from edited regions without ds9
+        run_config: runs galfit for current config file
+        check_run: checks if galfit run was successful
+        save_model: saves galfit output config and model
         produce_config: runs galfit for current config file with -o2 after region property edits
+        review_produce: saves finished -o2 galfit run and loads it into ds9
         visualize: opens up sersic model in ds9
         visualize_rgb: opens up target and model rgb images in ds9
         upload_config: copies uploaded config to dir and loads it to instance
         upload_model: copies uploaded model to dir and loads it to instance
         upload_constraint: copies uploaded constraint to dir and loads it
         config_to_region: converts current config file back into ds9 regions
+        config_regions: converts current config file into a region string
         add_constraint: creates a galfit constraint file
         remove_constraint: removes a galfit constraint file
         flags: prints flags from galfit model
@@ -58,6 +72,9 @@ class Sersic():
         self.mask = mask
         self.constraint_file = constraint
         self.psf = psf
+        self.galfit_run = None
+        self.queue = None
+        self.manifest = Manifest(ouput_dir, target_filename)
 
     def create_config(self, d) -> None:
         '''
@@ -73,40 +90,23 @@ class Sersic():
             print('\nPlease create or upload psf first\n')
         else:
             # Open target in ds9
-            d.set("fits new "+self.target_file)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode 99.5")
-            d.set("zoom to fit")
-            d.set("mode region")
+            d.show(self.target_file, mode='region')
             # Prompt user to place ellipse region for galaxies
             d.set("region shape ellipse")
-            input('\nPlace ellipses for galaxies. Hit enter when region is placed')
+            timing.prompt('\nPlace ellipses for galaxies. Hit enter when region is placed')
             # Prompt user to place point region for psf component
             d.set("region shape point")
-            input('\nPlace point for point sources. Hit enter when region is placed')
+            timing.prompt('\nPlace point for point sources. Hit enter when region is placed')
             d.set("region shape box")
-            input('\nPlace box for frame. Hit enter when region is placed')
+            timing.prompt('\nPlace box for frame. Hit enter when region is placed')
             regions = d.get("region -system image")
-            # Establish filenames
-            self.config_file = self.ouput_dir + self.target_filename + '_config.txt'
-            output_fits = self.ouput_dir + self.target_filename + '_model_temp.fits'
-            output_mask = self.ouput_dir + self.target_filename + '_mask.fits'
             # Set galfit config file
-            constraint = 'none'
-            # if self.constraint_file is None:
-            #     constraint = 'none'
-            # else:
-            #     constraint = self.constraint_file
-            input_to_galfit(self.target_file, False, regions, self.zero_point,
-                            self.config_file, output_fits, output_mask,
-                            self.psf.model_file, False, False, False, [0]*4,
-                            constraint, [])
+            self.make_config(regions)
             # Get rid of regions
             d.set('region select all')
             d.set('region delete select')
             # Optimize with galfit config
-            optimize = input('\nRun galfit for this config? Hit enter for yes, type no otherwise > ')
+            optimize = timing.prompt('\nRun galfit for this config? Hit enter for yes, type no otherwise > ')
             if optimize != 'no':
                 self.optimize_config(d)
 
@@ -119,19 +119,16 @@ class Sersic():
 
         Returns: Nothing
         '''
+        from region_to_config import input_to_galfit
+        from utils import open_textfile
         if self.config_file is None:
             print('\nPlease create config file first\n')
         else:
             # Open target in ds9
-            d.set("fits new "+self.target_file)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode 99.5")
-            d.set("zoom to fit")
-            d.set("mode region")
+            d.show(self.target_file, mode='region')
             box, mags, psf_mags, sky_info, bending = self.config_to_region(d)
             # Ask for manual edits first
-            open_editor = input('\nWould you like to edit the config text file manually? Any removal of components should be done manually. Type yes or hit enter to skip > ')
+            open_editor = timing.prompt('\nWould you like to edit the config text file manually? Any removal of components should be done manually. Type yes or hit enter to skip > ')
             if open_editor == 'yes' or open_editor == 'y':
                 open_textfile(self.config_file)
                 # Load in regions again
@@ -139,20 +136,20 @@ class Sersic():
 
             d.set("region shape ellipse")
             # Constrained changes
-            input('\nMake changes to existing regions and add any new regions you may want to constrain. Hit enter to continue')
+            timing.prompt('\nMake changes to existing regions and add any new regions you may want to constrain. Hit enter to continue')
             # Add constraint based on input
-            add_constraint = input('\nUse constraint? Hit enter for yes, type no otherwise > ')
+            add_constraint = timing.prompt('\nUse constraint? Hit enter for yes, type no otherwise > ')
             if add_constraint == 'no':
                 self.remove_constraint()
             else:
                 if self.constraint_file is not None and os.path.exists(self.constraint_file):
-                    use_exist_cst = input('\nReplace current constraint? Hit enter to create new constraint, type no to use existing constraint > ')
+                    use_exist_cst = timing.prompt('\nReplace current constraint? Hit enter to create new constraint, type no to use existing constraint > ')
                     if use_exist_cst != 'no':
                         self.add_constraint()
                 else:
                     self.add_constraint()
             # Give option to add new regions
-            input('\nAdd any new regions you do NOT want to constrain. Hit enter to continue')
+            timing.prompt('\nAdd any new regions you do NOT want to constrain. Hit enter to continue')
             # Get regions
             regions = d.get("region -system image")
             # Establish output files
@@ -163,10 +160,11 @@ class Sersic():
                 constraint = 'none'
             else:
                 constraint = self.constraint_file
-            input_to_galfit(self.target_file, False, regions, self.zero_point,
-                            self.config_file, output_fits, output_mask,
-                            self.psf.model_file, box, mags, psf_mags, sky_info,
-                            constraint, bending)
+            self.mask = input_to_galfit(self.target_file, False, regions, self.zero_point,
+                                        self.config_file, output_fits, output_mask,
+                                        self.psf.model_file, box, mags, psf_mags, sky_info,
+                                        constraint, bending, self.psf.convolution_box())
+            self.manifest.record('sersic_config_file', 'sersic_mask')
             # Optimize with new config file
             self.optimize_config(d)
 
@@ -181,67 +179,229 @@ class Sersic():
         '''
         if self.config_file is None:
             print('\nPlease create or upload config file first\n')
+        # Run galfit in background if job queue is set
+        elif self.queue is not None:
+            galfit_run = GalfitRun(self.galfit_path, self.config_file, self.ouput_dir)
+            self.queue.submit('sersic optimize config', self.target_filename, galfit_run,
+                              lambda d: self.review_optimize(galfit_run, d))
         else:
-            # Get rid of any previous galfit output config files
-            if os.path.exists('galfit.01'):
-                os.remove('galfit.01')
-            # Final output file
-            output_fits = self.ouput_dir + self.target_filename + '_model_temp.fits'
-            # Remove any previous temporary model outputs
-            if os.path.exists(output_fits):
-                os.remove(output_fits)
-            # Run galfit
-            # subprocess.run(['/bin/bash', '-c', self.galfit_path+" "+self.config_file])
-            subprocess.run(['/bin/bash', '-c', str(self.galfit_path.rstrip()+' '+self.config_file)])
-            print('\nFitting finished')
-            # Check if galfit was successful
-            if os.path.exists(output_fits) and os.path.exists('galfit.01'):
-                print("\ngalfit run done, loading into DS9...\n")
-                # Open output in ds9
-                d.set("mecube new " + output_fits)
-                d.set("tile no")
-                d.set("cmap 1 0.5")
-                d.set("scale mode minmax")
-                d.set("mode none")
-                d.set("zoom to fit")
-                d.set("cube play")
-                # Prompt next decision to user. Any other input exits loop
-                prompt = '''What would you like to do? Enter ->
+            self.galfit_run = GalfitRun(self.galfit_path, self.config_file, self.ouput_dir)
+            self.galfit_run.run()
+            self.review_optimize(self.galfit_run, d)
+
+    def review_optimize(self, galfit_run: GalfitRun, d) -> None:
+        '''
+        Loads finished galfit run into ds9 and prompts user for next step
+
+        Args:
+            galfit_run: finished galfit run of config
+            d: pyds9 DS9 instance
+
+        Returns: Nothing
+        '''
+        self.galfit_run = galfit_run
+        # Check if galfit was successful
+        if self.check_run():
+            print("\ngalfit run done, loading into DS9...\n")
+            # Open output in ds9
+            d.show(self.galfit_run.output_fits, cube=True, scale='minmax', mode='none')
+            # Prompt next decision to user. Any other input exits loop
+            prompt = '''What would you like to do? Enter ->
 1: Save this model and config
 2: Edit the output config of this model (continue process)
 3: Reset from last stage and edit last config
  > '''
-                next_step = input(prompt)
-                if next_step == '1':
-                    # Save the model and config
-                    # Replace this config with galfit output config
-                    os.remove(self.config_file)
-                    shutil.copyfile('galfit.01', self.config_file)
-                    os.remove('galfit.01')
-                    # save the model
-                    output_fits_final = self.ouput_dir + self.target_filename + '_model.fits'
-                    os.rename(output_fits, output_fits_final)
-                    self.config_output_file = output_fits_final
-
-                elif next_step == '2':
-                    # Replace this config with galfit output config
-                    os.remove(self.config_file)
-                    shutil.copyfile('galfit.01', self.config_file)
-                    os.remove('galfit.01')
-                    # Continue editing loop
-                    self.edit_config(d)
-
-                elif next_step == '3':
-                    # Remove galfit output config and go back to editing
-                    os.remove('galfit.01')
-                    # Continue editing loop
-                    self.edit_config(d)
+            next_step = timing.prompt(prompt)
+            if next_step == '1':
+                # Save the model and config
+                self.save_model()
+
+            elif next_step == '2':
+                # Replace this config with galfit output config
+                self.galfit_run.save_config(self.config_file)
+                self.galfit_run.cleanup()
+                self.manifest.record('sersic_config_file')
+                # Continue editing loop
+                self.edit_config(d)
+
+            elif next_step == '3':
+                # Remove galfit output config and go back to editing
+                self.galfit_run.cleanup()
+                # Continue editing loop
+                self.edit_config(d)
 
             else:
-                if os.path.exists(output_fits):
-                    print('\nCorrupted output. Check for buffer overflow.\nMay have to do with output directory path or target fits file path being too long\n')
-                else:
-                    print('\nGalfit crashed. Please edit/remake config file and try again\n')
+                self.galfit_run.cleanup()
+
+    def fit(self, regions: str|None =None) -> bool:
+        '''
+        Creates galfit config from a region string (if given) and optimizes
+        it without ds9 or prompts. Saves the model and output config if
+        galfit succeeds
+
+        Args:
+            regions: ds9 region string with ellipses, points and box for frame.
+                     If None, the existing config file is used
+
+        Returns: True if model was saved
+        '''
+        if self.psf.model_file is None:
+            print('\nPlease create or upload psf first\n')
+            return False
+        if regions is not None:
+            self.make_config(regions)
+        elif self.config_file is None:
+            print('\nPlease create or upload config file first\n')
+            return False
+        if not self.run_config():
+            return False
+        self.save_model()
+        return True
+
+    def make_config(self, regions: str, mags: list[float]|None =None,
+                    psf_mags: list[float]|None =None) -> None:
+        '''
+        Writes galfit config file from ds9 region string
+
+        Args:
+            regions: ds9 region string with ellipses, points and box for frame
+            mags: initial magnitudes of ellipses in order, otherwise measured
+                  from the pixels under each ellipse
+            psf_mags: initial magnitudes of points in order
+
+        Returns: Nothing
+        '''
+        from region_to_config import input_to_galfit
+        # Establish filenames
+        self.config_file = self.ouput_dir + self.target_filename + '_config.txt'
+        output_fits = self.ouput_dir + self.target_filename + '_model_temp.fits'
+        output_mask = self.ouput_dir + self.target_filename + '_mask.fits'
+        # Set galfit config file
+        constraint = 'none'
+        self.mask = input_to_galfit(self.target_file, False, regions, self.zero_point,
+                                    self.config_file, output_fits, output_mask,
+                                    self.psf.model_file, False, mags or False, psf_mags or False, [0]*4,
+                                    constraint, [], self.psf.convolution_box())
+        self.manifest.record('sersic_config_file', 'sersic_mask')
+
+    def auto_config(self, box: list[int]|None =None) -> bool:
+        '''
+        Writes galfit config without placing regions: seeds a component for
+        every source found in the fitting box (see detection.find_sources),
+        a sersic (ellipse) for each extended source and a psf (point) for
+        each point source, with magnitudes from their pixel flux
+
+        Args:
+            box: fitting box [xmin, xmax, ymin, ymax] in image pixels
+                 (1-indexed, inclusive), whole image if None
+
+        Returns: True if config was written
+        '''
+        from astropy.io import fits
+        from detection import find_sources, source_regions
+        if self.psf.model_file is None:
+            print('\nPlease create or upload psf first\n')
+            return False
+        with timing.span('fits_read'):
+            psf_data = fits.getdata(self.psf.model_file)
+            with fits.open(self.target_file) as hdul:
+                ny, nx = hdul[0].shape
+                xmin, xmax, ymin, ymax = box if box is not None else [1, nx, 1, ny]
+                xmin, ymin = max(int(xmin), 1), max(int(ymin), 1)
+                xmax, ymax = min(int(xmax), nx), min(int(ymax), ny)
+                # Only the fitting box is read
+                data = hdul[0].section[ymin-1:ymax, xmin-1:xmax]
+        sources = find_sources(data, psf_peak=psf_data.max() / psf_data.sum(),
+                               zero_point=self.zero_point)
+        if not sources:
+            print('\nNo sources found in fitting box\n')
+            return False
+        for source in sources:
+            source['x'] += xmin - 1
+            source['y'] += ymin - 1
+        self.make_config(source_regions(sources, [xmin, xmax, ymin, ymax]),
+                         [source['mag'] for source in sources if not source['point']],
+                         [source['mag'] for source in sources if source['point']])
+        n_points = sum(source['point'] for source in sources)
+        print(f'\nSeeded {len(sources) - n_points} sersic and {n_points} psf components\n')
+        return True
+
+    def edit_regions(self, regions: str) -> None:
+        '''
+        Rewrites galfit config file from edited regions without ds9. Like
+        edit_config, the fitting box (unless regions has a box), sky and
+        fitted magnitudes of the current config are kept, matched to the
+        regions in order, and the current constraint file is used
+
+        Args:
+            regions: ds9 region string with ellipses, points and optionally
+                     a box for frame
+
+        Returns: Nothing
+        '''
+        from region_to_config import input_to_galfit
+        if self.config_file is None:
+            print('\nPlease create config file first\n')
+            return
+        _, box, mags, psf_mags, sky_info, bending = self.config_regions()
+        output_fits = self.ouput_dir + self.target_filename + '_model_temp.fits'
+        output_mask = self.ouput_dir + self.target_filename + '_mask.fits'
+        constraint = self.constraint_file if self.constraint_file is not None else 'none'
+        self.mask = input_to_galfit(self.target_file, False, regions, self.zero_point,
+                                    self.config_file, output_fits, output_mask,
+                                    self.psf.model_file, box, mags, psf_mags, sky_info,
+                                    constraint, bending, self.psf.convolution_box())
+        self.manifest.record('sersic_config_file', 'sersic_mask')
+
+    def run_config(self) -> bool:
+        '''
+        Runs galfit for current config file in its own scratch directory,
+        leaving output there in self.galfit_run until saved or cleaned up
+
+        Args: None
+
+        Returns: True if galfit was successful
+        '''
+        # Run galfit
+        self.galfit_run = GalfitRun(self.galfit_path, self.config_file, self.ouput_dir)
+        self.galfit_run.run()
+        return self.check_run()
+
+    def check_run(self) -> bool:
+        '''
+        Checks if last galfit run was successful, cleaning it up if not
+
+        Args: None
+
+        Returns: True if galfit was successful
+        '''
+        print('\nFitting finished')
+        self.manifest.record_run('sersic', self.galfit_run)
+        if self.galfit_run.has_fits() and self.galfit_run.has_config():
+            return True
+        if self.galfit_run.has_fits():
+            print('\nCorrupted output. Check for buffer overflow.\nMay have to do with output directory path or target fits file path being too long\n')
+        else:
+            print('\nGalfit crashed. Please edit/remake config file and try again\n')
+        self.galfit_run.cleanup()
+        return False
+
+    def save_model(self) -> None:
+        '''
+        Replaces config with galfit output config and saves the model
+
+        Args: None
+
+        Returns: Nothing
+        '''
+        # Replace this config with galfit output config
+        self.galfit_run.save_config(self.config_file)
+        # save the model
+        output_fits_final = self.ouput_dir + self.target_filename + '_model.fits'
+        self.galfit_run.save_fits(output_fits_final)
+        self.galfit_run.cleanup()
+        self.config_output_file = output_fits_final
+        self.manifest.record('sersic_config_file', 'sersic_config_output_file')
 
     def optimize_config_(self, d) -> None:
         '''
@@ -255,65 +415,22 @@ class Sersic():
         if self.config_file is None:
             print('\nPlease create or upload psf galfit config file first\n')
         else:
-            config = open(self.config_file, 'r')
-            lines = config.readlines()
-            
-            comp_num = 0
-            comp_type = ""
-            for i, line in enumerate(lines):
-                # check for a line that contains the start of a component
-                if 'Component number:' in line:
-                    comp_num += 1
-                words = line.split()
-                # gets the component type (psf, sersic, sky, etc.)
-                if '0)' in line and '=0)' not in line and '10)' not in line:
-                    comp_type = words[1]
-                if comp_type == 'sky':
-                    if 'Z)' in line:
-                        lines[i] = "Z) 1\n"
-            config.close()
+            config = GalfitConfig.read(self.config_file)
+            # Skip sky components in output image
+            for component in config.components:
+                if component.type == 'sky' and 'Z' in component:
+                    config.set_param(component, 'Z', [1])
             # Write update to config file
-            with open(self.config_file, 'w') as file:
-                file.writelines(lines)
+            config.write(self.config_file)
+            self.manifest.record('sersic_config_file')
 
-            # Get rid of any previous galfit output config files
-            if os.path.exists('galfit.01'):
-                os.remove('galfit.01')
-            # Final output file
-            output_fits = self.ouput_dir + self.target_filename + '_model_temp.fits'
-            # Remove any previous temporary model outputs
-            if os.path.exists(output_fits):
-                os.remove(output_fits)
-            # Run galfit
-            # subprocess.run(['/bin/bash', '-c', self.galfit_path+" "+self.config_file])
-            # print(str(self.galfit_path.rstrip()+' '+self.config_file))
-            subprocess.run(['/bin/bash', '-c', str(self.galfit_path.rstrip()+' '+self.config_file)])
-            print('\nFitting finished')
-            # Check if galfit was successful
-            if os.path.exists(output_fits) and os.path.exists('galfit.01'):
+            # Run galfit and check if it was successful
+            if self.run_config():
                 print("\ngalfit run done, loading into DS9...\n")
                 # Open output in ds9
-                d.set("mecube new " + output_fits)
-                d.set("tile no")
-                d.set("cmap 1 0.5")
-                d.set("scale mode minmax")
-                d.set("mode none")
-                d.set("zoom to fit")
-                d.set("cube play")
-
-                # Replace this config with galfit output config
-                os.remove(self.config_file)
-                shutil.copyfile('galfit.01', self.config_file)
-                os.remove('galfit.01')
-                # save the model
-                output_fits_final = self.ouput_dir + self.target_filename + '_model.fits'
-                os.rename(output_fits, output_fits_final)
-                self.config_output_file = output_fits_final
-            else:
-                if os.path.exists(output_fits):
-                    print('\nCorrupted output. Check for buffer overflow.\nMay have to do with output directory path or target fits file path being too long\n')
-                else:
-                    print('\nGalfit crashed. Please edit/remake config file and try again\n')
+                d.show(self.galfit_run.output_fits, cube=True, scale='minmax', mode='none')
+                # Save the model and config
+                self.save_model()
 
     def produce_config(self, d) -> None:
         '''
@@ -324,26 +441,20 @@ class Sersic():
         
         Returns: Nothing
         '''
+        import pyregion
         if self.config_file is None:
             print('\nPlease create or upload config file first\n')
         else:
             # Open target in ds9
-            d.set("fits new "+self.target_file)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode 99.5")
-            d.set("zoom to fit")
-            d.set("mode region")
+            d.show(self.target_file, mode='region')
             _ = self.config_to_region(d)
             
             print('\nDO NOT edit/delete/add regions except for chaning source/background properties')
-            input('\nChange regions\' properties to background to not include in model. Hit enter to continue')
+            timing.prompt('\nChange regions\' properties to background to not include in model. Hit enter to continue')
             regions = d.get("region -system image")
 
-            # Establish output files
-            output_fits = self.ouput_dir + self.target_filename + '_model_temp.fits'
-            
-            regions = pyregion.parse(regions)
+            with timing.span('region_parse'):
+                regions = pyregion.parse(regions)
             reg_list = []
             inc_list = []
             for region in regions:
@@ -354,50 +465,48 @@ class Sersic():
                     reg_list.append(str(region.__dict__["attr"][1]["text"]))                    
                     inc_list.append(1)
 
-            with open(self.config_file, 'r') as config:
-                lines = config.readlines()
-                temp_lines = []
-                in_comp = False
-                for i, line in enumerate(lines):
-                    if 'Component number:' in line and 'sky' not in lines[i+1]:
-                        comp_num = str(int(line.split()[3]))
-                        in_comp = True
-                    if in_comp and 'Z)' in line:
-                        temp_lines.append(f"Z) {inc_list[reg_list.index(comp_num)]}")
-                        in_comp = False
-                    else:
-                        temp_lines.append(line)
+            # Set skip flag of each non-sky component from its region
+            included = dict(zip(reg_list, inc_list))
+            galfit_run = GalfitRun(self.galfit_path, self.config_file, self.ouput_dir, '-o2')
+            for component in galfit_run.config.components:
+                if str(component.number) in included and 'Z' in component:
+                    galfit_run.config.set_param(component, 'Z', [included[str(component.number)]])
+
+            # Run galfit, in background if job queue is set
+            if self.queue is not None:
+                self.queue.submit('sersic produce config', self.target_filename, galfit_run,
+                                  lambda d: self.review_produce(galfit_run, d))
+            else:
+                galfit_run.run()
+                self.review_produce(galfit_run, d)
 
-            # Write update to config file
-            with open(self.ouput_dir + 'config_temp.txt', 'w') as file:
-                file.writelines(temp_lines)
-
-            # Run galfit
-            subprocess.run(['/bin/bash', '-c', str(self.galfit_path.rstrip()+' '+self.ouput_dir+'config_temp.txt'+' -o2')])
-            os.remove(self.ouput_dir+'config_temp.txt')
-            print('\nFitting finished')
-            # Check if galfit was successful
-            if os.path.exists(output_fits):
-                print("\ngalfit run done, loading into DS9...\n")
-                print("produced mutli-frame fits model saved in "+str(self.ouput_dir + self.target_filename + '_model_prod.fits'))
-                print()
-                # Open output in ds9
-                d.set("mecube new " + output_fits)
-                d.set("tile no")
-                d.set("cmap 1 0.5")
-                d.set("scale mode minmax")
-                d.set("mode none")
-                d.set("zoom to fit")
-                d.set("cube play")
+    def review_produce(self, galfit_run: GalfitRun, d) -> None:
+        '''
+        Saves finished -o2 galfit run and loads it into ds9
 
-                # Save the model and config
-                output_fits_final = self.ouput_dir + self.target_filename + '_model_prod.fits'
-                os.rename(output_fits, output_fits_final)
-            else:
-                if os.path.exists(output_fits):
-                    print('\nCorrupted output. Check for buffer overflow.\nMay have to do with output directory path or target fits file path being too long\n')
-                else:
-                    print('\nGalfit crashed. Please edit/remake config file and try again\n')
+        Args:
+            galfit_run: finished galfit run of config with -o2
+            d: pyds9 DS9 instance
+
+        Returns: Nothing
+        '''
+        print('\nFitting finished')
+        self.manifest.record_run('sersic produce', galfit_run)
+        # Check if galfit was successful
+        if galfit_run.has_fits():
+            print("\ngalfit run done, loading into DS9...\n")
+            print("produced mutli-frame fits model saved in "+str(self.ouput_dir + self.target_filename + '_model_prod.fits'))
+            print()
+            # Save the model
+            output_fits_final = self.ouput_dir + self.target_filename + '_model_prod.fits'
+            galfit_run.save_fits(output_fits_final)
+            galfit_run.cleanup()
+            self.manifest.record('sersic_model_prod')
+            # Open output in ds9
+            d.show(output_fits_final, cube=True, scale='minmax', mode='none')
+        else:
+            galfit_run.cleanup()
+            print('\nGalfit crashed. Please edit/remake config file and try again\n')
 
 
 
@@ -413,13 +522,7 @@ class Sersic():
         if self.config_output_file is None:
             print('\nPlease upload or create sersic model first\n')
         else:
-            d.set("mecube new "+ self.config_output_file)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode minmax")
-            d.set("mode none")
-            d.set("zoom to fit")
-            d.set("cube play")
+            d.show(self.config_output_file, cube=True, scale='minmax', mode='none')
 
     def visualize_regions(self, d) -> None:
         '''
@@ -434,12 +537,7 @@ class Sersic():
             print('\nPlease create or upload config file first\n')
         else:
             # Open target in ds9
-            d.set("fits new "+self.target_file)
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("scale mode 99.5")
-            d.set("zoom to fit")
-            d.set("mode pan")
+            d.show(self.target_file, mode='pan')
             box, mags, psf_mags, sky_info, bending = self.config_to_region(d)
 
     def visualize_rgb(self, rfile: str, gfile: str, bfile: str, single: bool, d) -> None:
@@ -453,28 +551,30 @@ class Sersic():
 
         Returns: Nothing
         '''
+        from astropy.io import fits
         if single:
-            d.set("tile no")
-            d.set("cmap 1 0.5")
-            d.set("rgb")
-            d.set("rgb lock scale no")
-            d.set("rgb lock colorbar no")
-            d.set("rgb lock scalelimits yes")
-            d.set("rgb red")
-            d.set("scale linear")
-            d.set("scale mode 99.5")
-            d.set(f"fits {rfile}")
-            d.set("rgb green")
-            d.set("scale linear")
-            d.set("scale mode 99.5")
-            d.set(f"fits {gfile}")
-            d.set("rgb blue")
-            d.set("scale linear")
-            d.set("scale mode 99.5")
-            d.set(f"fits {bfile}")
-            d.set("rgb lock scale yes")
-            d.set("rgb lock colorbar yes")
-            d.set("zoom to fit")
+            with d.batch():
+                d.set("tile no")
+                d.set("cmap 1 0.5")
+                d.set("rgb")
+                d.set("rgb lock scale no")
+                d.set("rgb lock colorbar no")
+                d.set("rgb lock scalelimits yes")
+                d.set("rgb red")
+                d.set("scale linear")
+                d.set("scale mode 99.5")
+                d.set(f"fits {rfile}")
+                d.set("rgb green")
+                d.set("scale linear")
+                d.set("scale mode 99.5")
+                d.set(f"fits {gfile}")
+                d.set("rgb blue")
+                d.set("scale linear")
+                d.set("scale mode 99.5")
+                d.set(f"fits {bfile}")
+                d.set("rgb lock scale yes")
+                d.set("rgb lock colorbar yes")
+                d.set("zoom to fit")
 
             # _ = input("Change scaling as you wish, then hit enter to save")
             # print()
@@ -498,60 +598,29 @@ class Sersic():
             hdu_b = fits.open(bfile)
 
             if len(hdu_r) == 4 and len(hdu_g) == 4 and len(hdu_b) == 4:
-                d.set("frame delete all")
-                d.set("tile yes")
-                d.set("rgb")
-                d.set("rgb lock scale no")
-                d.set("rgb lock colorbar no")
-                d.set("rgb lock scalelimits yes")
-                d.set("rgb red")
-                d.set("scale linear")
-                d.set("scale mode 99.5")
-                d.set(f"mecube {rfile}")
-                d.set(f"cube 2")
-                d.set("scale limits "+rscale)
-                d.set("rgb green")
-                d.set("scale linear")
-                d.set("scale mode 99.5")
-                d.set(f"mecube {gfile}")
-                d.set(f"cube 2")
-                d.set("scale limits "+gscale)
-                d.set("rgb blue")
-                d.set("scale linear")
-                d.set("scale mode 99.5")
-                d.set(f"mecube {bfile}")
-                d.set(f"cube 2")
-                d.set("scale limits "+bscale)
-                d.set("rgb lock scale yes")
-                d.set("rgb lock colorbar yes")
-
-                d.set("rgb")
-                d.set("rgb lock scale no")
-                d.set("rgb lock colorbar no")
-                d.set("rgb lock scalelimits yes")
-                d.set("rgb red")
-                d.set("scale linear")
-                d.set("scale mode 99.5")
-                d.set(f"mecube {rfile}")
-                d.set(f"cube 3")
-                d.set("scale limits "+rscale)
-                d.set("rgb green")
-                d.set("scale linear")
-                d.set("scale mode 99.5")
-                d.set(f"mecube {gfile}")
-                d.set(f"cube 3")
-                d.set("scale limits "+gscale)
-                d.set("rgb blue")
-                d.set("scale linear")
-                d.set("scale mode 99.5")
-                d.set(f"mecube {bfile}")
-                d.set(f"cube 3")
-                d.set("scale limits "+bscale)
-                d.set("rgb lock scale yes")
-                d.set("rgb lock colorbar yes")
-                d.set("zoom to fit")
-                d.set("frame prev")
-                d.set("zoom to fit")
+                with d.batch():
+                    d.set("frame delete all")
+                    d.set("tile yes")
+                    # One rgb frame of models (cube 2) and one of residuals (cube 3).
+                    # Scale limits saved from target replace the scale mode
+                    for cube in [2, 3]:
+                        d.set("rgb")
+                        d.set("rgb lock scale no")
+                        d.set("rgb lock colorbar no")
+                        d.set("rgb lock scalelimits yes")
+                        for channel, file, scale in [('red', rfile, rscale),
+                                                     ('green', gfile, gscale),
+                                                     ('blue', bfile, bscale)]:
+                            d.set(f"rgb {channel}")
+                            d.set("scale linear")
+                            d.set(f"mecube {file}")
+                            d.set(f"cube {cube}")
+                            d.set("scale limits "+scale)
+                        d.set("rgb lock scale yes")
+                        d.set("rgb lock colorbar yes")
+                    d.set("zoom to fit")
+                    d.set("frame prev")
+                    d.set("zoom to fit")
             else:
                 with open(self.ouput_dir + 'rgb_info.txt') as info_:
                     lines = info_.readlines()
@@ -570,6 +639,7 @@ class Sersic():
 
         Returns: Nothing
         '''
+        from region_to_config import input_to_galfit
         if self.psf.model_file is None:
             print('\nPlease create or upload psf first\n')
         else:
@@ -590,10 +660,11 @@ class Sersic():
                 constraint = 'none'
             else:
                 constraint = self.constraint_file
-            input_to_galfit(self.target_file, False, regions, self.zero_point,
-                            self.config_file, output_fits, output_mask,
-                            self.psf.model_file, box, mags, psf_mags, sky_info,
-                            constraint, bending)
+            self.mask = input_to_galfit(self.target_file, False, regions, self.zero_point,
+                                        self.config_file, output_fits, output_mask,
+                                        self.psf.model_file, box, mags, psf_mags, sky_info,
+                                        constraint, bending, self.psf.convolution_box())
+            self.manifest.record('sersic_config_file', 'sersic_mask')
 
     def upload_model(self, file: str) -> None:
         '''
@@ -606,9 +677,10 @@ class Sersic():
 
         Returns: Nothing
         '''
-        self.config_output_file = self.ouput_dir + self.target_filename + '_config.txt'
+        self.config_output_file = self.ouput_dir + self.target_filename + '_model.fits'
         if file != self.config_output_file:
             shutil.copyfile(file, self.config_output_file)
+        self.manifest.record('sersic_config_output_file')
 
     def upload_constraint(self, file: str) -> None:
         '''
@@ -624,133 +696,99 @@ class Sersic():
             shutil.copyfile(file, self.constraint_file)
 
         # Update config file
-        with open(self.config_file, 'r') as file:
-            lines = file.readlines()
-        for i, line in enumerate(lines):
-            if 'G)' in line:
-                lines[i] = f'G) {self.constraint_file}\n'
-        with open(self.config_file, 'w') as file:
-            file.writelines(lines)
+        config = GalfitConfig.read(self.config_file)
+        config.set_header('G', self.constraint_file)
+        config.write(self.config_file)
+        self.manifest.record('sersic_constraint', 'sersic_config_file')
 
     def config_to_region(self, d) -> tuple[list[int], list[float]]:
         '''
         Converts a galfit config file into ds9 regions
         '''
+        # Open target file into ds9
+        d.show(self.target_file)
+        regions, box, magnitudes, psf_magnitudes, sky_info, bending = self.config_regions()
+
+        # create temporary region file to write region files out to
+        with open(self.ouput_dir + "temp_reg.reg", "w") as reg_f:
+            reg_f.write(regions)
+
+        # open regions, then delete temporary region file
+        d.set("region "+self.ouput_dir+"temp_reg.reg -system image")
+        os.remove(self.ouput_dir+"temp_reg.reg") 
+
+        return box, magnitudes, psf_magnitudes, sky_info, bending
+
+    def config_regions(self) -> tuple[str, list[int], list[float], list[float], list[float], list]:
+        '''
+        Converts a galfit config file into a ds9 region string, without ds9,
+        and gets what input_to_galfit needs to keep the config's fitted
+        values when it is rewritten from edited regions
+
+        Args: None
+
+        Returns: region string, fitting and convolution box, sersic
+                 magnitudes, psf magnitudes, sky info, sersic bending lines
+        '''
         # TODO: add magnitude memory for psf components
         assert self.config_file is not None
-        # Open target file into ds9
-        d.set("fits new "+self.target_file)
-        d.set("tile no")
-        d.set("cmap 1 0.5")
-        d.set("scale mode 99.5")
-        d.set("zoom to fit")
         # Keep track of magnitudes of all components
         magnitudes = []
         psf_magnitudes = []
         bending = []
         sky_info = [0, 0, 0, 0]
-        config = open(self.config_file, 'r')
-        lines = config.readlines()
+        config = GalfitConfig.read(self.config_file)
+        lines = []
 
-        # create temporary region file to write region files out to
-        reg_f = open(self.ouput_dir + "temp_reg.reg", "w")
-
-        for i, line in enumerate(lines):
+        for component in config.components:
+            number = component.number
             # Check for sersic component
-            if 'sersic' in line and 'sersic,' not in line:
-                if "# Component number:" in lines[i-1]:
-                    number = lines[i-1].split()[3]
+            if component.type == 'sersic':
+                # Get position info
+                x = component['1'].value(0)
+                y = component['1'].value(1)
+                # Get magnitude info
+                magnitudes.append(component['3'].value())
+                # Get effective radius
+                a = component['4'].value()
+                # Get axis ratio
+                b = component['9'].value() * a
+                # Get angle
+                angle = component['10'].value()
+                if angle >= 270:
+                    angle -= 90
                 else:
-                    number = ""
-                bend = False
-                for component_line in lines[i+1:]:
-                    words = component_line.split()
-                    if '1)' in component_line:
-                        # Get position info
-                        x = float(words[1])
-                        y = float(words[2])
-                    elif '3)' in component_line:
-                        # Get magnitude info
-                        magnitudes.append(float(words[1]))
-                    elif '4) ' in component_line and '=4)' not in component_line:
-                        # Get effective radius
-                        a = float(words[1])
-                    elif '9)' in component_line:
-                        # Get axis ratio
-                        b_over_a = float(words[1])
-                        b = b_over_a * a
-                    elif '10)' in component_line:
-                        # Get angle
-                        angle = float(words[1])
-                        if angle >= 270:
-                            angle -= 90
-                        else:
-                            angle += 90
-                    elif 'B2)' in component_line:
-                        bend = component_line
-                    if ('0)' in component_line and '10)' not in component_line) or component_line == lines[-1]:
-                        # Set ellipse region
-                        reg_f.write(f"ellipse {x} {y} {a} {b} {angle} # text={{{number}}} color=#f82")
-                        reg_f.write("\n")
-                        if bend:
-                            bending.append(bend)
-                        else:
-                            bending.append(None)
-                        break
-            # Check for psf component
-            if '0) psf' in line:
-                if "# Component number:" in lines[i-1]:
-                    number = lines[i-1].split()[3]
+                    angle += 90
+                # Set ellipse region
+                lines.append(f"ellipse {x} {y} {a} {b} {angle} # text={{{number}}} color=#f82")
+                if 'B2' in component:
+                    bending.append(config.lines[component['B2'].line].rstrip('\n'))
                 else:
-                    number = ""
-                for component_line in lines[i+1:]:
-                    words = component_line.split()
-                    if '1)' in component_line:
-                        # Get position info
-                        x = float(words[1])
-                        y = float(words[2])
-                    elif '3)' in component_line:
-                        # Get magnitude info
-                        psf_magnitudes.append(float(words[1]))
-                    if '0)' in component_line or component_line == lines[-1]:
-                        # Set region
-                        reg_f.write(f"point {x} {y} # text={{{number}}} color=#93f")
-                        reg_f.write("\n")
-                        break
-            if '0) sky' in line:
-                for component_line in lines[i+1:]:
-                    words = component_line.split()
-                    if '1)' in component_line:
-                        sky_info[3] = float(words[1])
-                    elif '2)' in component_line:
-                        sky_info[0] = float(words[1])
-                        sky_info[2] = int(words[2])
-                    elif '3)' in component_line:
-                        sky_info[1] = float(words[1])
-                        sky_info[2] = int(words[2])
-                    if '0)' in component_line or component_line == lines[-1]:
-                        break
-                    
-            if 'H)' in line:
-                words = line.split()
-                # Save box information
-                x_min = int(words[1])
-                x_max = int(words[2])
-                y_min = int(words[3])
-                y_max = int(words[4])
-            if 'I)' in line:
-                words = line.split()
-                # Save box information
-                x_center = int(words[1])
-                y_center = int(words[2])
-
-        # open regions, then delete temporary region file
-        reg_f.close()
-        d.set("region "+self.ouput_dir+"temp_reg.reg -system image")
-        os.remove(self.ouput_dir+"temp_reg.reg") 
-
-        config.close()
-        return [x_min, x_max, y_min, y_max, x_center, y_center],\
+                    bending.append(None)
+            # Check for psf component
+            elif component.type == 'psf':
+                # Get position info
+                x = component['1'].value(0)
+                y = component['1'].value(1)
+                # Get magnitude info
+                psf_magnitudes.append(component['3'].value())
+                # Set region
+                lines.append(f"point {x} {y} # text={{{number}}} color=#93f")
+            elif component.type == 'sky':
+                if '1' in component:
+                    sky_info[3] = component['1'].value()
+                if '2' in component:
+                    sky_info[0] = component['2'].value()
+                    sky_info[2] = int(component['2'].values[1])
+                if '3' in component:
+                    sky_info[1] = component['3'].value()
+                    sky_info[2] = int(component['3'].values[1])
+
+        # Save box information
+        x_min, x_max, y_min, y_max = [int(value) for value in config.header['H'].values[:4]]
+        x_center, y_center = [int(value) for value in config.header['I'].values[:2]]
+
+        return '\n'.join(lines) + '\n', [x_min, x_max, y_min, y_max, x_center, y_center],\
                 magnitudes, psf_magnitudes, sky_info, bending
     
     def add_constraint(self) -> None:
@@ -766,56 +804,46 @@ class Sersic():
         else:
             self.constraint_file = self.ouput_dir + self.target_filename + '_constraint.txt'
 
-            config = open(self.config_file, 'r')
-            lines = config.readlines()
-            
+            config = GalfitConfig.read(self.config_file)
+
             constraint_lines = []
-            comp_num = 0
-            comp_type = ""
-            for i, line in enumerate(lines):
-                # check for a line that contains the start of a component
-                if 'Component number:' in line:
-                    comp_num += 1
-                words = line.split()
-                # gets the component type (psft, sersic, sky, etc.)
-                if '0)' in line and '=0)' not in line and '10)' not in line:
-                    comp_type = words[1]
+            for component in config.components:
+                comp_num = component.number
                 # excludes sky component type in constraints (and other unsupported types)
-                if comp_type == 'psf' or comp_type == 'sersic' or comp_type == 'moffat':
-                    # constraints the x and y to +/- 1 pixels
-                    if '1)' in line:
-                        constraint_lines.append(f"{comp_num} x -1 1")
-                        constraint_lines.append(f"{comp_num} y -1 1")
-                    # constraints the magnitude to +/- 4 apparent magnitudes
-                    elif '3) ' in line:
-                        constraint_lines.append(f"{comp_num} 3 -4 4")
-                    # excludes psf component type, since other constraints don't apply
-                    if comp_type == 'sersic' or comp_type == 'moffat':
-                        # constraints the FWHM by +/- 10% of value
-                        if '4) ' in line:
-                            a = float(words[1])
-                            constraint_lines.append(f"{comp_num} 4 -{0.1*a:.5f} {0.1*a:.5f}")
-                        # constraints the sersic index/moffat powerlaw to +/- 10% of value
-                        if '5) ' in line:
-                            index = float(words[1])
-                            constraint_lines.append(f"{comp_num} 5 -{0.1*index:.5f} {0.1*index:.5f}")
-                        # constraints the axis ratio to +/- 10% of value
-                        elif '9) ' in line:
-                            b_over_a = float(words[1])
-                            constraint_lines.append(f"{comp_num} 9 -{0.1*b_over_a:.5f} {0.1*b_over_a:.5f}")
-                        # constraints the rotation to +/- 5 degrees
-                        elif '10) ' in line:
-                            constraint_lines.append(f"{comp_num} 10 -5 5")
-                # Add constraint to config
-                if 'G)' in line:
-                    lines[i] = f'G) {self.constraint_file}\n'
-            config.close()
+                if component.type not in ['psf', 'sersic', 'moffat']:
+                    continue
+                # constraints the x and y to +/- 1 pixels
+                if '1' in component:
+                    constraint_lines.append(f"{comp_num} x -1 1")
+                    constraint_lines.append(f"{comp_num} y -1 1")
+                # constraints the magnitude to +/- 4 apparent magnitudes
+                if '3' in component:
+                    constraint_lines.append(f"{comp_num} 3 -4 4")
+                # excludes psf component type, since other constraints don't apply
+                if component.type == 'sersic' or component.type == 'moffat':
+                    # constraints the FWHM by +/- 10% of value
+                    if '4' in component:
+                        a = component['4'].value()
+                        constraint_lines.append(f"{comp_num} 4 -{0.1*a:.5f} {0.1*a:.5f}")
+                    # constraints the sersic index/moffat powerlaw to +/- 10% of value
+                    if '5' in component:
+                        index = component['5'].value()
+                        constraint_lines.append(f"{comp_num} 5 -{0.1*index:.5f} {0.1*index:.5f}")
+                    # constraints the axis ratio to +/- 10% of value
+                    if '9' in component:
+                        b_over_a = component['9'].value()
+                        constraint_lines.append(f"{comp_num} 9 -{0.1*b_over_a:.5f} {0.1*b_over_a:.5f}")
+                    # constraints the rotation to +/- 5 degrees
+                    if '10' in component:
+                        constraint_lines.append(f"{comp_num} 10 -5 5")
+            # Add constraint to config
+            config.set_header('G', self.constraint_file)
             # Write update to config file
-            with open(self.config_file, 'w') as file:
-                file.writelines(lines)
+            config.write(self.config_file)
             # creates a text file from list of constraints     
             with open(self.constraint_file, 'w') as h:
                 h.write("\n".join(constraint_lines))
+            self.manifest.record('sersic_constraint', 'sersic_config_file')
 
     def remove_constraint(self) -> None:
         '''
@@ -835,13 +863,10 @@ class Sersic():
             print('\nPlease create or upload galfit config file first\n')
         else:
             # Update config file
-            with open(self.config_file, 'r') as file:
-                lines = file.readlines()
-            for i, line in enumerate(lines):
-                if 'G)' in line:
-                    lines[i] = 'G) none\n'
-            with open(self.config_file, 'w') as file:
-                file.writelines(lines)
+            config = GalfitConfig.read(self.config_file)
+            config.set_header('G', 'none')
+            config.write(self.config_file)
+        self.manifest.record('sersic_constraint', 'sersic_config_file')
 
     def flags(self) -> None:
         '''
@@ -852,6 +877,7 @@ class Sersic():
 
         Returns: Nothing
         '''
+        from astropy.io import fits
         # dictionary containing meanings of all possible flags
         flag_dict = {
                     "1": "Maximum number of iterations reached.  Quit out early.",
@@ -878,8 +904,9 @@ class Sersic():
         if self.config_output_file is None:
             print("\nPlease upload or create sersic model first\n")
         else:
-            hdulist = fits.open(self.config_output_file)
-            galfitheader = hdulist[2].header
+            with timing.span('fits_read'):
+                hdulist = fits.open(self.config_output_file)
+                galfitheader = hdulist[2].header
             galfit_flags = galfitheader["FLAGS"].split()
             print()
             for flag in galfit_flags:
@@ -895,6 +922,10 @@ class Sersic():
 
         Returns: Nothing
         '''
+        from astropy.io import fits
+        import numpy as np
+        import pyregion
+        from catalog import parse_value
 
         if self.config_output_file is None:
             print("\nPlease upload or create sersic model first\n")
@@ -908,9 +939,10 @@ class Sersic():
             d.set("tile yes")
             d.set("mode region")
             
-            input('\nChange regions\' properties to exclude to not include in sum of magnitudes. Hit enter to continue')
+            timing.prompt('\nChange regions\' properties to exclude to not include in sum of magnitudes. Hit enter to continue')
             regions = d.get("region -system image")
-            regions = pyregion.parse(regions)
+            with timing.span('region_parse'):
+                regions = pyregion.parse(regions)
 
             reg_keys = []
             inc_list = []
@@ -926,7 +958,7 @@ class Sersic():
                 mags = []
                 for i,key in enumerate(reg_keys):
                     if inc_list[i]==1:
-                        mags.append(float(header[key].split(' ',1)[0]))
+                        mags.append(parse_value(header[key])[0])
                 mags = np.array(mags)
 
                 fluxes = np.power(10,mags*-0.4)
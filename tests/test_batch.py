@@ -0,0 +1,68 @@
+# Batch runner checks of galfit wrapper, run against benchmarks/fake_galfit.py
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+from manifest import Manifest
+from synthetic import make_target, ZERO_POINT
+
+FAKE_GALFIT = os.path.join(REPO_DIR, 'benchmarks', 'fake_galfit.py')
+
+# Runs a batch in a fresh interpreter with HOME set to the scratch
+# directory, so the galfit cache is not shared with the user's
+BATCH_SCRIPT = '''
+import sys, json
+sys.path.insert(0, {repo!r})
+from batch import run_batch
+summaries = run_batch(json.loads({entries!r}), {galfit!r}, {output!r}, 2)
+print(json.dumps(summaries))
+'''
+
+def run_batch(work_dir: str, entries: list[dict]) -> list[dict]:
+    '''
+    Runs batch entries with fake galfit
+
+    Returns: list of run summaries
+    '''
+    output = os.path.join(work_dir, 'gf_out', '')
+    script = BATCH_SCRIPT.format(repo=REPO_DIR, entries=json.dumps(entries),
+                                 galfit=FAKE_GALFIT, output=output)
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            env=dict(os.environ, HOME=work_dir))
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_psf_library_fits_once_per_key(tmp_path):
+    '''
+    Targets sharing a psf library key run at once: one fits the psf and
+    adds it to the library, the other waits and links it
+    '''
+    entries = []
+    for seed, name in enumerate(['first', 'second']):
+        target = str(tmp_path / f'{name}.fits')
+        regions = make_target(target, 128, 4, seed)
+        entries.append({'target': target, 'zero_point': ZERO_POINT,
+                        'psf_regions': str(tmp_path / f'{name}_psf.reg'),
+                        'regions': str(tmp_path / f'{name}.reg'), 'psf_group': 'exposure_1'})
+        with open(entries[-1]['psf_regions'], 'w') as region_file:
+            region_file.write(regions['psf_regions'])
+        with open(entries[-1]['regions'], 'w') as region_file:
+            region_file.write(regions['regions'])
+    summaries = run_batch(str(tmp_path), entries)
+
+    assert all(summary['error'] is None and summary['sersic'] for summary in summaries)
+    psf_runs = [len(Manifest(summary['output_dir'], os.path.basename(summary['target'])[:-5])
+                    .runs('psf')) for summary in summaries]
+    assert sorted(psf_runs) == [0, 1]
+    with open(tmp_path / 'gf_out' / '.psf_library' / 'library.json') as library_file:
+        library = json.load(library_file)
+    assert list(library) == ['group=exposure_1']
+    assert library['group=exposure_1']['version'] == 1
+    assert len(library['group=exposure_1']['links']) == 1
@@ -0,0 +1,18 @@
+# Startup time and import checks of galfit wrapper (see benchmarks/startup.py)
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmarks'))
+
+from startup import make_target, check_startup
+
+def test_startup(tmp_path):
+    '''
+    TUI is ready within STARTUP_BUDGET without loading HEAVY_MODULES, and
+    headless commands load no GUI modules
+    '''
+    failures = check_startup(*make_target(str(tmp_path)))
+    assert failures == []
@@ -0,0 +1,136 @@
+# Per-command timing and hot path instrumentation for galfit wrapper
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import re
+import json
+import time
+import cProfile
+import threading
+import contextlib
+
+# Record of command being timed on this thread. Background jobs run on
+# other threads, so their spans never land in the command that is current
+_local = threading.local()
+
+def current() -> dict|None:
+    '''
+    Returns: record of command being timed on this thread, or None
+    '''
+    return getattr(_local, 'record', None)
+
+@contextlib.contextmanager
+def span(name: str):
+    '''
+    Times the enclosed block, adding it to the named span of the current
+    command. Spans of the same name add up, and their calls are counted.
+    Does nothing when no command is being timed
+
+    Args:
+        name: span name, e.g. 'fits_read', 'region_parse', 'mask', 'galfit'
+    '''
+    record = current()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans = record['spans'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+        spans['seconds'] += time.perf_counter() - start
+        spans['calls'] += 1
+
+def count(name: str, n: int =1) -> None:
+    '''
+    Adds to a named counter of the current command, e.g. ds9 round trips
+    '''
+    record = current()
+    if record is not None:
+        record['counts'][name] = record['counts'].get(name, 0) + n
+
+def prompt(text: str ='') -> str:
+    '''
+    Asks user for input, keeping the wait in its own 'prompt' span of the
+    current command, so user think time can be told apart from work
+
+    Args:
+        text: prompt shown to user
+
+    Returns: line typed by user
+    '''
+    with span('prompt'):
+        return input(text)
+
+@contextlib.contextmanager
+def command(name: str, log_file: str, profile_dir: str|None =None):
+    '''
+    Times a TUI command and appends its record to a JSONL log. Prompts
+    during the command should go through prompt(), so their wait is not
+    counted as work
+
+    Args:
+        name: command typed by user
+        log_file: JSONL file to append record to
+        profile_dir: directory to dump a cProfile file per command, or None
+
+    Returns: Nothing
+    '''
+    record = {'command': name, 'start': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'seconds': None, 'spans': {}, 'counts': {}, 'error': None}
+    _local.record = record
+    profile = cProfile.Profile() if profile_dir is not None else None
+    start = time.perf_counter()
+    try:
+        if profile is not None:
+            profile.enable()
+        yield record
+    except BaseException as error:
+        record['error'] = f'{type(error).__name__}: {error}'
+        raise
+    finally:
+        if profile is not None:
+            profile.disable()
+        record['seconds'] = time.perf_counter() - start
+        _local.record = None
+        for spans in record['spans'].values():
+            spans['seconds'] = round(spans['seconds'], 6)
+        record['seconds'] = round(record['seconds'], 6)
+        if profile is not None:
+            # Commands are typed by the user, so keep only safe characters
+            record['profile'] = os.path.join(profile_dir, time.strftime('%Y%m%d-%H%M%S_')
+                                             + re.sub(r'[^\w.-]', '_', name) + '.prof')
+        # Record is logged first, so a failed profile dump cannot lose it
+        with open(log_file, 'a') as log:
+            log.write(json.dumps(record) + '\n')
+        if profile is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            profile.dump_stats(record['profile'])
+
+class DS9Proxy():
+    '''
+    Class wrapping a pyds9 DS9 instance so each XPA round trip (set/get)
+    is counted and timed for the current command.
+
+    Attributes:
+        ds9: wrapped pyds9 DS9 instance
+
+    Methods:
+        set: sends command to ds9
+        get: queries ds9
+    '''
+    def __init__(self, ds9):
+        self.ds9 = ds9
+
+    def set(self, *args, **kwargs):
+        count('ds9_round_trips')
+        with span('ds9'):
+            return self.ds9.set(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        count('ds9_round_trips')
+        with span('ds9'):
+            return self.ds9.get(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self.ds9, name)
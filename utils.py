@@ -1,12 +1,11 @@
 # Util functions for galfit wrapper
 # Authors: Paxson Swierc & Daniel Babnigg
 
-import tkinter as tk
-from tkinter.filedialog import askopenfilename 
-from tkinter import Tk
-from tkinter import filedialog
 import os
 import sys
+import shutil
+from manifest import Manifest
+# tkinter is imported where used, so headless runs do not load the GUI stack
 
 def write_path_config() -> None:
     '''
@@ -50,10 +49,63 @@ def get_paths() -> tuple[str, str, str]:
 
     return path_to_galfit, path_to_output, galfit_output
 
+def init_target(target_path: str, path_to_output: str) -> tuple[str, str, str]:
+    '''
+    Makes output directory for target and copies target file into it
+
+    Args:
+        target_path: path to target fits file
+        path_to_output: root output directory (~/gf_out/)
+
+    Returns: path to copied target, target filename, target output directory
+    '''
+    target_filename = os.path.basename(target_path)[:-5]
+    path_to_output = os.path.join(path_to_output, target_filename, '')
+    # Check if output directory for this file already exists
+    if not os.path.exists(path_to_output):
+        os.makedirs(path_to_output)
+    # Copy target file to output dir
+    if not os.path.exists(path_to_output + os.path.basename(target_path)):
+        shutil.copyfile(target_path, path_to_output + os.path.basename(target_path))
+    target_path = path_to_output + os.path.basename(target_path)
+
+    return target_path, target_filename, path_to_output
+
+def saved_files(path_to_output: str, target_filename: str) -> dict[str, str|None]:
+    '''
+    Checks for any saved data in target output dir, from its manifest
+
+    Args:
+        path_to_output: target output directory
+        target_filename: filename of target
+
+    Returns: dict of artifact name -> path, or None if not saved
+    '''
+    return Manifest(path_to_output, target_filename).saved()
+
+def read_zero_point(path_to_output: str) -> float|None:
+    '''
+    Reads zero point saved in target output dir, None if not saved yet
+    '''
+    if not os.path.exists(path_to_output + 'zero_point.txt'):
+        return None
+    with open(path_to_output + 'zero_point.txt') as zero_point_file:
+        return float(zero_point_file.readlines()[0])
+
+def write_zero_point(path_to_output: str, zero_point: str) -> float:
+    '''
+    Writes zero point to file in target output dir for future reference
+    '''
+    with open(path_to_output + 'zero_point.txt', 'w') as zero_point_file:
+        zero_point_file.write(str(zero_point))
+    return float(zero_point)
+
 def my_filebrowser():
     '''
     Opens GUI file explorer to choose path to file
     '''
+    from tkinter import Tk
+    from tkinter.filedialog import askopenfilename
     root = Tk()
     root.withdraw()
     filename = askopenfilename()
@@ -63,6 +115,8 @@ def open_textfile(path_to_file):
     '''
     Opens GUI text editor
     '''
+    import tkinter as tk
+    from tkinter import Tk
     # saves file (overwrites) then quits window
     def save_file():
         with open(path_to_file, "w") as file:
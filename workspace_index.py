@@ -0,0 +1,290 @@
+# SQLite index of all targets in the output directory
+# Author: Paxson Swierc & Daniel Babnigg
+
+import os
+import sys
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Index lives in the root output directory (~/gf_out/), next to the targets
+INDEX_FILE = 'index.sqlite'
+# Seconds to wait on another writer (e.g. batch workers) before giving up
+LOCK_TIMEOUT = 30
+# Threads reading target manifests on rebuild, since NFS reads are latency bound
+REBUILD_WORKERS = 16
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS targets (
+    name TEXT PRIMARY KEY,
+    output_dir TEXT,
+    band TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    target TEXT,
+    name TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    PRIMARY KEY (target, name)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    target TEXT,
+    stage TEXT,
+    config TEXT,
+    options TEXT,
+    started TEXT,
+    seconds REAL,
+    status TEXT,
+    returncode INTEGER,
+    cached INTEGER,
+    iteration INTEGER,
+    chi2nu REAL,
+    stopped TEXT,
+    log TEXT,
+    UNIQUE (target, started, stage, log)
+);
+CREATE TABLE IF NOT EXISTS flags (
+    run_id INTEGER,
+    flag TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_target ON runs (target);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+CREATE INDEX IF NOT EXISTS flags_flag ON flags (flag);
+'''
+
+# Saved queries: name -> (SQL, description). ? is filled from query arguments
+QUERIES = {
+    'targets': ('SELECT name, band, updated, output_dir FROM targets ORDER BY name',
+                'all indexed targets'),
+    'finished': ("SELECT t.name, t.band, a.path FROM targets t JOIN artifacts a ON a.target = t.name "
+                 "WHERE a.name = 'sersic_config_output_file' ORDER BY t.name",
+                 'targets with a saved sersic model'),
+    'unfinished': ("SELECT name, band FROM targets WHERE name NOT IN (SELECT target FROM artifacts "
+                   "WHERE name = 'sersic_config_output_file') ORDER BY name",
+                   'targets without a saved sersic model'),
+    'no-psf': ("SELECT name, band FROM targets WHERE name NOT IN (SELECT target FROM artifacts "
+               "WHERE name = 'psf_model_file') ORDER BY name",
+               'targets without a psf model'),
+    'flag': ('SELECT r.target, r.stage, r.started, r.chi2nu, r.log FROM runs r JOIN flags f '
+             'ON f.run_id = r.id WHERE f.flag = ? ORDER BY r.started',
+             'runs that raised a galfit flag, e.g. flag 2'),
+    'failed': ("SELECT target, stage, started, status, stopped, log FROM runs "
+               "WHERE status IN ('failed', 'killed') ORDER BY started",
+               'runs that crashed or were killed'),
+    'latest': ('SELECT target, stage, MAX(started) AS started, status, iteration, chi2nu, seconds '
+               'FROM runs GROUP BY target, stage ORDER BY target',
+               'last run of each stage per target'),
+    'slow': ('SELECT target, stage, started, seconds, iteration FROM runs '
+             'ORDER BY seconds DESC LIMIT 20',
+             'longest 20 runs'),
+    'time': ('SELECT stage, COUNT(*) AS runs, ROUND(SUM(seconds), 1) AS total_s, '
+             'ROUND(AVG(seconds), 2) AS mean_s FROM runs GROUP BY stage',
+             'galfit time spent per stage'),
+}
+
+def index_path(path_to_output: str) -> str:
+    '''
+    Returns: path to index of root output directory
+    '''
+    return os.path.join(path_to_output, INDEX_FILE)
+
+def connect(index_file: str) -> sqlite3.Connection:
+    '''
+    Opens index, creating its tables if needed
+
+    Args:
+        index_file: path to index
+
+    Returns: sqlite connection
+    '''
+    connection = sqlite3.connect(index_file, timeout=LOCK_TIMEOUT)
+    connection.executescript(SCHEMA)
+    return connection
+
+def write_target(connection: sqlite3.Connection, output_dir: str, data: dict,
+                 runs: list[dict]) -> None:
+    '''
+    Writes a target's manifest into the index: replaces its row and
+    artifacts, and adds runs not yet indexed. Does not commit
+
+    Args:
+        connection: open index
+        output_dir: target output directory
+        data: target manifest dict
+        runs: runs to add
+    '''
+    name = data['target']
+    connection.execute('INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?)',
+                       (name, output_dir, data.get('band'), data.get('updated')))
+    connection.execute('DELETE FROM artifacts WHERE target = ?', (name,))
+    connection.executemany('INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?)',
+                           [(name, artifact, entry['path'], entry['size'], entry['mtime_ns'],
+                             entry['sha256']) for artifact, entry in data['artifacts'].items()])
+    for run in runs:
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO runs (target, stage, config, options, started, seconds, status, '
+            'returncode, cached, iteration, chi2nu, stopped, log) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (name, run['stage'], run['config'], run['options'], run['started'], run['seconds'],
+             run['status'], run['returncode'], run['cached'], run['iteration'], run['chi2nu'],
+             run['stopped'], run['log']))
+        if cursor.rowcount:
+            connection.executemany('INSERT INTO flags VALUES (?, ?)',
+                                   [(cursor.lastrowid, flag) for flag in run['flags'] or []])
+
+def update_target(output_dir: str, data: dict, runs: list[dict]) -> None:
+    '''
+    Updates the index with a target's manifest, after every manifest write.
+    The index can always be rebuilt from the manifests, so a failure to
+    update it is reported but does not stop the wrapper
+
+    Args:
+        output_dir: target output directory
+        data: target manifest dict
+        runs: runs added to manifest since last update
+
+    Returns: Nothing
+    '''
+    path_to_output = os.path.dirname(os.path.normpath(output_dir))
+    try:
+        connection = connect(index_path(path_to_output))
+        try:
+            with connection:
+                write_target(connection, output_dir, data, runs)
+        finally:
+            connection.close()
+    except sqlite3.Error as error:
+        print(f'\nCould not update index {index_path(path_to_output)}: {error}. '
+              'Run index rebuild to fix it\n')
+
+def target_dirs(path_to_output: str) -> list[tuple[str, str]]:
+    '''
+    Finds target output directories: subdirectories of the root output
+    directory holding a copy of their target, <name>/<name>.fits. Hidden
+    directories (e.g. the galfit cache) are skipped
+
+    Returns: list of (output dir, target filename)
+    '''
+    targets = []
+    with os.scandir(path_to_output) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            if os.path.exists(os.path.join(entry.path, entry.name + '.fits')):
+                targets.append((os.path.join(entry.path, ''), entry.name))
+    return sorted(targets)
+
+def rebuild(path_to_output: str, workers: int =REBUILD_WORKERS) -> int:
+    '''
+    Rebuilds the index from every target's manifest, rebuilding missing
+    manifests from disk. Manifests are read concurrently, written to a new
+    index in a single transaction, and the new index moved over the old
+
+    Args:
+        path_to_output: root output directory (~/gf_out/)
+        workers: threads reading manifests
+
+    Returns: number of targets indexed
+    '''
+    from manifest import Manifest
+    targets = target_dirs(path_to_output)
+    def load(target):
+        return target[0], Manifest(*target).load()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        manifests = list(pool.map(load, targets))
+    new_index = index_path(path_to_output) + '.new'
+    if os.path.exists(new_index):
+        os.remove(new_index)
+    connection = connect(new_index)
+    try:
+        with connection:
+            for output_dir, data in manifests:
+                write_target(connection, output_dir, data, data['runs'])
+    finally:
+        connection.close()
+    os.replace(new_index, index_path(path_to_output))
+    return len(manifests)
+
+def query(path_to_output: str, sql: str, args: list[str]|None =None) -> tuple[list[str], list[tuple]]:
+    '''
+    Runs a saved query (by name) or any read-only SQL on the index
+
+    Args:
+        path_to_output: root output directory (~/gf_out/)
+        sql: saved query name (see QUERIES) or SQL
+        args: values for ? placeholders
+
+    Returns: column names, rows
+    '''
+    if sql in QUERIES:
+        sql = QUERIES[sql][0]
+    # Open read only, so ad hoc SQL cannot change the index
+    connection = sqlite3.connect(f'file:{index_path(path_to_output)}?mode=ro', uri=True,
+                                 timeout=LOCK_TIMEOUT)
+    try:
+        cursor = connection.execute(sql, args or [])
+        columns = [column[0] for column in cursor.description or []]
+        return columns, cursor.fetchall()
+    finally:
+        connection.close()
+
+def print_table(columns: list[str], rows: list[tuple]) -> None:
+    '''
+    Prints query results as aligned columns
+    '''
+    if not rows:
+        print('\nNo results\n')
+        return
+    text = [[str(value) if value is not None else '' for value in row] for row in rows]
+    widths = [max(len(column), *(len(row[i]) for row in text)) for i, column in enumerate(columns)]
+    print()
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)).rstrip())
+    print('  '.join('-' * width for width in widths))
+    for row in text:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    print(f'\n{len(rows)} row(s)\n')
+
+def print_queries() -> None:
+    '''
+    Prints saved queries with their descriptions
+    '''
+    print('\nSaved queries (or type any SQL):')
+    for name, (_, description) in QUERIES.items():
+        print(f'- {name:<12} {description}')
+    print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query or rebuild the index of all galfit wrapper targets')
+    parser.add_argument('--output', default=os.path.expanduser('~/gf_out/'),
+                        help='root output directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    query_parser = subparsers.add_parser('query', help='run a saved query or SQL')
+    query_parser.add_argument('sql', nargs='?', default=None,
+                              help='saved query name or SQL, lists saved queries if not given')
+    query_parser.add_argument('args', nargs='*', help='values for ? placeholders, e.g. a flag')
+    query_parser.add_argument('--json', action='store_true', help='print rows as JSON')
+    rebuild_parser = subparsers.add_parser('rebuild', help='rebuild index from target manifests')
+    rebuild_parser.add_argument('--workers', type=int, default=REBUILD_WORKERS,
+                                help='threads reading manifests')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        print(f'Indexed {rebuild(args.output, args.workers)} targets into {index_path(args.output)}')
+    elif args.sql is None:
+        print_queries()
+    else:
+        if not os.path.exists(index_path(args.output)):
+            sys.exit(f'No index at {index_path(args.output)}, run rebuild first')
+        try:
+            columns, rows = query(args.output, args.sql, args.args)
+        except sqlite3.Error as error:
+            sys.exit(f'Query failed: {error}')
+        if args.json:
+            print(json.dumps([dict(zip(columns, row)) for row in rows], indent=1))
+        else:
+            print_table(columns, rows)